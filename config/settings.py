@@ -1,5 +1,5 @@
 import yaml
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 
 
 class ServerSettings(BaseModel):
@@ -7,6 +7,8 @@ class ServerSettings(BaseModel):
     port: int = 8000
     root_path: str = ""
     served_model_names: list[str] | None = Field(default_factory=list)
+    # seconds a generation may run before it is stopped, None for no limit
+    request_timeout: float | None = None
 
 
 class LogSettings(BaseModel):
@@ -21,11 +23,101 @@ class QuantizationSettings(BaseModel):
     bnb_8bit: bool = False
 
 
+class ToolCallSettings(BaseModel):
+    start: str = "<tool_call>"
+    end: str = "</tool_call>"
+
+
+class ReasoningSettings(BaseModel):
+    enabled: bool = False
+    start: str = "<think>"
+    end: str = "</think>"
+    starts_thinking: bool = False
+
+
 class ModelSettings(BaseModel):
     model_path: str
     quantization: QuantizationSettings = Field(default_factory=QuantizationSettings)
     device: str = "auto"
     precision: str = "bfloat16"
+    compile: bool = True
+    compile_cache_dir: str | None = None
+    warmup_lengths: list[int] = Field(default_factory=list)
+    warmup_new_tokens: int = 4
+    length_buckets: list[int] = Field(default_factory=list)
+    batch_buckets: list[int] = Field(default_factory=list)
+    prefix_cache_mb: float = 0.0
+    template_cache_size: int = 256
+    grammar_cache_size: int = 32
+    tool_calls: ToolCallSettings = Field(default_factory=ToolCallSettings)
+    reasoning: ReasoningSettings = Field(default_factory=ReasoningSettings)
+    draft_model_path: str | None = None
+    prompt_lookup_num_tokens: int | None = None
+
+
+class RegistrySettings(BaseModel):
+    max_resident_models: int = 0
+    memory_budget_gb: float = 0.0
+    eviction: str = "release"
+
+
+class DataParallelSettings(BaseModel):
+    workers: int = 1
+    devices: list[str] = Field(default_factory=list)
+    pin_cpu_cores: bool = True
+
+
+class BatchingSettings(BaseModel):
+    enabled: bool = False
+    continuous: bool = False
+    max_wait_ms: float = 10.0
+    max_batch_size: int = 8
+    max_padded_tokens: int = 16384
+
+
+class BatchJobSettings(BaseModel):
+    storage_dir: str = "data/batches"
+    chunk_size: int = 1024
+    max_batch_size: int = 32
+    max_padded_tokens: int = 65536
+    yield_to_online: int = 0
+    max_yield_seconds: float = 5.0
+
+
+class ExecutorSettings(BaseModel):
+    max_concurrency: int = 4
+    max_queue_size: int = 64
+
+
+class KVCacheSettings(BaseModel):
+    budget_gb: float = 0.0
+    memory_fraction: float = 0.9
+    implementations: list[str] = Field(
+        default_factory=lambda: ["dynamic", "quantized", "offloaded"]
+    )
+    quantized_backend: str = "quanto"
+    quantized_nbits: int = 4
+    max_wait_seconds: float = 30.0
+
+
+class EmbeddingSettings(BaseModel):
+    model_path: str | None = None
+    pooling: str = "mean"
+    normalize: bool = True
+    max_batch_size: int = 32
+    max_batch_tokens: int = 16384
+
+
+class ResponseCacheSettings(BaseModel):
+    enabled: bool = False
+    max_entries: int = 1024
+    max_tokens: int = 1_000_000
+    ttl_seconds: float = 3600.0
+    persist_path: str | None = None
+
+
+class MetricsSettings(BaseModel):
+    enabled: bool = False
 
 
 class CorsSettings(BaseModel):
@@ -39,9 +131,41 @@ class CorsSettings(BaseModel):
 class AppSettings(BaseModel):
     server: ServerSettings = Field(default_factory=ServerSettings)
     model: ModelSettings
+    models: dict[str, ModelSettings] = Field(default_factory=dict)
+    registry: RegistrySettings = Field(default_factory=RegistrySettings)
+    data_parallel: DataParallelSettings = Field(default_factory=DataParallelSettings)
     log: LogSettings = Field(default_factory=LogSettings)
+    batching: BatchingSettings = Field(default_factory=BatchingSettings)
+    executor: ExecutorSettings = Field(default_factory=ExecutorSettings)
+    kv_cache: KVCacheSettings = Field(default_factory=KVCacheSettings)
+    batch_jobs: BatchJobSettings = Field(default_factory=BatchJobSettings)
+    response_cache: ResponseCacheSettings = Field(
+        default_factory=ResponseCacheSettings
+    )
+    embeddings: EmbeddingSettings = Field(default_factory=EmbeddingSettings)
+    metrics: MetricsSettings = Field(default_factory=MetricsSettings)
     cors: CorsSettings = Field(default_factory=CorsSettings)
 
+    @model_validator(mode="after")
+    def check_prefix_cache(self) -> "AppSettings":
+        # prefix cached requests run one `generate` call each, outside any batch
+        if not (self.batching.enabled or self.batching.continuous):
+            return self
+        names = [
+            f"models.{name}"
+            for name, model in self.models.items()
+            if model.prefix_cache_mb > 0
+        ]
+        if self.model.prefix_cache_mb > 0:
+            names.insert(0, "model")
+        if names:
+            raise ValueError(
+                f"Configuration error: {', '.join(names)} sets prefix_cache_mb, "
+                "which cannot be combined with batching.enabled or "
+                "batching.continuous. Disable one of them"
+            )
+        return self
+
 
 def load_config(config_file: str = "config/config.yaml") -> AppSettings:
     """Loads configuration from a YAML file."""
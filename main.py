@@ -5,11 +5,18 @@ from fastapi import FastAPI, Request
 from config.settings import load_config
 from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
-from src.core.engine import InferenceEngine
+from src.core.registry import ModelRegistry
+from src.api.utils.file_store import FileStore
+from src.api.utils.batch_runner import BatchRunner
+from src.api.utils.leases import ReleaseEngineLeases
 from fastapi.middleware.cors import CORSMiddleware
 from src.api.endpoints import (
+    files,
     health,
+    batches,
+    metrics,
     tokenizer,
+    embeddings,
     list_models,
     completions,
     chat_completions,
@@ -27,26 +34,36 @@ logger = logging.getLogger(" TransAPI ")
 # --- Application Lifespan Management ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup: Load the inference engine
+    # Startup: Load the default model, the others load on their first request
     logger.info("Application startup: Loading inference engine...")
     try:
-        engine = InferenceEngine(settings, logger)
-        app.state.engine = engine  # Store the engine instance in app state
+        registry = ModelRegistry(settings, logger)
+        registry.load_default()
+        app.state.registry = registry  # Store the registry instance in app state
         logger.info("Inference engine loaded successfully.")
     except Exception as e:
         logger.error(
             f"FATAL: Failed to initialize InferenceEngine during startup: {e}",
             exc_info=True,
         )
-        app.state.engine = None
+        app.state.registry = None
         raise RuntimeError("Failed to initialize model engine during startup.") from e
+    # offline jobs, unfinished ones resume from their last checkpoint
+    batch_runner = BatchRunner(
+        registry, FileStore(settings.batch_jobs.storage_dir), settings, logger
+    )
+    batch_runner.start()
+    app.state.batch_runner = batch_runner
 
     yield  # Application runs here
 
     # Shutdown: Clean up resources (optional)
     logger.info("Application shutdown: Cleaning up resources...")
-    if hasattr(app.state, "engine") and app.state.engine is not None:
-        del app.state.engine  # Remove from state
+    await batch_runner.close()
+    del app.state.batch_runner
+    if hasattr(app.state, "registry") and app.state.registry is not None:
+        app.state.registry.close()
+        del app.state.registry  # Remove from state
         logger.info("Inference engine resources released.")
     logger.info("Application shutdown complete.")
 
@@ -57,6 +74,8 @@ app = FastAPI(
     root_path=settings.server.root_path,
     lifespan=lifespan,  # Register the lifespan context manager
 )
+# engines stay leased to a request until its response, streams included, is sent
+app.add_middleware(ReleaseEngineLeases)
 logger.info(
     f"FastAPI application initialized with root_path: '{settings.server.root_path}'"
 )
@@ -87,8 +106,12 @@ def startup():
     app.include_router(list_models.router, tags=["OpenAI - Models"])
     app.include_router(completions.router, tags=["OpenAI - Completions"])
     app.include_router(chat_completions.router, tags=["OpenAI - Chat Completions"])
+    app.include_router(embeddings.router, tags=["OpenAI - Embeddings"])
+    app.include_router(files.router, tags=["OpenAI - Files"])
+    app.include_router(batches.router, tags=["OpenAI - Batches"])
     app.include_router(tokenizer.router, tags=["OpenAI - Tokenizer"])
     app.include_router(health.router, tags=["OpenAI - Health"])
+    app.include_router(metrics.router, tags=["Monitoring"])
     logger.info("Starting Uvicorn server...")
 
     uvicorn.run(
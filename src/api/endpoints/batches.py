@@ -0,0 +1,61 @@
+from fastapi import APIRouter, Depends, HTTPException
+from src.api.utils.batch_runner import BatchRunner
+from src.api.utils.dependencies import get_batch_runner
+from src.api.types.batches import (
+    BATCH_ENDPOINTS,
+    BatchList,
+    BatchObject,
+    BatchRequest,
+)
+
+router = APIRouter()
+
+
+@router.post("/v1/batches", response_model=BatchObject)
+async def create_batch(
+    request: BatchRequest, runner: BatchRunner = Depends(get_batch_runner)
+):
+    """Queues the requests of an uploaded JSONL file as an offline job."""
+    if request.endpoint not in BATCH_ENDPOINTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported endpoint {request.endpoint}, "
+            f"use one of {', '.join(BATCH_ENDPOINTS)}",
+        )
+    if runner.store.get_file(request.input_file_id) is None:
+        raise HTTPException(
+            status_code=404, detail=f"No such file: {request.input_file_id}"
+        )
+    batch = BatchObject(
+        id=runner.store.new_id("batch"),
+        endpoint=request.endpoint,
+        input_file_id=request.input_file_id,
+        completion_window=request.completion_window,
+        metadata=request.metadata,
+    )
+    runner.submit(batch)
+    return batch
+
+
+@router.get("/v1/batches", response_model=BatchList)
+async def list_batches(runner: BatchRunner = Depends(get_batch_runner)):
+    return BatchList(data=runner.store.list_batches())
+
+
+@router.get("/v1/batches/{batch_id}", response_model=BatchObject)
+async def retrieve_batch(
+    batch_id: str, runner: BatchRunner = Depends(get_batch_runner)
+):
+    batch = runner.store.get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"No such batch: {batch_id}")
+    return batch
+
+
+@router.post("/v1/batches/{batch_id}/cancel", response_model=BatchObject)
+async def cancel_batch(batch_id: str, runner: BatchRunner = Depends(get_batch_runner)):
+    """Stops the batch after its current chunk, finished results are kept."""
+    batch = runner.store.get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"No such batch: {batch_id}")
+    return runner.cancel(batch)
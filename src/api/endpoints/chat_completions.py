@@ -1,12 +1,30 @@
-from threading import Thread
+import time
+import asyncio
 from src.core.engine import InferenceEngine
+from src.core.kv_memory import KVCacheTooLargeError
+from src.core.constrained import InvalidConstraintError, OutputConstraint
+from src.core.outputs import GenerationResult
+from config.settings import ToolCallSettings
 from src.api.types.usage_info import UsageInfo
 from fastapi.responses import StreamingResponse
 from src.api.utils.format_sse import format_sse
-from fastapi import APIRouter, HTTPException, Depends
-from src.api.utils.dependencies import get_inference_engine
-from transformers.generation.streamers import TextIteratorStreamer
+from src.api.types.stream_options import StreamOptions
+from src.core.cancellation import StopSignal
+from src.api.utils.disconnect import cancel_on_disconnect, stop_on_disconnect
+from src.api.utils.request_metrics import record_request, track_request
+from src.api.utils.dependencies import get_engine_for_model
+from fastapi import APIRouter, HTTPException, Request
+from src.core.executor import EngineOverloadedError, EngineUnavailableError
+from src.api.types.tool_call import NamedToolChoice, ToolCall
+from src.api.utils.incremental_streamer import IncrementalStreamer, SSEChunkTemplate
+from src.api.utils.reasoning_parser import ReasoningSplitter, split_reasoning
+from src.api.utils.tool_parser import (
+    ToolCallParser,
+    parse_tool_calls,
+    tool_call_constraint,
+)
 from src.api.types.chat_completions import (
+    ChoiceLogprobs,
     GeneratedMessage,
     ChatCompletionChoice,
     ChatCompletionRequest,
@@ -16,69 +34,198 @@ from src.api.types.chat_completions import (
 router = APIRouter()
 
 
-async def _stream_completion(request: ChatCompletionRequest, engine: InferenceEngine):
+def _num_top_logprobs(request: ChatCompletionRequest) -> int | None:
+    """The engine's `logprobs` argument, None when logprobs are off."""
+    return (request.top_logprobs or 0) if request.logprobs else None
+
+
+def _tools(request: ChatCompletionRequest) -> list[dict] | None:
+    """Tools for the chat template, None when the model may not call any."""
+    if not request.tools or request.tool_choice == "none":
+        return None
+    return [tool.model_dump(exclude_none=True) for tool in request.tools]
+
+
+def _constraint(
+    request: ChatCompletionRequest, markers: ToolCallSettings
+) -> OutputConstraint | None:
+    """Forced tool calls, or the `response_format` of the request."""
+    choice = request.tool_choice
+    if request.tools and (choice == "required" or isinstance(choice, NamedToolChoice)):
+        name = choice.function.name if isinstance(choice, NamedToolChoice) else None
+        return tool_call_constraint(request.tools, markers.start, markers.end, name)
+    return request.response_format.constraint() if request.response_format else None
+
+
+def _delta_chunks(
+    request: ChatCompletionRequest,
+    index: int,
+    text: str,
+    logprobs: list | None = None,
+    tool_calls: list[ToolCall] | None = None,
+    reasoning: str = "",
+):
+    """SSE chunks of a choice's reasoning, content with logprobs, then tool calls."""
+    if reasoning:
+        choice = ChatCompletionChoice(
+            index=index,
+            delta=GeneratedMessage(content=None, reasoning_content=reasoning),
+        )
+        chunk = ChatCompletionResponse(model=request.model, choices=[choice])
+        yield format_sse(chunk.model_dump())
+    if text or logprobs:
+        choice = ChatCompletionChoice(
+            index=index,
+            delta=GeneratedMessage(content=text),
+            logprobs=(
+                ChoiceLogprobs.from_tokens(logprobs) if logprobs is not None else None
+            ),
+        )
+        chunk = ChatCompletionResponse(model=request.model, choices=[choice])
+        yield format_sse(chunk.model_dump())
+    if tool_calls:
+        choice = ChatCompletionChoice(
+            index=index, delta=GeneratedMessage(content=None, tool_calls=tool_calls)
+        )
+        chunk = ChatCompletionResponse(model=request.model, choices=[choice])
+        yield format_sse(chunk.model_dump())
+
+
+async def _stream_completion(
+    request: ChatCompletionRequest,
+    engine: InferenceEngine,
+    constraint: OutputConstraint | None,
+    raw_request: Request,
+):
     messages = [msg.model_dump(exclude_none=True) for msg in request.messages]
     # init_choice = CompletionChoice(text="\n\n")
     # init_response = CompletionResponse(model=request.model, choices=[init_choice])
     # yield format_sse(init_response.model_dump())
 
-    streamer = TextIteratorStreamer(
-        engine.tokenizer,  # type: ignore
+    started = time.perf_counter()
+    options = request.stream_options or StreamOptions()
+    streamer = IncrementalStreamer(
+        engine.tokenizer,
         skip_prompt=True,
         skip_special_tokens=True,
+        coalesce_tokens=options.coalesce_tokens,
+        coalesce_interval=options.coalesce_interval_ms / 1000,
     )
+    num_choices = request.num_return_sequences or 1
+    templates = [
+        SSEChunkTemplate(
+            ChatCompletionResponse(
+                model=request.model,
+                choices=[
+                    ChatCompletionChoice(
+                        index=index,
+                        delta=GeneratedMessage(content=SSEChunkTemplate.PLACEHOLDER),
+                    )
+                ],
+            ).model_dump()
+        )
+        for index in range(num_choices)
+    ]
 
     gen_cfg = request.gen_config()
-
-    thread = Thread(
-        target=engine.generate_chat_completions,
-        kwargs=dict(
-            conversation=messages, generation_config=gen_cfg, streamer=streamer
-        ),
+    tools = _tools(request)
+    markers = engine.settings.model.tool_calls
+    parsers = (
+        [ToolCallParser(markers.start, markers.end) for _ in range(num_choices)]
+        if tools
+        else None
+    )
+    reasoning = engine.settings.model.reasoning
+    splitters = (
+        [ReasoningSplitter(reasoning) for _ in range(num_choices)]
+        if reasoning.enabled
+        else None
     )
-    thread.start()
 
     finish_reason = None
-    all_text = ""
+    usage_info = None
+    result: GenerationResult | None = None
 
-    try:
-        for text in streamer:
-            if not text:
-                continue
+    stop = StopSignal()
+    timeout = engine.settings.server.request_timeout
+    async with stop_on_disconnect(raw_request, stop, timeout=timeout):
+        try:
+            future = engine.stream_chat_completions(
+                conversation=messages,
+                streamer=streamer,
+                generation_config=gen_cfg,
+                speculative=request.speculative,
+                logprobs=_num_top_logprobs(request),
+                constraint=constraint,
+                tools=tools,
+                max_reasoning_tokens=request.max_reasoning_tokens,
+                stop=stop,
+            )
+            async for index, text, logprobs in streamer:
+                if splitters is None and parsers is None and logprobs is None:
+                    yield templates[index].render(text)
+                    continue
+                thought = ""
+                if splitters is not None:
+                    thought, text = splitters[index].feed(text)
+                tool_calls = None
+                if parsers is not None:
+                    text, tool_calls = parsers[index].feed(text)
+                for chunk in _delta_chunks(
+                    request, index, text, logprobs, tool_calls, thought
+                ):
+                    yield chunk
+            for index in range(num_choices if splitters or parsers else 0):
+                thought, text, tool_calls = "", "", []
+                if splitters is not None:
+                    thought, text = splitters[index].flush()
+                if parsers is not None:
+                    text, tool_calls = parsers[index].feed(text)
+                    rest, more = parsers[index].flush()
+                    text, tool_calls = text + rest, tool_calls + more
+                for chunk in _delta_chunks(
+                    request, index, text, tool_calls=tool_calls, reasoning=thought
+                ):
+                    yield chunk
 
-            all_text += text
-            # Construct Response Body
-            assistant_message = GeneratedMessage(content=text)
-            choice = ChatCompletionChoice(
-                delta=assistant_message, finish_reason=finish_reason
+            # token counts come straight from the engine, no re-tokenization
+            result = await asyncio.wrap_future(future)
+            usage_info = UsageInfo.from_result(result)
+            # a timed out generation was cut short like at max_tokens
+            finish_reason = "length" if stop.reason == "timeout" else "stop"
+        except Exception:
+            finish_reason = "error"
+        finally:
+            outcome = {"stop": "success", "length": "timeout", "error": "error"}.get(
+                finish_reason, "cancelled"
             )
-            response = ChatCompletionResponse(model=request.model, choices=[choice])
-            yield format_sse(response.model_dump())
-        finish_reason = "stop"
-    except Exception as e:
-        print(e)
-        finish_reason = "error"
-    finally:
-        thread.join()
-
-        # Calculate usage
-        num_prompt_tokens = len(engine.apply_chat_template(conversation=messages))
-        num_completion_tokens = len(engine.tokenize(all_text))
-        usage_info = UsageInfo(
-            prompt_tokens=num_prompt_tokens,
-            completion_tokens=num_completion_tokens,
-            total_tokens=num_prompt_tokens + num_completion_tokens,
-        )
+            record_request("chat_completions", outcome, started)
+            for index in range(num_choices):
+                reason = finish_reason
+                if reason == "stop" and parsers is not None and parsers[index].calls:
+                    reason = "tool_calls"
+                elif reason == "stop" and result is not None:
+                    reason = result.finish_reason(index)
+                final_choice = ChatCompletionChoice(
+                    index=index,
+                    delta=GeneratedMessage(content=""),
+                    finish_reason=reason,
+                )
+                last = index == num_choices - 1
+                final_response = ChatCompletionResponse(
+                    model=request.model,
+                    choices=[final_choice],
+                    usage=usage_info if last and not options.include_usage else None,
+                )
+                yield format_sse(final_response.model_dump())
 
-        final_choice = ChatCompletionChoice(
-            delta=GeneratedMessage(content=""), finish_reason=finish_reason
-        )
-        final_response = ChatCompletionResponse(
-            model=request.model, choices=[final_choice], usage=usage_info
-        )
-        yield format_sse(final_response.model_dump())
+            if options.include_usage:
+                usage_response = ChatCompletionResponse(
+                    model=request.model, choices=[], usage=usage_info
+                )
+                yield format_sse(usage_response.model_dump())
 
-        yield "data: [DONE]\n\n"  # finish sse
+            yield "data: [DONE]\n\n"  # finish sse
 
 
 # Update main endpoint to inject engine
@@ -88,48 +235,136 @@ async def _stream_completion(request: ChatCompletionRequest, engine: InferenceEn
 )
 async def create_chat_completion(
     request: ChatCompletionRequest,
-    engine: InferenceEngine = Depends(get_inference_engine),  # Inject engine
+    raw_request: Request,
 ):
     """
     Endpoint for chat completions. Handles both streaming and non-streaming.
     """
+    if request.top_logprobs is not None and not request.logprobs:
+        raise HTTPException(
+            status_code=400, detail="top_logprobs requires logprobs to be true"
+        )
+    if request.logprobs and (request.num_beams or 1) > 1:
+        raise HTTPException(
+            status_code=400, detail="logprobs are not supported with beam search"
+        )
+    forced = request.tool_choice == "required" or isinstance(
+        request.tool_choice, NamedToolChoice
+    )
+    if forced and not request.tools:
+        raise HTTPException(status_code=400, detail="tool_choice requires tools")
+    if forced and request.response_format and request.response_format.constraint():
+        raise HTTPException(
+            status_code=400,
+            detail="response_format cannot be combined with a forced tool_choice",
+        )
+    engine = await get_engine_for_model(raw_request, request.model)
+    markers = engine.settings.model.tool_calls
+    reasoning = engine.settings.model.reasoning
+    if request.max_reasoning_tokens is not None:
+        if not reasoning.enabled:
+            raise HTTPException(
+                status_code=400,
+                detail="max_reasoning_tokens requires a model with reasoning enabled",
+            )
+        if (request.num_beams or 1) > 1:
+            raise HTTPException(
+                status_code=400,
+                detail="max_reasoning_tokens is not supported with beam search",
+            )
+    try:
+        constraint = _constraint(request, markers)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if constraint is not None and (request.num_beams or 1) > 1:
+        raise HTTPException(
+            status_code=400, detail="response_format is not supported with beam search"
+        )
+    if constraint is not None:
+        # an invalid schema fails here, before a stream sends its 200
+        try:
+            await engine.compile_constraint(constraint)
+        except InvalidConstraintError as e:
+            raise HTTPException(status_code=400, detail=str(e))
     if request.stream:
         return StreamingResponse(
-            _stream_completion(request, engine), media_type="text/event-stream"
+            _stream_completion(request, engine, constraint, raw_request),
+            media_type="text/event-stream",
         )
 
-    try:
-        gen_cfg = request.gen_config()
-        messages = [msg.model_dump(exclude_none=True) for msg in request.messages]
-        generated_response, num_prompt_tokens, num_completion_tokens = (
-            engine.generate_chat_completions(
-                conversation=messages, generation_config=gen_cfg
+    with track_request("chat_completions"):
+        try:
+            gen_cfg = request.gen_config()
+            messages = [msg.model_dump(exclude_none=True) for msg in request.messages]
+            tools = _tools(request)
+            stop = StopSignal()
+            result = await cancel_on_disconnect(
+                raw_request,
+                engine.submit_chat_completions(
+                    conversation=messages,
+                    generation_config=gen_cfg,
+                    speculative=request.speculative,
+                    logprobs=_num_top_logprobs(request),
+                    constraint=constraint,
+                    tools=tools,
+                    max_reasoning_tokens=request.max_reasoning_tokens,
+                    stop=stop,
+                ),
+                stop=stop,
+                timeout=engine.settings.server.request_timeout,
             )
-        )
 
-        # Construct Response Body
-        usage_info = UsageInfo(
-            prompt_tokens=num_prompt_tokens,
-            completion_tokens=num_completion_tokens,
-            total_tokens=num_prompt_tokens + num_completion_tokens,
-        )
-        assistant_message = GeneratedMessage(content=generated_response)
-        choice = ChatCompletionChoice(message=assistant_message, finish_reason="stop")
-        response = ChatCompletionResponse(
-            model=request.model, choices=[choice], usage=usage_info
-        )
-        return response
+            # Construct Response Body
+            usage_info = UsageInfo.from_result(result)
+            choices = []
+            for index, text in enumerate(result.texts):
+                thought = None
+                if reasoning.enabled:
+                    thought, text = split_reasoning(text, reasoning)
+                tool_calls = None
+                if tools:
+                    text, tool_calls = parse_tool_calls(
+                        text, markers.start, markers.end
+                    )
+                choices.append(
+                    ChatCompletionChoice(
+                        index=index,
+                        message=GeneratedMessage(
+                            content=(text.strip() or None) if tool_calls else text,
+                            reasoning_content=thought or None,
+                            tool_calls=tool_calls or None,
+                        ),
+                        logprobs=(
+                            ChoiceLogprobs.from_tokens(result.logprobs[index])
+                            if result.logprobs is not None
+                            else None
+                        ),
+                        finish_reason=(
+                            "tool_calls" if tool_calls else result.finish_reason(index)
+                        ),
+                    )
+                )
+            response = ChatCompletionResponse(
+                model=request.model, choices=choices, usage=usage_info
+            )
+            return response
 
-    except StopIteration:
-        raise HTTPException(
-            status_code=500,
-            detail="Internal Server Error: Generator yielded no response.",
-        )
-    except HTTPException as e:
-        # Re-raise HTTPExceptions directly
-        raise e
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Internal Server Error during chat generation: {str(e)}",
-        )
+        except StopIteration:
+            raise HTTPException(
+                status_code=500,
+                detail="Internal Server Error: Generator yielded no response.",
+            )
+        except (KVCacheTooLargeError, InvalidConstraintError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except EngineOverloadedError as e:
+            raise HTTPException(status_code=429, detail=str(e))
+        except EngineUnavailableError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except HTTPException as e:
+            # Re-raise HTTPExceptions directly
+            raise e
+        except Exception as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Internal Server Error during chat generation: {str(e)}",
+            )
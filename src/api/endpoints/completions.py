@@ -1,101 +1,228 @@
-from threading import Thread
+import time
+import asyncio
 from src.core.engine import InferenceEngine
+from src.core.kv_memory import KVCacheTooLargeError
+from src.core.constrained import InvalidConstraintError, OutputConstraint
+from src.core.outputs import GenerationResult
 from src.api.types.usage_info import UsageInfo
 from fastapi.responses import StreamingResponse
 from src.api.utils.format_sse import format_sse
-from fastapi import APIRouter, HTTPException, Depends
-from src.api.utils.dependencies import get_inference_engine
-from transformers.generation.streamers import TextIteratorStreamer
+from src.api.types.stream_options import StreamOptions
+from src.core.cancellation import StopSignal
+from src.api.utils.disconnect import cancel_on_disconnect, stop_on_disconnect
+from src.api.utils.request_metrics import record_request, track_request
+from src.api.utils.dependencies import get_engine_for_model
+from fastapi import APIRouter, HTTPException, Request
+from src.core.executor import EngineOverloadedError, EngineUnavailableError
+from src.api.utils.incremental_streamer import IncrementalStreamer, SSEChunkTemplate
 from src.api.types.completions import (
     CompletionChoice,
     CompletionRequest,
+    CompletionLogprobs,
     CompletionResponse,
 )
 
 router = APIRouter()
 
 
-async def _stream_completion(request: CompletionRequest, engine: InferenceEngine):
+def _constraint(request: CompletionRequest) -> OutputConstraint | None:
+    return request.response_format.constraint() if request.response_format else None
+
+
+def _choice_logprobs(
+    request: CompletionRequest, result: GenerationResult, index: int
+) -> CompletionLogprobs | None:
+    if result.logprobs is None:
+        return None
+    if request.echo:
+        tokens = (result.prompt_logprobs or []) + result.logprobs[index]
+        return CompletionLogprobs.from_tokens(tokens)
+    return CompletionLogprobs.from_tokens(result.logprobs[index], len(request.prompt))
+
+
+async def _stream_completion(
+    request: CompletionRequest, engine: InferenceEngine, raw_request: Request
+):
     # init_choice = CompletionChoice(text="\n\n")
     # init_response = CompletionResponse(model=request.model, choices=[init_choice])
     # yield format_sse(init_response.model_dump())
 
-    streamer = TextIteratorStreamer(
-        engine.tokenizer,  # type: ignore
+    started = time.perf_counter()
+    options = request.stream_options or StreamOptions()
+    streamer = IncrementalStreamer(
+        engine.tokenizer,
         skip_prompt=True,
         skip_special_tokens=True,
+        coalesce_tokens=options.coalesce_tokens,
+        coalesce_interval=options.coalesce_interval_ms / 1000,
     )
+    num_choices = request.num_return_sequences or 1
+    templates = [
+        SSEChunkTemplate(
+            CompletionResponse(
+                model=request.model,
+                choices=[
+                    CompletionChoice(text=SSEChunkTemplate.PLACEHOLDER, index=index)
+                ],
+            ).model_dump()
+        )
+        for index in range(num_choices)
+    ]
 
     gen_cfg = request.gen_config()
 
-    thread = Thread(
-        target=engine.generate_completions,
-        kwargs=dict(
-            prompt=request.prompt, generation_config=gen_cfg, streamer=streamer
-        ),
-    )
-    thread.start()
-
     finish_reason = None
+    usage_info = None
+    result: GenerationResult | None = None
 
-    try:
-        for text in streamer:
-            if not text:
-                continue
+    stop = StopSignal()
+    timeout = engine.settings.server.request_timeout
+    async with stop_on_disconnect(raw_request, stop, timeout=timeout):
+        try:
+            future = engine.stream_completions(
+                prompt=request.prompt,
+                streamer=streamer,
+                generation_config=gen_cfg,
+                speculative=request.speculative,
+                logprobs=request.logprobs,
+                echo=request.echo,
+                constraint=_constraint(request),
+                stop=stop,
+            )
+            # with logprobs the engine replays the scored prompt through the streamer
+            if request.echo and request.logprobs is None:
+                for index in range(num_choices):
+                    yield templates[index].render(request.prompt)
+            offsets = [0 if request.echo else len(request.prompt)] * num_choices
+            async for index, text, logprobs in streamer:
+                if logprobs is None:
+                    yield templates[index].render(text)
+                    continue
+                choice = CompletionChoice(
+                    text=text,
+                    index=index,
+                    logprobs=CompletionLogprobs.from_tokens(logprobs, offsets[index]),
+                )
+                offsets[index] += sum(len(token.token) for token in logprobs)
+                chunk = CompletionResponse(model=request.model, choices=[choice])
+                yield format_sse(chunk.model_dump())
 
-            # Construct Response Body
-            choice = CompletionChoice(text=text, finish_reason=finish_reason)
-            response = CompletionResponse(model=request.model, choices=[choice])
-            yield format_sse(response.model_dump())
-        finish_reason = "stop"
-    except Exception:
-        finish_reason = "error"
-    finally:
-        thread.join()
-        final_choice = CompletionChoice(text="", finish_reason=finish_reason)
-        final_response = CompletionResponse(model=request.model, choices=[final_choice])
-        yield format_sse(final_response.model_dump())
+            result = await asyncio.wrap_future(future)
+            usage_info = UsageInfo.from_result(result)
+            # a timed out generation was cut short like at max_tokens
+            finish_reason = "length" if stop.reason == "timeout" else "stop"
+        except Exception:
+            finish_reason = "error"
+        finally:
+            outcome = {"stop": "success", "length": "timeout", "error": "error"}.get(
+                finish_reason, "cancelled"
+            )
+            record_request("completions", outcome, started)
+            for index in range(num_choices):
+                reason = finish_reason
+                if reason == "stop" and result is not None:
+                    reason = result.finish_reason(index)
+                final_choice = CompletionChoice(
+                    text="", index=index, finish_reason=reason
+                )
+                final_response = CompletionResponse(
+                    model=request.model, choices=[final_choice]
+                )
+                yield format_sse(final_response.model_dump())
 
-        yield "data: [DONE]\n\n"  # finish sse
+            if options.include_usage:
+                usage_response = CompletionResponse(
+                    model=request.model, choices=[], usage=usage_info
+                )
+                yield format_sse(usage_response.model_dump())
+
+            yield "data: [DONE]\n\n"  # finish sse
 
 
 # Update main endpoint to inject engine
 @router.post("/v1/completions", response_model=CompletionResponse)
 async def create_completion(
     request: CompletionRequest,
-    engine: InferenceEngine = Depends(get_inference_engine),  # Inject engine
+    raw_request: Request,
 ):
     """
     Endpoint for text completions. Handles both streaming and non-streaming.
     """
+    num_choices = request.num_return_sequences or 1
+    if request.best_of is not None and request.best_of < num_choices:
+        raise HTTPException(status_code=400, detail="best_of must be >= n")
+    if request.stream and request.best_of is not None and request.best_of > num_choices:
+        raise HTTPException(
+            status_code=400, detail="best_of > n is not supported with streaming"
+        )
+    if request.logprobs is not None and (request.num_beams or 1) > 1:
+        raise HTTPException(
+            status_code=400, detail="logprobs are not supported with beam search"
+        )
+    if _constraint(request) is not None and (request.num_beams or 1) > 1:
+        raise HTTPException(
+            status_code=400, detail="response_format is not supported with beam search"
+        )
+    engine = await get_engine_for_model(raw_request, request.model)
+    constraint = _constraint(request)
+    if constraint is not None:
+        # an invalid schema fails here, before a stream sends its 200
+        try:
+            await engine.compile_constraint(constraint)
+        except InvalidConstraintError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
     if request.stream:
         return StreamingResponse(
-            _stream_completion(request, engine), media_type="text/event-stream"
+            _stream_completion(request, engine, raw_request),
+            media_type="text/event-stream",
         )
-    try:
-        # Use the injected engine instance
-        gen_cfg = request.gen_config()
-        generated_response, num_prompt_tokens, num_completion_tokens = (
-            engine.generate_completions(
-                prompt=request.prompt, generation_config=gen_cfg
+    with track_request("completions"):
+        try:
+            # Use the injected engine instance
+            gen_cfg = request.gen_config()
+            stop = StopSignal()
+            result = await cancel_on_disconnect(
+                raw_request,
+                engine.submit_completions(
+                    prompt=request.prompt,
+                    generation_config=gen_cfg,
+                    best_of=request.best_of,
+                    speculative=request.speculative,
+                    logprobs=request.logprobs,
+                    echo=request.echo,
+                    constraint=constraint,
+                    stop=stop,
+                ),
+                stop=stop,
+                timeout=engine.settings.server.request_timeout,
             )
-        )
 
-        # Construct Response Body
-        usage_info = UsageInfo(
-            prompt_tokens=num_prompt_tokens,
-            completion_tokens=num_completion_tokens,
-            total_tokens=num_prompt_tokens + num_completion_tokens,
-        )
-        choice = CompletionChoice(text=generated_response, finish_reason="stop")
-        response = CompletionResponse(
-            model=request.model, choices=[choice], usage=usage_info
-        )
-        return response
+            # Construct Response Body
+            usage_info = UsageInfo.from_result(result)
+            choices = [
+                CompletionChoice(
+                    text=request.prompt + text if request.echo else text,
+                    index=index,
+                    logprobs=_choice_logprobs(request, result, index),
+                    finish_reason=result.finish_reason(index),
+                )
+                for index, text in enumerate(result.texts)
+            ]
+            response = CompletionResponse(
+                model=request.model, choices=choices, usage=usage_info
+            )
+            return response
 
-    except HTTPException as e:
-        raise e
-    except Exception as e:
-        raise HTTPException(
-            status_code=500, detail=f"Internal Server Error during generation. {e}"
-        )
+        except (KVCacheTooLargeError, InvalidConstraintError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except EngineOverloadedError as e:
+            raise HTTPException(status_code=429, detail=str(e))
+        except EngineUnavailableError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except HTTPException as e:
+            raise e
+        except Exception as e:
+            raise HTTPException(
+                status_code=500, detail=f"Internal Server Error during generation. {e}"
+            )
@@ -0,0 +1,63 @@
+import base64
+import numpy as np
+from src.api.utils.request_metrics import track_request
+from src.api.utils.disconnect import cancel_on_disconnect
+from src.api.utils.dependencies import get_engine_for_model
+from fastapi import APIRouter, HTTPException, Request
+from src.core.executor import EngineOverloadedError, EngineUnavailableError
+from src.api.types.embeddings import (
+    EmbeddingData,
+    EmbeddingUsage,
+    EmbeddingRequest,
+    EmbeddingResponse,
+)
+
+router = APIRouter()
+
+
+def _encode_vectors(
+    vectors: np.ndarray, encoding_format: str
+) -> list[list[float]] | list[str]:
+    if encoding_format == "base64":
+        # rows of the contiguous float32 array are encoded from its buffer, no copy
+        return [base64.b64encode(row).decode("ascii") for row in vectors]
+    return vectors.tolist()
+
+
+@router.post("/v1/embeddings", response_model=EmbeddingResponse)
+async def create_embeddings(request: EmbeddingRequest, raw_request: Request):
+    """Embeds the input texts or token ID lists, one vector each."""
+    inputs = request.inputs()
+    if not inputs or any(len(item) == 0 for item in inputs):
+        raise HTTPException(status_code=400, detail="Input must not be empty")
+    engine = await get_engine_for_model(raw_request, request.model)
+
+    with track_request("embeddings"):
+        try:
+            result = await cancel_on_disconnect(
+                raw_request,
+                engine.submit_embeddings(inputs=inputs, pooling=request.pooling),
+            )
+            vectors = _encode_vectors(result.embeddings, request.encoding_format)
+            return EmbeddingResponse(
+                data=[
+                    EmbeddingData(index=index, embedding=vector)
+                    for index, vector in enumerate(vectors)
+                ],
+                model=request.model,
+                usage=EmbeddingUsage(
+                    prompt_tokens=result.num_prompt_tokens,
+                    total_tokens=result.num_prompt_tokens,
+                ),
+            )
+
+        except EngineOverloadedError as e:
+            raise HTTPException(status_code=429, detail=str(e))
+        except EngineUnavailableError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except HTTPException as e:
+            raise e
+        except Exception as e:
+            raise HTTPException(
+                status_code=500, detail=f"Internal Server Error during embedding. {e}"
+            )
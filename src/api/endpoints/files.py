@@ -0,0 +1,57 @@
+import asyncio
+from fastapi.responses import FileResponse
+from src.api.utils.batch_runner import BatchRunner
+from src.api.utils.dependencies import get_batch_runner
+from src.api.types.files import FileDeleted, FileList, FileObject
+from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
+
+router = APIRouter()
+
+
+@router.post("/v1/files", response_model=FileObject)
+async def upload_file(
+    file: UploadFile = File(...),
+    purpose: str = Form(...),
+    runner: BatchRunner = Depends(get_batch_runner),
+):
+    """Uploads a file, e.g. the JSONL input of a batch (`purpose` "batch")."""
+    return await asyncio.to_thread(
+        runner.store.save_upload, file.file, file.filename or "upload.jsonl", purpose
+    )
+
+
+@router.get("/v1/files", response_model=FileList)
+async def list_files(
+    purpose: str | None = None, runner: BatchRunner = Depends(get_batch_runner)
+):
+    return FileList(data=runner.store.list_files(purpose))
+
+
+@router.get("/v1/files/{file_id}", response_model=FileObject)
+async def retrieve_file(file_id: str, runner: BatchRunner = Depends(get_batch_runner)):
+    file_object = runner.store.get_file(file_id)
+    if file_object is None:
+        raise HTTPException(status_code=404, detail=f"No such file: {file_id}")
+    return file_object
+
+
+@router.get("/v1/files/{file_id}/content")
+async def retrieve_file_content(
+    file_id: str, runner: BatchRunner = Depends(get_batch_runner)
+):
+    """Streams the file from disk."""
+    file_object = runner.store.get_file(file_id)
+    if file_object is None:
+        raise HTTPException(status_code=404, detail=f"No such file: {file_id}")
+    return FileResponse(
+        runner.store.file_path(file_id),
+        media_type="application/jsonl",
+        filename=file_object.filename,
+    )
+
+
+@router.delete("/v1/files/{file_id}", response_model=FileDeleted)
+async def delete_file(file_id: str, runner: BatchRunner = Depends(get_batch_runner)):
+    if not runner.store.delete_file(file_id):
+        raise HTTPException(status_code=404, detail=f"No such file: {file_id}")
+    return FileDeleted(id=file_id)
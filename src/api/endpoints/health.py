@@ -1,14 +1,27 @@
 from fastapi import APIRouter, Request
+from src.core.workers import DataParallelEngine
 
 router = APIRouter()
 
 
 @router.get("/health")
 async def health_check(request: Request):
-    """Basic health check endpoint, checks engine status."""
-    engine_status = (
-        "available"
-        if hasattr(request.app.state, "engine") and request.app.state.engine is not None
-        else "unavailable"
-    )
-    return {"status": "ok", "engine_status": engine_status}
+    """Basic health check endpoint, checks engine and worker status."""
+    registry = getattr(request.app.state, "registry", None)
+    resident = registry.resident() if registry is not None else {}
+    response = {
+        "status": "ok",
+        "engine_status": "available" if resident else "unavailable",
+    }
+    workers = {
+        name: engine.executor.status()
+        for name, engine in resident.items()
+        if isinstance(engine, DataParallelEngine)
+    }
+    if workers:
+        response["workers"] = workers
+        if any(
+            not worker["alive"] for statuses in workers.values() for worker in statuses
+        ):
+            response["engine_status"] = "degraded"
+    return response
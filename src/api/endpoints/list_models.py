@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends
-from src.core.engine import InferenceEngine
+from src.core.registry import ModelRegistry
 from src.api.types.model_list import ModelCard, ModelList
-from src.api.utils.dependencies import get_inference_engine
+from src.api.utils.dependencies import get_model_registry
 
 router = APIRouter()
 
@@ -9,18 +9,15 @@ router = APIRouter()
 @router.get("/models", response_model=ModelList)
 @router.get("/v1/models", response_model=ModelList)
 async def list_models(
-    engine: InferenceEngine = Depends(get_inference_engine),
-):  # Inject engine
+    registry: ModelRegistry = Depends(get_model_registry),
+):  # Inject registry
     """
     Endpoint to list available models.
     Mimics https://platform.openai.com/docs/api-reference/models/list
+    `status` tells whether a model is resident, offloaded or unloaded.
     """
-    assert isinstance(
-        engine.settings.server.served_model_names, list
-    ), "Model names must be a list"
     model_cards = [
-        ModelCard(id=model_name)
-        # Use the injected engine instance
-        for model_name in engine.settings.server.served_model_names
+        ModelCard(id=model_name, status=status)
+        for model_name, status in registry.status().items()
     ]
     return ModelList(data=model_cards)
@@ -0,0 +1,64 @@
+from src.core import metrics
+from src.core.engine import InferenceEngine
+from src.core.registry import ModelRegistry
+from src.core.buckets import compiled_graphs
+from fastapi.responses import PlainTextResponse
+from fastapi import APIRouter, HTTPException, Depends
+from src.api.utils.dependencies import get_model_registry
+
+router = APIRouter()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _refresh_engine_gauges(model: str, engine: InferenceEngine) -> None:
+    metrics.QUEUE_DEPTH.set(engine.executor.queue_depth, model=model)
+    metrics.OUTSTANDING.set(engine.executor.outstanding, model=model)
+    if engine.kv_memory is not None:
+        metrics.KV_RESERVED_BYTES.set(engine.kv_memory.reserved, model=model)
+    recompiles = engine.recompiles()
+    if recompiles is not None:
+        metrics.RECOMPILES.set(recompiles, model=model)
+    caches = {
+        "prefix": engine.prefix_cache,
+        "template": engine.template_cache,
+        "response": engine.response_cache,
+        "grammar": engine.grammar_cache,
+    }
+    for name, cache in caches.items():
+        if cache is None:
+            continue
+        stats = cache.stats()
+        metrics.CACHE_HITS.set(stats["hits"], model=model, cache=name)
+        metrics.CACHE_MISSES.set(stats["misses"], model=model, cache=name)
+
+
+async def _worker_snapshots(registry: ModelRegistry) -> list[dict]:
+    """Registries of data parallel workers, where their engines record metrics."""
+    snapshots = []
+    for engine in registry.resident().values():
+        snapshots.extend(await engine.metrics_snapshots())
+    return snapshots
+
+
+def _refresh_gauges(registry: ModelRegistry) -> None:
+    """Gauges are read from the engines at scrape time instead of on every change."""
+    resident = registry.resident()
+    metrics.RESIDENT_MODELS.set(len(resident))
+    graphs = compiled_graphs()
+    if graphs is not None:
+        metrics.COMPILED_GRAPHS.set(graphs)
+    for model, engine in resident.items():
+        _refresh_engine_gauges(model, engine)
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(registry: ModelRegistry = Depends(get_model_registry)):
+    """Prometheus metrics in the text exposition format."""
+    if not metrics.REGISTRY.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    _refresh_gauges(registry)
+    snapshots = await _worker_snapshots(registry)
+    return PlainTextResponse(
+        metrics.REGISTRY.render(snapshots), media_type=CONTENT_TYPE
+    )
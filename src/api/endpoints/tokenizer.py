@@ -1,6 +1,9 @@
-from src.core.engine import InferenceEngine
-from fastapi import APIRouter, HTTPException, Depends
-from src.api.utils.dependencies import get_inference_engine
+import base64
+import asyncio
+import binascii
+import numpy as np
+from fastapi import APIRouter, HTTPException, Request
+from src.api.utils.dependencies import get_engine_for_model
 from src.api.types.tokenize import (
     TokenizeRequest,
     TokenizeResponse,
@@ -10,36 +13,87 @@ from src.api.types.tokenize import (
 
 router = APIRouter()
 
+# little-endian int32, token IDs of every vocabulary in use fit
+TOKEN_DTYPE = "<i4"
+
+
+def _pack(token_ids: list[int]) -> str:
+    return base64.b64encode(np.asarray(token_ids, dtype=TOKEN_DTYPE)).decode("ascii")
+
+
+def _unpack(data: str) -> list[int]:
+    try:
+        return np.frombuffer(base64.b64decode(data), dtype=TOKEN_DTYPE).tolist()
+    except (binascii.Error, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid packed tokens: {e}")
+
 
 @router.post("/tokenize", response_model=TokenizeResponse)
 @router.post("/v1/tokenize", response_model=TokenizeResponse)
 async def tokenize(
     request: TokenizeRequest,
-    engine: InferenceEngine = Depends(get_inference_engine),  # Inject engine
+    raw_request: Request,
 ):
-    """Tokenizes the given text using the loaded model's tokenizer."""
+    """
+    Tokenizes prompts or chat conversations using the model's tokenizer.
+
+    Lists are encoded in one batch call off the event loop.
+    """
+    engine = await get_engine_for_model(raw_request, request.model)
     try:
-        # Use the injected engine instance
-        result = engine.tokenize(request.prompt)
-        return TokenizeResponse(tokens=result, count=len(result))
+        if request.messages is not None:
+            conversations = request.messages if request.is_batch else [request.messages]
+            token_lists = await asyncio.to_thread(
+                engine.tokenize_conversations,
+                [
+                    [message.model_dump(exclude_none=True) for message in messages]
+                    for messages in conversations  # type: ignore
+                ],
+                request.add_generation_prompt,
+            )
+        else:
+            prompts = request.prompt if request.is_batch else [request.prompt]
+            token_lists = await asyncio.to_thread(
+                engine.tokenize_batch, prompts, request.add_special_tokens
+            )
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Internal Server Error during tokenization. {e}"
         )
 
+    counts = [len(token_ids) for token_ids in token_lists]
+    tokens = (
+        [_pack(token_ids) for token_ids in token_lists]
+        if request.encoding_format == "base64"
+        else token_lists
+    )
+    if not request.is_batch:
+        return TokenizeResponse(tokens=tokens[0], count=counts[0])
+    return TokenizeResponse(tokens=tokens, count=sum(counts), counts=counts)
+
 
 @router.post("/detokenize", response_model=DetokenizeResponse)
 @router.post("/v1/detokenize", response_model=DetokenizeResponse)
 async def detokenize(
     request: DetokenizeRequest,
-    engine: InferenceEngine = Depends(get_inference_engine),  # Inject engine
+    raw_request: Request,
 ):
-    """Detokenizes the given list of token IDs."""
+    """Detokenizes token ID lists, plain or base64 packed, in one batch call."""
+    engine = await get_engine_for_model(raw_request, request.model)
+    single = isinstance(request.tokens, str) or (
+        not request.tokens or isinstance(request.tokens[0], int)
+    )
+    items = [request.tokens] if single else request.tokens
+    token_lists = [
+        _unpack(item) if isinstance(item, str) else item
+        for item in items  # type: ignore
+    ]
     try:
-        # Use the injected engine instance
-        result = engine.detokenize(request.tokens)
-        return DetokenizeResponse(prompt=result)
+        texts = await asyncio.to_thread(
+            engine.detokenize_batch, token_lists, request.skip_special_tokens
+        )
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Internal Server Error during detokenization. {e}"
         )
+    return DetokenizeResponse(prompt=texts[0] if single else texts)
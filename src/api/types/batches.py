@@ -0,0 +1,57 @@
+import time
+from pydantic import BaseModel, Field
+
+BATCH_ENDPOINTS = ("/v1/completions", "/v1/chat/completions")
+# statuses a batch never leaves
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchRequest(BaseModel):
+    input_file_id: str
+    endpoint: str
+    completion_window: str = "24h"
+    metadata: dict[str, str] | None = None
+
+
+class BatchError(BaseModel):
+    code: str
+    message: str
+    line: int | None = None
+
+
+class BatchErrors(BaseModel):
+    object: str = "list"
+    data: list[BatchError] = []
+
+
+class BatchRequestCounts(BaseModel):
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+
+
+class BatchObject(BaseModel):
+    id: str
+    object: str = "batch"
+    endpoint: str
+    errors: BatchErrors | None = None
+    input_file_id: str
+    completion_window: str
+    # validating, in_progress, finalizing, completed, failed, cancelling, cancelled
+    status: str = "validating"
+    output_file_id: str | None = None
+    error_file_id: str | None = None
+    created_at: int = Field(default_factory=lambda: int(time.time()))
+    in_progress_at: int | None = None
+    finalizing_at: int | None = None
+    completed_at: int | None = None
+    failed_at: int | None = None
+    cancelling_at: int | None = None
+    cancelled_at: int | None = None
+    request_counts: BatchRequestCounts = Field(default_factory=BatchRequestCounts)
+    metadata: dict[str, str] | None = None
+
+
+class BatchList(BaseModel):
+    object: str = "list"
+    data: list[BatchObject] = []
@@ -1,36 +1,111 @@
 import time
+from typing import Literal
 from pydantic import BaseModel, Field
+from src.core.outputs import TokenLogprob
 from src.api.types.samplers import Samplers
 from src.api.types.usage_info import UsageInfo
+from src.api.types.stream_options import StreamOptions
+from src.api.types.response_format import ResponseFormat
+from src.api.types.tool_call import (
+    ToolCall,
+    ToolDefinition,
+    NamedToolChoice,
+    ToolCallRequest,
+)
 from transformers.generation.configuration_utils import GenerationConfig
 
 
 class Message(BaseModel):
     role: str
-    content: str | list[dict[str, str]]
+    # None on assistant messages that only call tools
+    content: str | list[dict[str, str]] | None = None
+    tool_calls: list[ToolCallRequest] | None = None
+    # the call a "tool" message answers
+    tool_call_id: str | None = None
+    name: str | None = None
 
 
 class GeneratedMessage(BaseModel):
     role: str = "assistant"
-    content: str
+    content: str | None
     reasoning_content: str | None = None
+    tool_calls: list[ToolCall] | None = None
 
 
 class ChatCompletionRequest(Samplers):
     model: str | None = None
     messages: list[Message]
     stream: bool = False
+    stream_options: StreamOptions | None = None
+    logprobs: bool = False
+    # Number of top alternatives returned with each token's logprob
+    top_logprobs: int | None = Field(None, ge=0, le=20)
+    response_format: ResponseFormat | None = None
+    tools: list[ToolDefinition] | None = None
+    tool_choice: Literal["none", "auto", "required"] | NamedToolChoice | None = None
+    # Tokens the model may think for before its answer is started
+    max_reasoning_tokens: int | None = Field(None, ge=0)
 
     def gen_config(self):
-        exclude = set(["stream", "model", "messages"])
+        exclude = set(
+            [
+                "stream",
+                "stream_options",
+                "speculative",
+                "logprobs",
+                "top_logprobs",
+                "response_format",
+                "tools",
+                "tool_choice",
+                "max_reasoning_tokens",
+                "model",
+                "messages",
+            ]
+        )
         return GenerationConfig(**self.model_dump(exclude=exclude, exclude_none=True))
 
 
+class TopLogprob(BaseModel):
+    token: str
+    logprob: float
+    bytes: list[int] | None = None
+
+    @classmethod
+    def from_token(cls, token: TokenLogprob) -> "TopLogprob":
+        return cls(
+            token=token.token,
+            logprob=token.logprob,  # type: ignore
+            bytes=list(token.token.encode("utf-8")),
+        )
+
+
+class ChatTokenLogprob(TopLogprob):
+    top_logprobs: list[TopLogprob] = Field(default_factory=list)
+
+
+class ChoiceLogprobs(BaseModel):
+    content: list[ChatTokenLogprob] | None = None
+
+    @classmethod
+    def from_tokens(cls, tokens: list[TokenLogprob]) -> "ChoiceLogprobs":
+        return cls(
+            content=[
+                ChatTokenLogprob(
+                    **TopLogprob.from_token(token).model_dump(),
+                    top_logprobs=[
+                        TopLogprob.from_token(top) for top in token.top_logprobs
+                    ],
+                )
+                for token in tokens
+            ]
+        )
+
+
 class ChatCompletionChoice(BaseModel):
     index: int = 0
     message: GeneratedMessage | None = None
     delta: GeneratedMessage | None = None
-    logprobs: str | None = None
+    logprobs: ChoiceLogprobs | None = None
     finish_reason: str | None = None
 
 
@@ -1,7 +1,10 @@
 import time
 from pydantic import BaseModel, Field
+from src.core.outputs import TokenLogprob
 from src.api.types.samplers import Samplers
 from src.api.types.usage_info import UsageInfo
+from src.api.types.stream_options import StreamOptions
+from src.api.types.response_format import ResponseFormat
 from transformers.generation.configuration_utils import GenerationConfig
 
 
@@ -9,16 +12,60 @@ class CompletionRequest(Samplers):
     model: str | None = None
     prompt: str
     stream: bool = False
+    stream_options: StreamOptions | None = None
+    best_of: int | None = None
+    # Number of top alternatives returned with each token's logprob
+    logprobs: int | None = Field(None, ge=0, le=20)
+    # Prepend the prompt to the text, and its logprobs with `logprobs`
+    echo: bool = False
+    # Restricts the completion to a JSON schema or regex, not the echoed prompt
+    response_format: ResponseFormat | None = None
 
     def gen_config(self):
-        exclude = set(["stream", "model", "prompt"])
+        exclude = set(
+            [
+                "stream",
+                "stream_options",
+                "speculative",
+                "best_of",
+                "logprobs",
+                "echo",
+                "response_format",
+                "model",
+                "prompt",
+            ]
+        )
         return GenerationConfig(**self.model_dump(exclude=exclude, exclude_none=True))
 
 
+class CompletionLogprobs(BaseModel):
+    tokens: list[str] = Field(default_factory=list)
+    token_logprobs: list[float | None] = Field(default_factory=list)
+    top_logprobs: list[dict[str, float] | None] = Field(default_factory=list)
+    text_offset: list[int] = Field(default_factory=list)
+
+    @classmethod
+    def from_tokens(
+        cls, tokens: list[TokenLogprob], offset: int = 0
+    ) -> "CompletionLogprobs":
+        """Legacy completions layout, offsets count from `offset` in the text."""
+        logprobs = cls()
+        for token in tokens:
+            logprobs.tokens.append(token.token)
+            logprobs.token_logprobs.append(token.logprob)
+            top_logprobs = {top.token: top.logprob for top in token.top_logprobs}
+            logprobs.top_logprobs.append(
+                top_logprobs if token.logprob is not None else None  # type: ignore
+            )
+            logprobs.text_offset.append(offset)
+            offset += len(token.token)
+        return logprobs
+
+
 class CompletionChoice(BaseModel):
     text: str
     index: int = 0
-    logprobs: str | None = None
+    logprobs: CompletionLogprobs | None = None
     finish_reason: str | None = None  # None for stream chunks until final
 
 
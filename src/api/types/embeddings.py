@@ -0,0 +1,38 @@
+from typing import Literal
+from pydantic import BaseModel, Field
+
+
+class EmbeddingRequest(BaseModel):
+    model: str | None = None
+    # A text, a token ID list, or an array of either
+    input: str | list[str] | list[int] | list[list[int]]
+    encoding_format: Literal["float", "base64"] = "float"
+    # Overrides `embeddings.pooling` of the config
+    pooling: Literal["mean", "last"] | None = None
+    user: str | None = None
+
+    def inputs(self) -> list[str] | list[list[int]]:
+        if isinstance(self.input, str):
+            return [self.input]
+        if self.input and isinstance(self.input[0], int):
+            return [self.input]  # type: ignore
+        return self.input  # type: ignore
+
+
+class EmbeddingData(BaseModel):
+    object: str = "embedding"
+    index: int
+    # Floats, or base64 of the little-endian float32 bytes
+    embedding: list[float] | str
+
+
+class EmbeddingUsage(BaseModel):
+    prompt_tokens: int
+    total_tokens: int
+
+
+class EmbeddingResponse(BaseModel):
+    object: str = "list"
+    data: list[EmbeddingData] = Field(default_factory=list)
+    model: str | None = None
+    usage: EmbeddingUsage
@@ -0,0 +1,22 @@
+import time
+from pydantic import BaseModel, Field
+
+
+class FileObject(BaseModel):
+    id: str
+    object: str = "file"
+    bytes: int
+    created_at: int = Field(default_factory=lambda: int(time.time()))
+    filename: str
+    purpose: str  # "batch" for batch inputs, "batch_output" for results
+
+
+class FileList(BaseModel):
+    object: str = "list"
+    data: list[FileObject] = []
+
+
+class FileDeleted(BaseModel):
+    id: str
+    object: str = "file"
+    deleted: bool = True
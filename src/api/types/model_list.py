@@ -7,6 +7,7 @@ class ModelCard(BaseModel):
     object: str = "model"
     created: int = Field(default_factory=lambda: int(time.time()))
     owned_by: str = "transAPI"
+    status: str | None = None  # "resident", "offloaded" or "unloaded"
 
 
 class ModelList(BaseModel):
@@ -0,0 +1,35 @@
+from typing import Literal
+from pydantic import BaseModel, Field, model_validator
+from src.core.constrained import OutputConstraint
+
+
+class JsonSchemaFormat(BaseModel):
+    name: str | None = None
+    description: str | None = None
+    json_schema: dict = Field(default_factory=dict, alias="schema")
+    strict: bool | None = None
+
+
+class ResponseFormat(BaseModel):
+    type: Literal["text", "json_object", "json_schema", "regex"] = "text"
+    json_schema: JsonSchemaFormat | None = None
+    # Pattern the whole output has to match, with `type: "regex"`
+    regex: str | None = None
+
+    @model_validator(mode="after")
+    def check_spec(self) -> "ResponseFormat":
+        if self.type == "json_schema" and self.json_schema is None:
+            raise ValueError('response_format of type "json_schema" needs json_schema')
+        if self.type == "regex" and not self.regex:
+            raise ValueError('response_format of type "regex" needs regex')
+        return self
+
+    def constraint(self) -> OutputConstraint | None:
+        """What the engine restricts the output to, None for plain text."""
+        if self.type == "json_schema" and self.json_schema is not None:
+            return OutputConstraint("json_schema", self.json_schema.json_schema)
+        if self.type == "regex":
+            return OutputConstraint("regex", self.regex)
+        if self.type == "json_object":
+            return OutputConstraint("json_object")
+        return None
@@ -8,12 +8,19 @@ class Samplers(BaseModel):
     max_new_tokens: int | None = Field(None, alias="max_completion_tokens")
     stop_strings: str | list[str] | None = Field(None, alias="stop")
     num_beams: int | None = None
+    num_return_sequences: int | None = Field(None, alias="n")
     num_beam_groups: int | None = None
     temperature: float | None = None
     top_p: float | None = None
     top_k: int | None = None
     repetition_penalty: float | None = None
+    prompt_lookup_num_tokens: int | None = None
+    num_assistant_tokens: int | None = None
+    # None follows the server settings, False disables speculative decoding
+    speculative: bool | None = None
 
     def gen_config(self):
-        exclude = set(["stream", "model", "messages", "prompt"])
+        exclude = set(
+            ["stream", "stream_options", "speculative", "model", "messages", "prompt"]
+        )
         return GenerationConfig(**self.model_dump(exclude=exclude, exclude_none=True))
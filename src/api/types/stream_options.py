@@ -0,0 +1,10 @@
+from pydantic import BaseModel
+
+
+class StreamOptions(BaseModel):
+    # Send a final chunk with empty choices carrying the usage of the request
+    include_usage: bool = False
+    # Send a chunk once this many tokens are pending
+    coalesce_tokens: int = 1
+    # Or once this many milliseconds passed since the last chunk, 0 disables
+    coalesce_interval_ms: float = 0.0
@@ -1,20 +1,47 @@
-from pydantic import BaseModel
+from typing import Literal
+from pydantic import BaseModel, model_validator
+from src.api.types.chat_completions import Message
 
 
 class TokenizeRequest(BaseModel):
     model: str | None = None
-    prompt: str
+    # One prompt or a list of prompts
+    prompt: str | list[str] | None = None
+    # One conversation or a list of them, tokenized after chat templating
+    messages: list[Message] | list[list[Message]] | None = None
+    add_special_tokens: bool = True
+    add_generation_prompt: bool = True
+    # "base64" packs each token list as little-endian int32,
+    # e.g. numpy.frombuffer(base64.b64decode(tokens), dtype="<i4")
+    encoding_format: Literal["json", "base64"] = "json"
+
+    @model_validator(mode="after")
+    def check_input(self) -> "TokenizeRequest":
+        if (self.prompt is None) == (self.messages is None):
+            raise ValueError("Exactly one of 'prompt' and 'messages' is required")
+        return self
+
+    @property
+    def is_batch(self) -> bool:
+        if self.messages is not None:
+            return bool(self.messages) and isinstance(self.messages[0], list)
+        return isinstance(self.prompt, list)
 
 
 class TokenizeResponse(BaseModel):
-    tokens: list[int]
+    # One entry per input for list inputs, base64 strings with "base64"
+    tokens: list[int] | list[list[int]] | str | list[str]
+    # Total over all inputs
     count: int
+    counts: list[int] | None = None  # Only for list inputs
 
 
 class DetokenizeRequest(BaseModel):
     model: str | None = None
-    tokens: list[int]
+    # Token IDs or a list of them, either may be base64 packed int32
+    tokens: list[int] | list[list[int]] | str | list[str]
+    skip_special_tokens: bool = False
 
 
 class DetokenizeResponse(BaseModel):
-    prompt: str
+    prompt: str | list[str]
@@ -1,12 +1,27 @@
-from pydantic import BaseModel, Field
+import json
+from typing import Any
+from pydantic import BaseModel, Field, field_validator
 
 
 class Function(BaseModel):
     name: str = Field(default_factory=str)
     arguments: dict = Field(default_factory=dict)
 
+    @field_validator("arguments", mode="before")
+    @classmethod
+    def parse_arguments(cls, value: Any) -> Any:
+        # clients send the arguments they got back as a JSON string, templates
+        # expect a mapping
+        if isinstance(value, str):
+            try:
+                return json.loads(value) if value.strip() else {}
+            except json.JSONDecodeError:
+                return {"arguments": value}
+        return value
+
 
 class ToolCallRequest(BaseModel):
+    id: str | None = None
     type: str = Field("function")
     function: Function = Field(default_factory=Function)
 
@@ -15,3 +30,38 @@ class ToolResponse(BaseModel):
     role: str = Field("tool")
     name: str = Field(default_factory=str)
     content: str = Field(default_factory=str)
+
+
+class FunctionDefinition(BaseModel):
+    name: str
+    description: str | None = None
+    # JSON schema of the arguments
+    parameters: dict = Field(default_factory=dict)
+
+
+class ToolDefinition(BaseModel):
+    type: str = "function"
+    function: FunctionDefinition
+
+
+class FunctionName(BaseModel):
+    name: str
+
+
+class NamedToolChoice(BaseModel):
+    type: str = "function"
+    function: FunctionName
+
+
+class FunctionCall(BaseModel):
+    name: str | None = None
+    # JSON text, streamed in pieces
+    arguments: str | None = None
+
+
+class ToolCall(BaseModel):
+    # position among the calls of a choice, set on stream deltas only
+    index: int | None = None
+    id: str | None = None
+    type: str | None = None
+    function: FunctionCall = Field(default_factory=FunctionCall)
@@ -1,7 +1,40 @@
 from pydantic import BaseModel
+from src.core.outputs import GenerationResult
+
+
+class SpeculativeUsage(BaseModel):
+    mode: str
+    acceptance_rate: float | None = None
+    accepted_tokens: int | None = None
+    draft_tokens: int | None = None
+    target_steps: int
+    tokens_per_second: float
 
 
 class UsageInfo(BaseModel):
     prompt_tokens: int
     completion_tokens: int | None = None  # Optional for streaming chunks
     total_tokens: int
+    speculative: SpeculativeUsage | None = None  # Only for speculative decoding
+
+    @classmethod
+    def from_result(cls, result: GenerationResult) -> "UsageInfo":
+        stats = result.stats
+        speculative = None
+        if stats.speculative_mode is not None:
+            speculative = SpeculativeUsage(
+                mode=stats.speculative_mode,
+                acceptance_rate=stats.acceptance_rate(result.num_completion_tokens),
+                accepted_tokens=stats.accepted_tokens(result.num_completion_tokens),
+                draft_tokens=stats.draft_tokens,
+                target_steps=stats.target_steps,
+                tokens_per_second=stats.tokens_per_second(
+                    result.num_completion_tokens
+                ),
+            )
+        return cls(
+            prompt_tokens=result.num_prompt_tokens,
+            completion_tokens=result.num_completion_tokens,
+            total_tokens=result.num_prompt_tokens + result.num_completion_tokens,
+            speculative=speculative,
+        )
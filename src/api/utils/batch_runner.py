@@ -0,0 +1,395 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from pydantic import BaseModel
+from config.settings import AppSettings
+from src.core.outputs import GenerationResult
+from src.api.types.usage_info import UsageInfo
+from src.api.utils.file_store import FileStore
+from src.core.registry import ModelNotFoundError, ModelRegistry
+from src.api.types.completions import (
+    CompletionChoice,
+    CompletionRequest,
+    CompletionResponse,
+)
+from src.api.types.chat_completions import (
+    GeneratedMessage,
+    ChatCompletionChoice,
+    ChatCompletionRequest,
+    ChatCompletionResponse,
+)
+from src.api.types.batches import (
+    FINAL_STATUSES,
+    BatchError,
+    BatchErrors,
+    BatchObject,
+)
+
+REQUEST_TYPES: dict[str, type[CompletionRequest] | type[ChatCompletionRequest]] = {
+    "/v1/completions": CompletionRequest,
+    "/v1/chat/completions": ChatCompletionRequest,
+}
+# request fields the online endpoints honour, `generate_batch` only takes the
+# prompt and generation config
+UNSUPPORTED_FIELDS = (
+    "response_format",
+    "tools",
+    "tool_choice",
+    "logprobs",
+    "top_logprobs",
+    "echo",
+    "best_of",
+    "max_reasoning_tokens",
+)
+
+
+def _read_chunk(path: str, offset: int, size: int) -> tuple[list[str], int]:
+    """Up to `size` non-empty lines from byte `offset`, and the offset after them."""
+    lines = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while len(lines) < size:
+            line = f.readline()
+            if not line:
+                break
+            if line.strip():
+                lines.append(line.decode("utf-8"))
+        return lines, f.tell()
+
+
+def _count_lines(path: str) -> int:
+    with open(path, "rb") as f:
+        return sum(1 for line in f if line.strip())
+
+
+def _append_at(path: str, offset: int, lines: list[dict]) -> int:
+    """
+    Writes `lines` as JSONL from byte `offset`, dropping anything after it.
+
+    Output beyond the last checkpoint belongs to a chunk that is run again.
+    """
+    with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+        f.truncate(offset)
+        f.seek(offset)
+        for line in lines:
+            f.write(json.dumps(line, ensure_ascii=False).encode("utf-8") + b"\n")
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+def _unsupported_fields(request: BaseModel) -> list[str]:
+    """The `UNSUPPORTED_FIELDS` set on `request` to something that has an effect."""
+    names = []
+    for name in UNSUPPORTED_FIELDS:
+        value = getattr(request, name, None)
+        if value is None or value is False:
+            continue
+        if name == "response_format" and value.constraint() is None:
+            continue
+        if name in ("tools", "tool_choice") and (
+            not getattr(request, "tools", None)
+            or getattr(request, "tool_choice", None) == "none"
+        ):
+            continue
+        if name == "best_of" and value <= (request.num_return_sequences or 1):
+            continue
+        names.append(name)
+    return names
+
+
+def _output_line(custom_id: str | None, body: BaseModel) -> dict:
+    return {
+        "id": f"batch_req_{uuid.uuid4().hex}",
+        "custom_id": custom_id,
+        "response": {
+            "status_code": 200,
+            "request_id": uuid.uuid4().hex,
+            "body": body.model_dump(),
+        },
+        "error": None,
+    }
+
+
+def _error_line(custom_id: str | None, code: str, message: str) -> dict:
+    return {
+        "id": f"batch_req_{uuid.uuid4().hex}",
+        "custom_id": custom_id,
+        "response": None,
+        "error": {"code": code, "message": message},
+    }
+
+
+class BatchRunner:
+    """
+    Runs batch jobs one after another on a background task.
+
+    The input file is read `batch_jobs.chunk_size` lines at a time, never as a
+    whole. The requests of a chunk are grouped by model and handed to the
+    engine's `generate_batch`, which sorts them by length into large padded
+    batches and yields to online traffic between them. Results are appended to
+    the output and error files after every chunk, together with a checkpoint of
+    the input offset and output sizes, so after a restart a job resumes at its
+    last finished chunk.
+    """
+
+    def __init__(
+        self,
+        registry: ModelRegistry,
+        store: FileStore,
+        settings: AppSettings,
+        logger: logging.Logger,
+    ) -> None:
+        self.registry = registry
+        self.store = store
+        self.settings = settings
+        self.logger = logger
+        self._queue: asyncio.Queue[str] = asyncio.Queue()
+        self._cancelled: set[str] = set()
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Starts the runner, unfinished jobs of an earlier run are queued first."""
+        for batch in sorted(self.store.list_batches(), key=lambda b: b.created_at):
+            if batch.status not in FINAL_STATUSES:
+                self.logger.info(f"Resuming batch {batch.id} ({batch.status})")
+                self._queue.put_nowait(batch.id)
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def submit(self, batch: BatchObject) -> None:
+        self.store.save_batch(batch)
+        self._queue.put_nowait(batch.id)
+
+    def cancel(self, batch: BatchObject) -> BatchObject:
+        """Stops the job after its current chunk, finished results are kept."""
+        if batch.status in FINAL_STATUSES or batch.status == "cancelling":
+            return batch
+        self._cancelled.add(batch.id)
+        batch.status = "cancelling"
+        batch.cancelling_at = int(time.time())
+        self.store.save_batch(batch)
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch_id = await self._queue.get()
+            batch = self.store.get_batch(batch_id)
+            if batch is None or batch.status in FINAL_STATUSES:
+                continue
+            try:
+                await self._process(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error(f"Batch {batch_id} failed: {e}", exc_info=True)
+                self._fail(batch, "internal_error", str(e))
+
+    def _save(self, batch: BatchObject) -> None:
+        # a cancel request that arrived meanwhile wins over the runner's copy
+        if batch.id in self._cancelled and batch.status not in FINAL_STATUSES:
+            batch.status = "cancelling"
+        self.store.save_batch(batch)
+
+    def _fail(self, batch: BatchObject, code: str, message: str) -> None:
+        batch.status = "failed"
+        batch.failed_at = int(time.time())
+        batch.errors = BatchErrors(data=[BatchError(code=code, message=message)])
+        self.store.save_batch(batch)
+
+    async def _process(self, batch: BatchObject) -> None:
+        if batch.status == "cancelling" or batch.id in self._cancelled:
+            batch.status = "cancelled"
+            batch.cancelled_at = int(time.time())
+            self.store.save_batch(batch)
+            return
+        input_path = self.store.file_path(batch.input_file_id)
+        if self.store.get_file(batch.input_file_id) is None:
+            self._fail(batch, "file_not_found", "The input file was deleted")
+            return
+
+        checkpoint = self.store.load_checkpoint(batch.id)
+        if checkpoint is None:
+            batch.request_counts.total = await asyncio.to_thread(
+                _count_lines, input_path
+            )
+            checkpoint = {
+                "input_offset": 0,
+                "line": 0,
+                "output_file_id": self.store.new_id("file"),
+                "output_offset": 0,
+                "error_file_id": self.store.new_id("file"),
+                "error_offset": 0,
+                "completed": 0,
+                "failed": 0,
+            }
+            self.store.save_checkpoint(batch.id, checkpoint)
+            batch.status = "in_progress"
+            batch.in_progress_at = int(time.time())
+            self._save(batch)
+        output_path = self.store.file_path(checkpoint["output_file_id"])
+        error_path = self.store.file_path(checkpoint["error_file_id"])
+
+        chunk_size = max(self.settings.batch_jobs.chunk_size, 1)
+        while batch.id not in self._cancelled:
+            lines, next_offset = await asyncio.to_thread(
+                _read_chunk, input_path, checkpoint["input_offset"], chunk_size
+            )
+            if not lines:
+                break
+            outputs, errors = await self._run_chunk(
+                batch.endpoint, lines, checkpoint["line"]
+            )
+            checkpoint["output_offset"] = await asyncio.to_thread(
+                _append_at, output_path, checkpoint["output_offset"], outputs
+            )
+            checkpoint["error_offset"] = await asyncio.to_thread(
+                _append_at, error_path, checkpoint["error_offset"], errors
+            )
+            checkpoint["input_offset"] = next_offset
+            checkpoint["line"] += len(lines)
+            checkpoint["completed"] += len(outputs)
+            checkpoint["failed"] += len(errors)
+            self.store.save_checkpoint(batch.id, checkpoint)
+
+            # the checkpoint is the source of truth, counts follow it
+            batch.request_counts.completed = checkpoint["completed"]
+            batch.request_counts.failed = checkpoint["failed"]
+            self._save(batch)
+            self.logger.info(
+                f"Batch {batch.id}: {checkpoint['line']}/"
+                f"{batch.request_counts.total} requests done"
+            )
+
+        batch.finalizing_at = int(time.time())
+        if checkpoint["output_offset"] > 0:
+            self.store.register_file(
+                checkpoint["output_file_id"], f"{batch.id}_output.jsonl", "batch_output"
+            )
+            batch.output_file_id = checkpoint["output_file_id"]
+        if checkpoint["error_offset"] > 0:
+            self.store.register_file(
+                checkpoint["error_file_id"], f"{batch.id}_error.jsonl", "batch_output"
+            )
+            batch.error_file_id = checkpoint["error_file_id"]
+        if batch.id in self._cancelled:
+            self._cancelled.discard(batch.id)
+            batch.status = "cancelled"
+            batch.cancelled_at = int(time.time())
+        else:
+            batch.status = "completed"
+            batch.completed_at = int(time.time())
+        self.store.save_batch(batch)
+
+    async def _run_chunk(
+        self, endpoint: str, lines: list[str], first_line: int
+    ) -> tuple[list[dict], list[dict]]:
+        outputs: list[dict] = []
+        errors: list[dict] = []
+        request_type = REQUEST_TYPES[endpoint]
+        by_model: dict[str | None, list[tuple[str | None, BaseModel]]] = {}
+        for number, line in enumerate(lines, start=first_line + 1):
+            custom_id = None
+            try:
+                item = json.loads(line)
+                custom_id = item.get("custom_id")
+                if item.get("url") != endpoint:
+                    raise ValueError(f"url must be {endpoint}, got {item.get('url')}")
+                request = request_type.model_validate(item.get("body") or {})
+                unsupported = _unsupported_fields(request)
+                if unsupported:
+                    raise ValueError(
+                        f"Not supported in batch jobs: {', '.join(unsupported)}"
+                    )
+            except ValueError as e:
+                # JSON and validation errors are ValueErrors too
+                message = f"Line {number}: {e}"
+                errors.append(_error_line(custom_id, "invalid_request", message))
+                continue
+            by_model.setdefault(request.model, []).append((custom_id, request))
+
+        for model, items in by_model.items():
+            # a failing model fails its own requests, not the rest of the batch
+            try:
+                results = await self._generate(model, items)
+            except ModelNotFoundError:
+                message = f"The model '{model}' does not exist"
+                errors.extend(
+                    _error_line(custom_id, "model_not_found", message)
+                    for custom_id, _ in items
+                )
+                continue
+            except Exception as e:
+                self.logger.error(
+                    f"Batch requests for model '{model}' failed: {e}", exc_info=True
+                )
+                errors.extend(
+                    _error_line(custom_id, "server_error", str(e))
+                    for custom_id, _ in items
+                )
+                continue
+            for (custom_id, request), result in zip(items, results):
+                if isinstance(result, Exception):
+                    errors.append(_error_line(custom_id, "server_error", str(result)))
+                else:
+                    outputs.append(
+                        _output_line(custom_id, self._response(request, result))
+                    )
+        return outputs, errors
+
+    async def _generate(
+        self, model: str | None, items: list[tuple[str | None, BaseModel]]
+    ) -> list[GenerationResult | Exception]:
+        prompts, configs = [], []
+        for _, request in items:
+            if isinstance(request, ChatCompletionRequest):
+                prompts.append(
+                    [msg.model_dump(exclude_none=True) for msg in request.messages]
+                )
+            else:
+                prompts.append(request.prompt)  # type: ignore
+            configs.append(request.gen_config())  # type: ignore
+        engine = await self.registry.get(model)
+        # leased, so the model is not evicted while the chunk runs
+        try:
+            return await asyncio.to_thread(engine.generate_batch, prompts, configs)
+        finally:
+            self.registry.release(model)
+
+    @staticmethod
+    def _response(request: BaseModel, result: GenerationResult) -> BaseModel:
+        usage_info = UsageInfo.from_result(result)
+        if isinstance(request, ChatCompletionRequest):
+            return ChatCompletionResponse(
+                model=request.model,
+                choices=[
+                    ChatCompletionChoice(
+                        index=index,
+                        message=GeneratedMessage(content=text),
+                        finish_reason=result.finish_reason(index),
+                    )
+                    for index, text in enumerate(result.texts)
+                ],
+                usage=usage_info,
+            )
+        return CompletionResponse(
+            model=request.model,  # type: ignore
+            choices=[
+                CompletionChoice(
+                    text=text, index=index, finish_reason=result.finish_reason(index)
+                )
+                for index, text in enumerate(result.texts)
+            ],
+            usage=usage_info,
+        )
@@ -1,24 +1,66 @@
 import logging
 from src.core.engine import InferenceEngine
+from src.api.utils.leases import hold_lease
+from src.api.utils.batch_runner import BatchRunner
 from fastapi import Request, HTTPException, status
+from src.core.registry import ModelNotFoundError, ModelRegistry
 
 logger = logging.getLogger(" TransAPI ")
 
 
-def get_inference_engine(request: Request) -> InferenceEngine:
+def get_model_registry(request: Request) -> ModelRegistry:
     """
-    Dependency function to get the InferenceEngine instance.
+    Dependency function to get the ModelRegistry instance.
 
-    Relies on the engine being initialized during application startup
-    and stored in request.app.state.engine.
+    Relies on the registry being initialized during application startup
+    and stored in request.app.state.registry.
     """
-    if not hasattr(request.app.state, "engine") or request.app.state.engine is None:
+    if not hasattr(request.app.state, "registry") or request.app.state.registry is None:
         # This should ideally not happen if lifespan management is correct
-        logger.error(
-            "Inference engine dependency requested but not found in app state."
-        )
+        logger.error("Model registry dependency requested but not found in app state.")
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="Inference engine is not available or not yet initialized.",
         )
-    return request.app.state.engine
+    return request.app.state.registry
+
+
+async def get_engine_for_model(request: Request, model: str | None) -> InferenceEngine:
+    """
+    Returns the engine serving `model`, loading it on first use.
+
+    The engine is leased until the response is sent, so it is not evicted in
+    between.
+    """
+    registry = get_model_registry(request)
+    try:
+        engine = await registry.get(model)
+    except ModelNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"The model '{model}' does not exist",
+        )
+    except Exception as e:
+        logger.error(f"Failed to load model '{model}': {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Model '{model}' could not be loaded: {e}",
+        )
+    hold_lease(request, lambda: registry.release(model))
+    return engine
+
+
+async def get_inference_engine(request: Request) -> InferenceEngine:
+    """Dependency function to get the engine of the default model."""
+    return await get_engine_for_model(request, None)
+
+
+def get_batch_runner(request: Request) -> BatchRunner:
+    """Dependency function to get the BatchRunner of `/v1/files` and `/v1/batches`."""
+    runner = getattr(request.app.state, "batch_runner", None)
+    if runner is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Batch jobs are not available or not yet initialized.",
+        )
+    return runner
@@ -0,0 +1,87 @@
+import asyncio
+from typing import Any, Awaitable
+from fastapi import Request, HTTPException
+from contextlib import asynccontextmanager
+from src.core.cancellation import StopSignal
+
+# nginx's "client closed request", the client will never see it
+CLIENT_CLOSED_REQUEST = 499
+GATEWAY_TIMEOUT = 504
+
+
+async def _wait_for_disconnect(request: Request, interval: float) -> None:
+    while not await request.is_disconnected():
+        await asyncio.sleep(interval)
+
+
+async def cancel_on_disconnect(
+    request: Request,
+    awaitable: Awaitable[Any],
+    interval: float = 0.5,
+    stop: StopSignal | None = None,
+    timeout: float | None = None,
+) -> Any:
+    """
+    Awaits `awaitable`, cancelling it if the client goes away first.
+
+    Raises HTTPException(499) when the client disconnected, and (504) when
+    `timeout` seconds passed first. Either way `stop` is set, so generation
+    that already started ends as well.
+    """
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(_wait_for_disconnect(request, interval))
+    try:
+        await asyncio.wait(
+            {task, watcher}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+    except asyncio.CancelledError:
+        if stop is not None:
+            stop.set("disconnect")
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+
+    if not task.done():
+        timed_out = not watcher.done()
+        if stop is not None:
+            stop.set("timeout" if timed_out else "disconnect")
+        task.cancel()
+        if timed_out:
+            raise HTTPException(status_code=GATEWAY_TIMEOUT, detail="Request timed out")
+        raise HTTPException(
+            status_code=CLIENT_CLOSED_REQUEST, detail="Client disconnected"
+        )
+    return task.result()
+
+
+@asynccontextmanager
+async def stop_on_disconnect(
+    request: Request,
+    stop: StopSignal,
+    interval: float = 0.5,
+    timeout: float | None = None,
+):
+    """
+    Sets `stop` when the client goes away or `timeout` seconds passed.
+
+    For streamed responses: leaving the block early, e.g. because the response
+    was closed, counts as a disconnect as well.
+    """
+    watcher = asyncio.ensure_future(_wait_for_disconnect(request, interval))
+    watcher.add_done_callback(
+        lambda task: task.cancelled() or stop.set("disconnect")
+    )
+    timer = None
+    if timeout is not None:
+        timer = asyncio.get_running_loop().call_later(timeout, stop.set, "timeout")
+    completed = False
+    try:
+        yield
+        completed = True
+    finally:
+        watcher.cancel()
+        if timer is not None:
+            timer.cancel()
+        if not completed:
+            stop.set("disconnect")
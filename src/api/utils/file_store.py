@@ -0,0 +1,134 @@
+import os
+import json
+import uuid
+import shutil
+import threading
+from typing import BinaryIO
+from src.api.types.files import FileObject
+from src.api.types.batches import BatchObject
+
+
+class FileStore:
+    """
+    Uploaded files, batch records and batch checkpoints on local disk.
+
+    Every file is stored next to a JSON record of its metadata. Records are
+    written to a temporary file and moved into place, so a crash never leaves
+    half a record behind.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.files_dir = os.path.join(root, "files")
+        self.batches_dir = os.path.join(root, "batches")
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_id(prefix: str) -> str:
+        return f"{prefix}-{uuid.uuid4().hex}"
+
+    @staticmethod
+    def _write_json(path: str, data: dict) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read_json(path: str) -> dict | None:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _records(self, directory: str, suffix: str) -> list[dict]:
+        if not os.path.isdir(directory):
+            return []
+        records = []
+        for name in os.listdir(directory):
+            if name.endswith(suffix):
+                record = self._read_json(os.path.join(directory, name))
+                if record is not None:
+                    records.append(record)
+        return records
+
+    # --- files ---
+
+    def file_path(self, file_id: str) -> str:
+        return os.path.join(self.files_dir, f"{os.path.basename(file_id)}.jsonl")
+
+    def _file_record_path(self, file_id: str) -> str:
+        return os.path.join(self.files_dir, f"{os.path.basename(file_id)}.json")
+
+    def save_upload(self, source: BinaryIO, filename: str, purpose: str) -> FileObject:
+        """Copies `source` to the store in chunks, it is never read whole."""
+        file_id = self.new_id("file")
+        path = self.file_path(file_id)
+        os.makedirs(self.files_dir, exist_ok=True)
+        with open(f"{path}.tmp", "wb") as f:
+            shutil.copyfileobj(source, f, length=1024 * 1024)
+        os.replace(f"{path}.tmp", path)
+        return self.register_file(file_id, filename, purpose)
+
+    def register_file(self, file_id: str, filename: str, purpose: str) -> FileObject:
+        """Records a file already written to `file_path(file_id)`."""
+        file_object = FileObject(
+            id=file_id,
+            bytes=os.path.getsize(self.file_path(file_id)),
+            filename=filename,
+            purpose=purpose,
+        )
+        self._write_json(self._file_record_path(file_id), file_object.model_dump())
+        return file_object
+
+    def get_file(self, file_id: str) -> FileObject | None:
+        record = self._read_json(self._file_record_path(file_id))
+        return FileObject(**record) if record is not None else None
+
+    def list_files(self, purpose: str | None = None) -> list[FileObject]:
+        files = [
+            FileObject(**record) for record in self._records(self.files_dir, ".json")
+        ]
+        if purpose is not None:
+            files = [file for file in files if file.purpose == purpose]
+        return sorted(files, key=lambda file: file.created_at, reverse=True)
+
+    def delete_file(self, file_id: str) -> bool:
+        with self._lock:
+            if self.get_file(file_id) is None:
+                return False
+            os.remove(self._file_record_path(file_id))
+            if os.path.exists(self.file_path(file_id)):
+                os.remove(self.file_path(file_id))
+        return True
+
+    # --- batches ---
+
+    def _batch_path(self, batch_id: str) -> str:
+        return os.path.join(self.batches_dir, f"{os.path.basename(batch_id)}.json")
+
+    def _checkpoint_path(self, batch_id: str) -> str:
+        return os.path.join(
+            self.batches_dir, f"{os.path.basename(batch_id)}.checkpoint"
+        )
+
+    def save_batch(self, batch: BatchObject) -> None:
+        self._write_json(self._batch_path(batch.id), batch.model_dump())
+
+    def get_batch(self, batch_id: str) -> BatchObject | None:
+        record = self._read_json(self._batch_path(batch_id))
+        return BatchObject(**record) if record is not None else None
+
+    def list_batches(self) -> list[BatchObject]:
+        batches = [
+            BatchObject(**record) for record in self._records(self.batches_dir, ".json")
+        ]
+        return sorted(batches, key=lambda batch: batch.created_at, reverse=True)
+
+    def save_checkpoint(self, batch_id: str, checkpoint: dict) -> None:
+        self._write_json(self._checkpoint_path(batch_id), checkpoint)
+
+    def load_checkpoint(self, batch_id: str) -> dict | None:
+        return self._read_json(self._checkpoint_path(batch_id))
@@ -0,0 +1,169 @@
+import json
+import time
+import asyncio
+from src.core.outputs import TokenLogprob
+from src.api.utils.format_sse import format_sse
+from transformers.generation.streamers import BaseStreamer
+from transformers.tokenization_utils_base import PreTrainedTokenizerBase
+
+
+class _DecodeState:
+    """Incremental detokenization state of one generated sequence."""
+
+    def __init__(self) -> None:
+        self.token_ids: list[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.pending_text = ""
+        self.pending_tokens = 0
+        self.pending_logprobs: list[TokenLogprob] = []
+
+
+class IncrementalStreamer(BaseStreamer):
+    """
+    Streamer that detokenizes incrementally and hands text to an asyncio consumer.
+
+    Only a small window of recent tokens is decoded per step: text decoded from
+    `prefix_offset` to `read_offset` is already sent, so the new text is what
+    decoding up to the last token adds on top of it. Pending tokens are flushed
+    as one chunk once `coalesce_tokens` are pending or `coalesce_interval`
+    seconds have passed since the last chunk.
+
+    Several sequences (`n` > 1) are tracked side by side, iteration yields
+    `(index, text, logprobs)` triples. `logprobs` lists the entries handed to
+    `put_logprobs` for the tokens of the chunk, or is None without them. `put`
+    and `end` are called from the generation thread, the streamer is consumed
+    with `async for` on the event loop that created it.
+    """
+
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizerBase,
+        skip_prompt: bool = True,
+        skip_special_tokens: bool = True,
+        coalesce_tokens: int = 1,
+        coalesce_interval: float = 0.0,
+    ) -> None:
+        self.tokenizer = tokenizer
+        self.skip_prompt = skip_prompt
+        self.skip_special_tokens = skip_special_tokens
+        self.coalesce_tokens = max(coalesce_tokens, 1)
+        self.coalesce_interval = coalesce_interval
+
+        self.states: list[_DecodeState] = []
+        self._next_tokens_are_prompt = True
+        self._last_flush = time.monotonic()
+
+        self._loop = asyncio.get_running_loop()
+        self._queue: asyncio.Queue[
+            tuple[int, str, list[TokenLogprob] | None] | None
+        ] = asyncio.Queue()
+
+    def _decode(self, token_ids: list[int]) -> str:
+        return self.tokenizer.decode(
+            token_ids, skip_special_tokens=self.skip_special_tokens
+        )
+
+    def _push(self, item: tuple[int, str, list[TokenLogprob] | None] | None) -> None:
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        except RuntimeError:
+            # the event loop is gone, nobody is listening anymore
+            pass
+
+    def put_logprobs(self, rows: list[list[TokenLogprob]]) -> None:
+        """Entries of the tokens the next `put` brings, one list per sequence."""
+        while len(self.states) < len(rows):
+            self.states.append(_DecodeState())
+        for state, entries in zip(self.states, rows):
+            state.pending_logprobs.extend(entries)
+
+    def put(self, value) -> None:
+        if self.skip_prompt and self._next_tokens_are_prompt:
+            self._next_tokens_are_prompt = False
+            return
+        self._next_tokens_are_prompt = False
+
+        # (batch,) carries one new token per sequence, (batch, k) carries k tokens
+        rows = value.tolist()
+        if value.dim() == 1:
+            rows = [[token] for token in rows]
+        while len(self.states) < len(rows):
+            self.states.append(_DecodeState())
+
+        for state, token_ids in zip(self.states, rows):
+            state.token_ids.extend(token_ids)
+            state.pending_tokens += len(token_ids)
+            self._advance(state, final=False)
+
+        interval_elapsed = (
+            self.coalesce_interval > 0
+            and time.monotonic() - self._last_flush >= self.coalesce_interval
+        )
+        for index, state in enumerate(self.states):
+            if state.pending_text and (
+                state.pending_tokens >= self.coalesce_tokens or interval_elapsed
+            ):
+                self._flush(index, state)
+
+    def _advance(self, state: _DecodeState, final: bool) -> None:
+        if state.read_offset >= len(state.token_ids):
+            return
+        prefix_text = self._decode(
+            state.token_ids[state.prefix_offset : state.read_offset]
+        )
+        new_text = self._decode(state.token_ids[state.prefix_offset :])
+        # an incomplete multi-byte character decodes to U+FFFD, wait for more tokens
+        if len(new_text) > len(prefix_text) and (
+            final or not new_text.endswith("\ufffd")
+        ):
+            state.pending_text += new_text[len(prefix_text) :]
+            state.prefix_offset = state.read_offset
+            state.read_offset = len(state.token_ids)
+
+    def _flush(self, index: int, state: _DecodeState) -> None:
+        self._push((index, state.pending_text, state.pending_logprobs or None))
+        state.pending_text = ""
+        state.pending_tokens = 0
+        state.pending_logprobs = []
+        self._last_flush = time.monotonic()
+
+    def end(self) -> None:
+        for index, state in enumerate(self.states):
+            self._advance(state, final=True)
+            # e.g. a skipped special token still carries its logprob
+            if state.pending_text or state.pending_logprobs:
+                self._flush(index, state)
+        self._push(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> tuple[int, str, list[TokenLogprob] | None]:
+        item = await self._queue.get()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+
+class SSEChunkTemplate:
+    """
+    Pre-rendered SSE event with a single string slot.
+
+    The response body is serialized once with `PLACEHOLDER` in place of the
+    streamed text, so each chunk only costs one `json.dumps` of the text itself.
+    """
+
+    PLACEHOLDER = "__TRANSAPI_CHUNK__"
+
+    def __init__(self, data: dict) -> None:
+        event = format_sse(data)
+        placeholder = json.dumps(self.PLACEHOLDER)
+        prefix, found, suffix = event.partition(placeholder)
+        if not found:
+            raise ValueError("Chunk template data does not contain PLACEHOLDER")
+        self.prefix = prefix.encode()
+        self.suffix = suffix.encode()
+
+    def render(self, text: str) -> bytes:
+        return self.prefix + json.dumps(text).encode() + self.suffix
@@ -0,0 +1,39 @@
+from typing import Callable
+from fastapi import Request
+
+# key of the request state list `ReleaseEngineLeases` empties
+LEASES_KEY = "engine_leases"
+
+
+class ReleaseEngineLeases:
+    """
+    ASGI middleware ending the registry leases a request took on engines.
+
+    It runs once the response is fully sent, streamed bodies included, which a
+    `BaseHTTPMiddleware` or the exit code of a dependency does not guarantee.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        leases: list[Callable[[], None]] = []
+        scope.setdefault("state", {})[LEASES_KEY] = leases
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            for release in leases:
+                release()
+
+
+def hold_lease(request: Request, release: Callable[[], None]) -> None:
+    """Calls `release` once `request` is answered."""
+    leases = request.scope.get("state", {}).get(LEASES_KEY)
+    if leases is None:
+        # without the middleware the engine is only pinned while it is busy
+        release()
+        return
+    leases.append(release)
@@ -0,0 +1,73 @@
+from config.settings import ReasoningSettings
+from src.api.utils.tool_parser import partial_marker_length
+
+
+class ReasoningSplitter:
+    """
+    Routes streamed text to reasoning or content at the think tags in one pass.
+
+    Thinking opens with the start tag at the very beginning of the output,
+    leading whitespace aside, or right away with `starts_thinking` when the
+    chat template opened it in the prompt. It closes at the end tag, and from
+    there on text is passed through as content without being scanned again.
+    Only a tail that may begin a tag is held back.
+    """
+
+    def __init__(self, settings: ReasoningSettings) -> None:
+        self.start = settings.start
+        self.end = settings.end
+        self._mode = "thinking" if settings.starts_thinking else "opening"
+        self._pending = ""
+        # whitespace between a tag and the text of the next phase is dropped
+        self._strip = True
+
+    def feed(self, text: str) -> tuple[str, str]:
+        """Reasoning and content in `text`, which follows the last feed."""
+        data = self._pending + text
+        self._pending = ""
+        reasoning = ""
+        if self._mode == "opening":
+            stripped = data.lstrip()
+            if not stripped or (
+                self.start.startswith(stripped) and stripped != self.start
+            ):
+                self._pending = data
+                return "", ""
+            if stripped.startswith(self.start):
+                data = stripped[len(self.start) :]
+                self._mode = "thinking"
+            else:
+                self._mode = "content"
+                self._strip = False
+        if self._mode == "thinking":
+            if self._strip:
+                data = data.lstrip()
+                self._strip = not data
+            position = data.find(self.end)
+            if position < 0:
+                keep = partial_marker_length(data, self.end)
+                self._pending = data[len(data) - keep :]
+                return data[: len(data) - keep], ""
+            reasoning = data[:position]
+            data = data[position + len(self.end) :]
+            self._mode = "content"
+            self._strip = True
+        if self._strip:
+            data = data.lstrip()
+            self._strip = not data
+        return reasoning, data
+
+    def flush(self) -> tuple[str, str]:
+        """Text held back once generation ended."""
+        pending, self._pending = self._pending, ""
+        if self._mode == "thinking":
+            return pending, ""
+        return "", pending
+
+
+def split_reasoning(text: str, settings: ReasoningSettings) -> tuple[str, str]:
+    """Reasoning and content of a whole completion."""
+    splitter = ReasoningSplitter(settings)
+    reasoning, content = splitter.feed(text)
+    rest_reasoning, rest_content = splitter.flush()
+    return reasoning + rest_reasoning, content + rest_content
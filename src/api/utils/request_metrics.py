@@ -0,0 +1,32 @@
+import time
+from src.core import metrics
+from fastapi import HTTPException
+from contextlib import contextmanager
+from src.api.utils.disconnect import CLIENT_CLOSED_REQUEST, GATEWAY_TIMEOUT
+
+_OUTCOMES = {
+    429: "rejected",
+    503: "rejected",
+    CLIENT_CLOSED_REQUEST: "cancelled",
+    GATEWAY_TIMEOUT: "timeout",
+}
+
+
+def record_request(endpoint: str, outcome: str, started: float) -> None:
+    metrics.REQUESTS.inc(endpoint=endpoint, outcome=outcome)
+    metrics.REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint)
+
+
+@contextmanager
+def track_request(endpoint: str):
+    """Counts a non-streaming request by outcome and records its latency."""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "success"
+    except HTTPException as e:
+        outcome = _OUTCOMES.get(e.status_code, "error")
+        raise
+    finally:
+        record_request(endpoint, outcome, started)
@@ -0,0 +1,299 @@
+import re
+import json
+import uuid
+from src.core.constrained import OutputConstraint
+from src.core.json_schema import schema_to_regex
+from src.api.types.tool_call import FunctionCall, ToolCall, ToolDefinition
+
+# opening of a call up to the arguments value, `{"name": "...", "arguments": `
+_CALL_HEAD = re.compile(
+    r'\s*\{\s*"name"\s*:\s*"((?:[^"\\]|\\.)*)"\s*,\s*"arguments"\s*:\s*'
+)
+# a head not matched within this many characters is parsed once the call ends
+MAX_HEAD_CHARS = 1024
+
+
+def partial_marker_length(text: str, marker: str) -> int:
+    """Length of the longest end of `text` that `marker` starts with."""
+    for size in range(min(len(marker) - 1, len(text)), 0, -1):
+        if marker.startswith(text[-size:]):
+            return size
+    return 0
+
+
+def _new_call_id() -> str:
+    return f"call_{uuid.uuid4().hex[:24]}"
+
+
+class ToolCallParser:
+    """
+    Splits streamed text into content and tool calls in one pass.
+
+    A call is a JSON object of `name` and `arguments` between the `start` and
+    `end` markers, e.g. `<tool_call>{"name": ..., "arguments": {...}}</tool_call>`.
+    Text outside the markers is content; only a tail that may begin a marker is
+    held back. Inside a call, the first delta carries the id and name once the
+    head is complete. The arguments then stream as they arrive, ended by a
+    bracket and string tracking scan. Arguments given as a JSON string are held
+    back up to its closing quote and sent decoded, the way a whole call parses.
+    Calls in another layout are buffered up to their end marker and parsed whole.
+
+    Every character is scanned once, apart from the bounded held back tails and
+    call head, so the cost is linear in the generated length.
+    """
+
+    def __init__(self, start: str, end: str) -> None:
+        self.start = start
+        self.end = end
+        # number of calls seen so far, the index of the next one
+        self.calls = 0
+        self._mode = "text"
+        self._pending = ""
+        self._buffer: list[str] = []
+        self._depth = 0
+        self._started = False
+        # the arguments value is a JSON string rather than an object
+        self._string_value = False
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text: str) -> tuple[str, list[ToolCall]]:
+        """Content and tool call deltas in `text`, which follows the last feed."""
+        content: list[str] = []
+        deltas: list[ToolCall] = []
+        data = self._pending + text
+        self._pending = ""
+        while data:
+            if self._mode == "text":
+                data = self._text(data, content)
+            elif self._mode == "head":
+                data = self._head(data, deltas)
+            elif self._mode == "arguments":
+                data = self._arguments(data, deltas)
+            elif self._mode == "tail":
+                data = self._tail(data)
+            else:
+                data = self._buffered(data, content, deltas)
+        return "".join(content), deltas
+
+    def flush(self) -> tuple[str, list[ToolCall]]:
+        """What is held back once generation ended, e.g. a call missing its end."""
+        pending, self._pending = self._pending, ""
+        if self._mode == "text":
+            return pending, []
+        if self._mode in ("head", "buffered"):
+            text = "".join(self._buffer) + pending
+            self._buffer = []
+            self._mode = "text"
+            call = self._complete_call(text)
+            if call is None:
+                return self.start + text, []
+            return "", [call]
+        # a call whose end marker never came
+        deltas = []
+        if self._mode == "arguments" and self._string_value and self._buffer:
+            arguments = FunctionCall(arguments="".join(self._buffer).strip())
+            deltas.append(ToolCall(index=self.calls, function=arguments))
+        self._buffer = []
+        self._mode = "text"
+        self.calls += 1
+        return "", deltas
+
+    def _text(self, data: str, content: list[str]) -> str:
+        position = data.find(self.start)
+        if position < 0:
+            keep = partial_marker_length(data, self.start)
+            content.append(data[: len(data) - keep])
+            self._pending = data[len(data) - keep :]
+            return ""
+        content.append(data[:position])
+        self._mode = "head"
+        self._buffer = []
+        return data[position + len(self.start) :]
+
+    def _head(self, data: str, deltas: list[ToolCall]) -> str:
+        self._buffer.append(data)
+        head = "".join(self._buffer)
+        match = _CALL_HEAD.match(head)
+        if match is None:
+            if self.end in head or len(head) > MAX_HEAD_CHARS:
+                self._buffer = []
+                self._mode = "buffered"
+                return head
+            self._buffer = [head]
+            return ""
+        try:
+            name = json.loads(f'"{match.group(1)}"')
+        except json.JSONDecodeError:
+            name = match.group(1)
+        deltas.append(
+            ToolCall(
+                index=self.calls,
+                id=_new_call_id(),
+                type="function",
+                function=FunctionCall(name=name, arguments=""),
+            )
+        )
+        self._buffer = []
+        self._mode = "arguments"
+        self._depth = 0
+        self._started = False
+        self._string_value = False
+        self._in_string = False
+        self._escaped = False
+        return head[match.end() :]
+
+    def _arguments(self, data: str, deltas: list[ToolCall]) -> str:
+        begin = 0
+        end = None
+        for position, char in enumerate(data):
+            if not self._started:
+                if char.isspace():
+                    begin = position + 1
+                    continue
+                self._started = True
+                self._string_value = char == '"'
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                if self._depth == 0:
+                    end = position  # closes the call object
+                    break
+                self._depth -= 1
+                if self._depth == 0:
+                    end = position + 1
+                    break
+            elif char == "," and self._depth == 0:
+                end = position
+                break
+        stop = len(data) if end is None else end
+        if stop > begin:
+            if self._string_value:
+                self._buffer.append(data[begin:stop])
+            else:
+                arguments = FunctionCall(arguments=data[begin:stop])
+                deltas.append(ToolCall(index=self.calls, function=arguments))
+        if end is None:
+            return ""
+        if self._string_value:
+            deltas.append(
+                ToolCall(
+                    index=self.calls,
+                    function=FunctionCall(arguments=self._decoded_string()),
+                )
+            )
+            self._buffer = []
+        self._mode = "tail"
+        return data[end:]
+
+    def _decoded_string(self) -> str:
+        literal = "".join(self._buffer).strip()
+        try:
+            value = json.loads(literal)
+        except json.JSONDecodeError:
+            return literal
+        return value if isinstance(value, str) else literal
+
+    def _tail(self, data: str) -> str:
+        # what is left of the call object up to the end marker is dropped
+        position = data.find(self.end)
+        if position < 0:
+            self._pending = data[len(data) - partial_marker_length(data, self.end) :]
+            return ""
+        self._mode = "text"
+        self.calls += 1
+        return data[position + len(self.end) :]
+
+    def _buffered(
+        self, data: str, content: list[str], deltas: list[ToolCall]
+    ) -> str:
+        position = data.find(self.end)
+        if position < 0:
+            keep = partial_marker_length(data, self.end)
+            self._buffer.append(data[: len(data) - keep])
+            self._pending = data[len(data) - keep :]
+            return ""
+        text = "".join(self._buffer) + data[:position]
+        self._buffer = []
+        self._mode = "text"
+        call = self._complete_call(text)
+        if call is None:
+            content.append(self.start + text + self.end)
+        else:
+            deltas.append(call)
+        return data[position + len(self.end) :]
+
+    def _complete_call(self, text: str) -> ToolCall | None:
+        """A whole call parsed at once, None if `text` is not one."""
+        try:
+            payload = json.loads(text)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(payload, dict) or not isinstance(payload.get("name"), str):
+            return None
+        arguments = payload.get("arguments", payload.get("parameters", {}))
+        if not isinstance(arguments, str):
+            arguments = json.dumps(arguments, ensure_ascii=False)
+        call = ToolCall(
+            index=self.calls,
+            id=_new_call_id(),
+            type="function",
+            function=FunctionCall(name=payload["name"], arguments=arguments),
+        )
+        self.calls += 1
+        return call
+
+
+def parse_tool_calls(text: str, start: str, end: str) -> tuple[str, list[ToolCall]]:
+    """Content and merged tool calls of a whole completion."""
+    parser = ToolCallParser(start, end)
+    content, deltas = parser.feed(text)
+    rest, more = parser.flush()
+    calls: dict[int, ToolCall] = {}
+    for delta in deltas + more:
+        index = delta.index or 0
+        call = calls.get(index)
+        if call is None:
+            calls[index] = delta.model_copy(update={"index": None}, deep=True)
+            continue
+        arguments = delta.function.arguments or ""
+        call.function.arguments = (call.function.arguments or "") + arguments
+    return content + rest, list(calls.values())
+
+
+def tool_call_constraint(
+    tools: list[ToolDefinition], start: str, end: str, name: str | None = None
+) -> OutputConstraint:
+    """
+    A regex forcing the output to be tool calls, of the tool `name` if given.
+
+    Used for `tool_choice` "required" or a named function, calls take the
+    layout `ToolCallParser` reads.
+    """
+    options = [
+        {
+            "type": "object",
+            "properties": {
+                "name": {"const": tool.function.name},
+                "arguments": tool.function.parameters or {"type": "object"},
+            },
+            "required": ["name", "arguments"],
+        }
+        for tool in tools
+        if name is None or tool.function.name == name
+    ]
+    if not options:
+        raise ValueError(f"tool_choice names an unknown function: {name}")
+    schema = options[0] if len(options) == 1 else {"anyOf": options}
+    call = rf"{re.escape(start)}\n?{schema_to_regex(schema)}\n?{re.escape(end)}"
+    pattern = call if name is not None else rf"{call}(\n?{call})*"
+    return OutputConstraint("regex", pattern)
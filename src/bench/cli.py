@@ -0,0 +1,110 @@
+import os
+import json
+import logging
+import argparse
+import tempfile
+from src.bench.runner import run_benchmark
+from src.bench.trace import load_trace, trace_texts
+
+
+def _parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="transapi-bench",
+        description="Replay a JSONL request trace against transAPI and report "
+        "TTFT, inter-token latency, end-to-end latency and throughput.",
+    )
+    parser.add_argument(
+        "trace", nargs="?", default="requests.jsonl", help="JSONL request trace"
+    )
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument(
+        "--url", default="http://127.0.0.1:8000", help="Server to benchmark"
+    )
+    target.add_argument(
+        "--in-process",
+        action="store_true",
+        help="Serve a tiny randomly initialized model on CPU for the run",
+    )
+    parser.add_argument(
+        "--config",
+        help="Config file for the in-process engine (model settings are replaced)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Serve the in-process model from this many CPU worker processes",
+    )
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument(
+        "--rate", type=float, help="Poisson arrival rate in requests/s"
+    )
+    parser.add_argument("--num-requests", type=int, help="Replay only the first N")
+    parser.add_argument(
+        "--stream",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Force streaming on or off, the trace decides by default",
+    )
+    parser.add_argument(
+        "--max-tokens", type=int, help="Completion token budget of every request"
+    )
+    parser.add_argument("--model", help="Model name sent with every request")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the summary as JSON here")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = _parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger(" TransAPI ")
+
+    max_tokens = args.max_tokens
+    if args.in_process and max_tokens is None:
+        max_tokens = 64
+    requests = load_trace(args.trace, args.stream, max_tokens, args.model)
+    if args.num_requests is not None:
+        requests = requests[: args.num_requests]
+    if not requests:
+        raise SystemExit(f"No requests in {args.trace}")
+
+    if args.in_process:
+        # imported here, a remote run needs neither torch nor a model
+        from src.bench.in_process import (
+            InProcessServer,
+            build_tiny_model,
+            tiny_model_settings,
+        )
+
+        with tempfile.TemporaryDirectory(prefix="transapi-bench-") as model_path:
+            build_tiny_model(model_path, trace_texts(requests), seed=args.seed)
+            settings = tiny_model_settings(
+                args.config, model_path, logger, args.workers
+            )
+            with InProcessServer(settings, logger) as server:
+                report = run_benchmark(
+                    server.base_url,
+                    requests,
+                    args.concurrency,
+                    args.rate,
+                    args.timeout,
+                    args.seed,
+                )
+    else:
+        report = run_benchmark(
+            args.url, requests, args.concurrency, args.rate, args.timeout, args.seed
+        )
+
+    print(report.format())
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report.summary(), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import json
+import time
+import http.client
+from urllib.parse import urlsplit
+from dataclasses import dataclass, field
+from src.bench.trace import TraceRequest
+
+
+@dataclass
+class RequestResult:
+    """Client-side timings of one request, all in seconds."""
+
+    ok: bool
+    latency: float
+    # only measured for streaming requests
+    ttft: float | None = None
+    # gaps between consecutive streamed chunks
+    itls: list[float] = field(default_factory=list)
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    error: str | None = None
+
+
+def _chunk_text(chunk: dict) -> str:
+    text = ""
+    for choice in chunk.get("choices") or []:
+        if "delta" in choice:
+            text += (choice.get("delta") or {}).get("content") or ""
+        else:
+            text += choice.get("text") or ""
+    return text
+
+
+def _read_stream(
+    response: http.client.HTTPResponse, started: float, result: RequestResult
+) -> None:
+    last_chunk = None
+    for raw_line in response:
+        line = raw_line.decode("utf-8").strip()
+        if not line.startswith("data:"):
+            continue
+        data = line[len("data:") :].strip()
+        if data == "[DONE]":
+            break
+        chunk = json.loads(data)
+        if chunk.get("usage"):
+            usage = chunk["usage"]
+            result.prompt_tokens = usage.get("prompt_tokens") or 0
+            result.completion_tokens = usage.get("completion_tokens") or 0
+        if any(
+            choice.get("finish_reason") == "error"
+            for choice in chunk.get("choices") or []
+        ):
+            result.ok = False
+            result.error = "Generation failed"
+        if not _chunk_text(chunk):
+            continue
+
+        now = time.perf_counter()
+        if last_chunk is None:
+            result.ttft = now - started
+        else:
+            result.itls.append(now - last_chunk)
+        last_chunk = now
+
+
+def send(base_url: str, request: TraceRequest, timeout: float) -> RequestResult:
+    """Sends one request and measures it, never raises on request errors."""
+    url = urlsplit(base_url)
+    connection_class = (
+        http.client.HTTPSConnection
+        if url.scheme == "https"
+        else http.client.HTTPConnection
+    )
+    connection = connection_class(url.netloc, timeout=timeout)
+    payload = json.dumps(request.body).encode("utf-8")
+    started = time.perf_counter()
+    result = RequestResult(ok=True, latency=0.0)
+    try:
+        connection.request(
+            "POST",
+            url.path.rstrip("/") + request.endpoint,
+            body=payload,
+            headers={"Content-Type": "application/json"},
+        )
+        response = connection.getresponse()
+        if response.status != 200:
+            result.ok = False
+            result.error = f"HTTP {response.status}: {response.read()[:200]!r}"
+        elif request.body.get("stream"):
+            _read_stream(response, started, result)
+        else:
+            usage = json.loads(response.read()).get("usage") or {}
+            result.prompt_tokens = usage.get("prompt_tokens") or 0
+            result.completion_tokens = usage.get("completion_tokens") or 0
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        result.ok = False
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        connection.close()
+    result.latency = time.perf_counter() - started
+    return result
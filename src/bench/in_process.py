@@ -0,0 +1,134 @@
+import time
+import torch
+import socket
+import logging
+import uvicorn
+import threading
+from fastapi import FastAPI
+from config.settings import (
+    AppSettings,
+    DataParallelSettings,
+    ModelSettings,
+    load_config,
+)
+from src.core.registry import ModelRegistry
+from src.api.endpoints import chat_completions, completions
+from transformers.models.llama import LlamaConfig, LlamaForCausalLM
+from transformers.tokenization_utils_fast import PreTrainedTokenizerFast
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+
+CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "<s>{{ message['role'] }}\n{{ message['content'] }}</s>\n"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}<s>assistant\n{% endif %}"
+)
+
+
+def build_tiny_model(
+    directory: str, texts: list[str], vocab_size: int = 1024, seed: int = 0
+) -> None:
+    """
+    Saves a randomly initialized two-layer Llama and a BPE tokenizer trained on
+    `texts` to `directory`.
+
+    The weights only depend on `seed`, so runs against the same trace compare
+    engine changes rather than model changes. Random weights rarely emit EOS,
+    so generations usually run to their token budget.
+    """
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=["<unk>", "<s>", "</s>", "<pad>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(texts or [""], trainer)
+    fast_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<s>",
+        eos_token="</s>",
+        unk_token="<unk>",
+        pad_token="<pad>",
+    )
+    fast_tokenizer.chat_template = CHAT_TEMPLATE
+    fast_tokenizer.save_pretrained(directory)
+
+    config = LlamaConfig(
+        vocab_size=len(fast_tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=8192,
+        bos_token_id=fast_tokenizer.bos_token_id,
+        eos_token_id=fast_tokenizer.eos_token_id,
+        pad_token_id=fast_tokenizer.pad_token_id,
+    )
+    torch.manual_seed(seed)
+    LlamaForCausalLM(config).save_pretrained(directory)
+
+
+def tiny_model_settings(
+    config: str | None, model_path: str, logger: logging.Logger, workers: int = 1
+) -> AppSettings:
+    """
+    Engine settings for the tiny model, other sections come from `config`.
+
+    With `workers` > 1 the model is served by that many CPU worker processes.
+    """
+    settings = load_config(config) if config else None
+    model = ModelSettings(
+        model_path=model_path, device="cpu", precision="float32", compile=False
+    )
+    data_parallel = DataParallelSettings(workers=workers)
+    if settings is None:
+        return AppSettings(model=model, data_parallel=data_parallel)
+    logger.info(f"Using engine settings from {config} with the tiny model")
+    return settings.model_copy(
+        update={"model": model, "models": {}, "data_parallel": data_parallel}
+    )
+
+
+class InProcessServer:
+    """Serves the completion endpoints of an engine on a free localhost port."""
+
+    def __init__(self, settings: AppSettings, logger: logging.Logger) -> None:
+        self.registry = ModelRegistry(settings, logger)
+        self.registry.load_default()
+        app = FastAPI()
+        app.state.registry = self.registry
+        app.include_router(completions.router)
+        app.include_router(chat_completions.router)
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.bind(("127.0.0.1", 0))
+        self.port = self._socket.getsockname()[1]
+        self._server = uvicorn.Server(
+            uvicorn.Config(app, log_level=settings.log.level.lower())
+        )
+        self._thread = threading.Thread(
+            target=self._server.run,
+            kwargs={"sockets": [self._socket]},
+            name="bench-server",
+            daemon=True,
+        )
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def __enter__(self) -> "InProcessServer":
+        self._thread.start()
+        while not self._server.started:
+            if not self._thread.is_alive():
+                raise RuntimeError("In-process server failed to start")
+            time.sleep(0.05)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.should_exit = True
+        self._thread.join()
+        self.registry.close()
@@ -0,0 +1,118 @@
+import time
+import random
+import threading
+from dataclasses import dataclass
+from concurrent.futures import Future, ThreadPoolExecutor
+from src.bench.trace import TraceRequest
+from src.bench.client import RequestResult, send
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    """Linear interpolation between closest ranks, like `numpy.percentile`."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+@dataclass
+class BenchmarkReport:
+    results: list[RequestResult]
+    duration: float
+
+    @property
+    def succeeded(self) -> list[RequestResult]:
+        return [result for result in self.results if result.ok]
+
+    def summary(self) -> dict:
+        succeeded = self.succeeded
+        ttfts = [result.ttft for result in succeeded if result.ttft is not None]
+        itls = [itl for result in succeeded for itl in result.itls]
+        latencies = [result.latency for result in succeeded]
+        prompt_tokens = sum(result.prompt_tokens for result in succeeded)
+        completion_tokens = sum(result.completion_tokens for result in succeeded)
+        duration = max(self.duration, 1e-9)
+
+        return {
+            "requests": len(self.results),
+            "failed": len(self.results) - len(succeeded),
+            "duration_s": self.duration,
+            "requests_per_s": len(succeeded) / duration,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "output_tokens_per_s": completion_tokens / duration,
+            "total_tokens_per_s": (prompt_tokens + completion_tokens) / duration,
+            "ttft_s": {f"p{q}": percentile(ttfts, q) for q in PERCENTILES},
+            "itl_s": {f"p{q}": percentile(itls, q) for q in PERCENTILES},
+            "latency_s": {f"p{q}": percentile(latencies, q) for q in PERCENTILES},
+        }
+
+    def format(self) -> str:
+        summary = self.summary()
+        lines = [
+            f"Requests:         {summary['requests']} ({summary['failed']} failed)",
+            f"Duration:         {summary['duration_s']:.2f} s",
+            f"Throughput:       {summary['requests_per_s']:.2f} req/s, "
+            f"{summary['output_tokens_per_s']:.1f} output tokens/s, "
+            f"{summary['total_tokens_per_s']:.1f} total tokens/s",
+        ]
+        for name, key in (
+            ("TTFT", "ttft_s"),
+            ("ITL", "itl_s"),
+            ("E2E latency", "latency_s"),
+        ):
+            values = ", ".join(
+                f"{label} n/a" if value is None else f"{label} {value * 1000:.1f} ms"
+                for label, value in summary[key].items()
+            )
+            lines.append(f"{name + ':':<18}{values}")
+
+        errors = {result.error for result in self.results if result.error}
+        for error in sorted(errors)[:5]:
+            lines.append(f"Error:            {error}")
+        return "\n".join(lines)
+
+
+def run_benchmark(
+    base_url: str,
+    requests: list[TraceRequest],
+    concurrency: int = 1,
+    rate: float | None = None,
+    timeout: float = 600.0,
+    seed: int = 0,
+) -> BenchmarkReport:
+    """
+    Replays `requests` against a running server.
+
+    Without `rate`, up to `concurrency` requests are kept in flight back to back.
+    With `rate`, requests arrive as a Poisson process of `rate` requests per
+    second, still capped at `concurrency` in flight.
+    """
+    rng = random.Random(seed)
+    slots = threading.Semaphore(max(concurrency, 1))
+
+    def worker(request: TraceRequest) -> RequestResult:
+        try:
+            return send(base_url, request, timeout)
+        finally:
+            slots.release()
+
+    futures: list[Future] = []
+    started = time.perf_counter()
+    next_arrival = started
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+        for request in requests:
+            if rate is not None and rate > 0:
+                next_arrival += rng.expovariate(rate)
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            slots.acquire()
+            futures.append(pool.submit(worker, request))
+        results = [future.result() for future in futures]
+    return BenchmarkReport(results, time.perf_counter() - started)
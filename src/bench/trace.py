@@ -0,0 +1,88 @@
+import json
+from dataclasses import dataclass
+
+COMPLETIONS = "/v1/completions"
+CHAT_COMPLETIONS = "/v1/chat/completions"
+
+
+@dataclass
+class TraceRequest:
+    """One request of a trace, `body` is sent as is."""
+
+    endpoint: str
+    body: dict
+
+
+def _parse_line(record: dict) -> TraceRequest:
+    """
+    Accepts API request bodies or `{"endpoint": ..., "body": {...}}` records.
+
+    Records that only carry free text in `body` (like the backlog entries of
+    `requests.jsonl`) become single-turn chat requests, so any text corpus
+    can serve as a trace.
+    """
+    body = record.get("body")
+    if isinstance(body, dict):
+        endpoint = record.get("endpoint", CHAT_COMPLETIONS)
+        if endpoint not in (COMPLETIONS, CHAT_COMPLETIONS):
+            raise ValueError(f"Unsupported endpoint in trace: {endpoint}")
+        return TraceRequest(endpoint, dict(body))
+    if "messages" in record:
+        return TraceRequest(CHAT_COMPLETIONS, dict(record))
+    if "prompt" in record:
+        return TraceRequest(COMPLETIONS, dict(record))
+    if isinstance(body, str):
+        title = record.get("title")
+        content = f"{title}\n\n{body}" if title else body
+        return TraceRequest(
+            CHAT_COMPLETIONS, {"messages": [{"role": "user", "content": content}]}
+        )
+    raise ValueError("Trace record has neither `messages`, `prompt` nor `body`")
+
+
+def load_trace(
+    path: str,
+    stream: bool | None = None,
+    max_tokens: int | None = None,
+    model: str | None = None,
+) -> list[TraceRequest]:
+    """Reads a JSONL trace, optionally overriding streaming and the token budget."""
+    requests = []
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                request = _parse_line(json.loads(line))
+            except ValueError as e:
+                raise ValueError(f"{path}:{number}: {e}") from e
+
+            if stream is not None:
+                request.body["stream"] = stream
+            if request.body.get("stream"):
+                # completions only report usage in streams when asked to
+                request.body.setdefault("stream_options", {})["include_usage"] = True
+            if max_tokens is not None:
+                request.body.pop("max_tokens", None)
+                request.body["max_completion_tokens"] = max_tokens
+            if model is not None:
+                request.body["model"] = model
+            requests.append(request)
+    return requests
+
+
+def trace_texts(requests: list[TraceRequest]) -> list[str]:
+    """All prompt and message texts of a trace, e.g. to train a tokenizer on."""
+    texts = []
+    for request in requests:
+        if "prompt" in request.body:
+            texts.append(str(request.body["prompt"]))
+        for message in request.body.get("messages", []):
+            content = message.get("content")
+            if isinstance(content, str):
+                texts.append(content)
+            elif isinstance(content, list):
+                texts.extend(
+                    part["text"] for part in content if part.get("type") == "text"
+                )
+    return texts
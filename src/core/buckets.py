@@ -0,0 +1,58 @@
+import bisect
+from src.core import metrics
+
+
+def compiled_graphs() -> int | None:
+    """Graphs compiled by dynamo in this process, None without dynamo."""
+    try:
+        from torch._dynamo.utils import counters
+    except ImportError:
+        return None
+    return int(counters["stats"]["unique_graphs"])
+
+
+class ShapeBuckets:
+    """
+    Rounds prompt lengths and batch sizes up to a fixed set of shapes.
+
+    A compiled model only sees the bucket shapes, so it does not recompile or
+    re-record CUDA graphs for every new prompt length. Sizes beyond the largest
+    bucket are rounded up to a multiple of it. Real and padding tokens are
+    counted per bucket to tune the boundaries from real traffic.
+    """
+
+    def __init__(self, lengths: list[int], batch_sizes: list[int]) -> None:
+        self.lengths = sorted({length for length in lengths if length > 0})
+        self.batch_sizes = sorted({size for size in batch_sizes if size > 0})
+
+    @staticmethod
+    def _round_up(buckets: list[int], value: int) -> int:
+        if not buckets:
+            return value
+        index = bisect.bisect_left(buckets, value)
+        if index < len(buckets):
+            return buckets[index]
+        largest = buckets[-1]
+        return -(-value // largest) * largest
+
+    def length_for(self, length: int) -> int:
+        return self._round_up(self.lengths, length)
+
+    def batch_for(self, batch_size: int) -> int:
+        return self._round_up(self.batch_sizes, batch_size)
+
+    def shapes(self) -> list[tuple[int, int]]:
+        """Every (length, batch size) pair, for compiling ahead of traffic."""
+        return [
+            (length, batch_size)
+            for length in self.lengths
+            for batch_size in (self.batch_sizes or [1])
+        ]
+
+    def record(self, length: int, real_tokens: int, padded_tokens: int) -> None:
+        """Counts the tokens of a padded batch whose rows are `length` long."""
+        bucket = str(length)
+        metrics.BUCKET_TOKENS.inc(real_tokens, bucket=bucket, kind="real")
+        metrics.BUCKET_TOKENS.inc(
+            padded_tokens - real_tokens, bucket=bucket, kind="padding"
+        )
@@ -0,0 +1,17 @@
+import torch
+from transformers.cache_utils import DynamicCache
+
+
+def cache_tensors(cache: DynamicCache) -> list[tuple[torch.Tensor, torch.Tensor]]:
+    """Returns the per-layer (key, value) tensors of a cache, shaped (B, H, L, D)."""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]  # type: ignore
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def build_cache(tensors: list[tuple[torch.Tensor, torch.Tensor]]) -> DynamicCache:
+    """Builds a `DynamicCache` holding the given per-layer (key, value) tensors."""
+    cache = DynamicCache()
+    for layer_idx, (key, value) in enumerate(tensors):
+        cache.update(key, value, layer_idx)
+    return cache
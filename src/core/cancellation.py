@@ -0,0 +1,91 @@
+import torch
+import threading
+from typing import Callable
+from src.core import metrics
+from transformers.generation.stopping_criteria import StoppingCriteria
+
+
+class StopSignal:
+    """
+    Per-request flag the API sets once nobody waits for the output any more.
+
+    Generation checks it at every decoding step. `reason` is e.g. "disconnect"
+    or "timeout", the first one set wins.
+    """
+
+    def __init__(self) -> None:
+        self.reason: str | None = None
+        self._lock = threading.Lock()
+        self._callbacks: list[Callable[[str], None]] = []
+        self._counted = False
+
+    def is_set(self) -> bool:
+        return self.reason is not None
+
+    def set(self, reason: str) -> None:
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(reason)
+
+    def add_callback(self, callback: Callable[[str], None]) -> None:
+        """Calls `callback(reason)` once the signal is set, right away if it is."""
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return
+        callback(self.reason)
+
+    def stopped(self, tokens_saved: int) -> None:
+        """Counts a generation this signal ended early, once per request."""
+        with self._lock:
+            if self._counted:
+                return
+            self._counted = True
+        reason = self.reason or "unknown"
+        metrics.STOPPED_GENERATIONS.inc(reason=reason)
+        metrics.STOPPED_TOKENS_SAVED.inc(tokens_saved, reason=reason)
+
+
+class StopSignalCriteria(StoppingCriteria):
+    """
+    Ends the rows of requests whose `StopSignal` is set, within one step.
+
+    `signals` has an entry per request of the batch, None for rows that never
+    stop this way, and each request owns the same number of rows. `budgets`
+    are their new token limits, what is left of them counts as saved.
+    """
+
+    def __init__(
+        self,
+        signals: list[StopSignal | None],
+        budgets: list[int],
+        num_prompt_tokens: int,
+    ) -> None:
+        self.signals = signals
+        self.budgets = budgets
+        self.num_prompt_tokens = num_prompt_tokens
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> torch.BoolTensor:
+        if not any(signal is not None and signal.is_set() for signal in self.signals):
+            # no host to device copy on the common path
+            return torch.zeros(
+                input_ids.shape[0], dtype=torch.bool, device=input_ids.device
+            )  # type: ignore
+        rows = input_ids.shape[0] // len(self.signals)
+        generated = input_ids.shape[1] - self.num_prompt_tokens
+        flags: list[bool] = []
+        for signal, budget in zip(self.signals, self.budgets):
+            if signal is not None and signal.is_set():
+                signal.stopped(max(budget - generated, 0) * rows)
+                flags.extend([True] * rows)
+            else:
+                flags.extend([False] * rows)
+        return torch.tensor(
+            flags, dtype=torch.bool, device=input_ids.device
+        )  # type: ignore
@@ -0,0 +1,270 @@
+import json
+import time
+import torch
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass
+from collections import OrderedDict
+from src.core import metrics
+from src.core.fsm import DFA
+from src.core.json_schema import any_object, schema_to_regex
+from transformers.generation.logits_process import LogitsProcessor
+from transformers.tokenization_utils_base import PreTrainedTokenizerBase
+
+# state of rows that ended with a token outside the automaton, e.g. EOS
+FINISHED = -1
+SPIECE_UNDERLINE = "▁"
+
+
+class InvalidConstraintError(ValueError):
+    """Raised when a schema or regex cannot be compiled into an automaton."""
+
+
+@dataclass(frozen=True)
+class OutputConstraint:
+    """
+    What the generated text has to match.
+
+    `kind` is "regex" with the pattern as `spec`, "json_schema" with the schema,
+    or "json_object" for any JSON object.
+    """
+
+    kind: str
+    spec: str | dict | None = None
+
+    def key(self) -> str:
+        canonical = json.dumps(
+            {"kind": self.kind, "spec": self.spec},
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def regex(self) -> str:
+        if self.kind == "regex" and isinstance(self.spec, str):
+            return self.spec
+        if self.kind == "json_schema" and isinstance(self.spec, dict):
+            return schema_to_regex(self.spec)
+        if self.kind == "json_object":
+            return any_object()
+        raise InvalidConstraintError(f"Invalid {self.kind} constraint: {self.spec!r}")
+
+    def dfa(self) -> DFA:
+        """The character automaton, raises `InvalidConstraintError` if it has none."""
+        try:
+            return DFA(self.regex())
+        except ValueError as e:
+            raise InvalidConstraintError(str(e)) from e
+
+
+class Vocabulary:
+    """
+    Text of every token as it lands in the output, built once per tokenizer.
+
+    Special tokens, and tokens holding part of a multi-byte character, can
+    never be matched against a pattern and are left out as None.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizerBase) -> None:
+        special = set(tokenizer.all_special_ids)
+        tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+        self.texts: list[str | None] = []
+        for token_id, token in enumerate(tokens):
+            text = None
+            if token is not None and token_id not in special:
+                text = tokenizer.convert_tokens_to_string([token])
+                # sentencepiece drops the space a word piece starts with
+                if token.startswith(SPIECE_UNDERLINE) and not text.startswith(" "):
+                    text = " " + text
+                if not text or "�" in text:
+                    text = None
+            self.texts.append(text)
+        self.chars = sorted({char for text in self.texts if text for char in text})
+
+
+class TokenAutomaton:
+    """
+    A regex automaton lifted from characters to the tokens of a vocabulary.
+
+    Tokens are rewritten as sequences of the automaton's character classes and
+    deduplicated, then grouped by their first class. The tokens a state allows,
+    and the state each leads to, are worked out on its first visit by walking
+    only the groups whose first class the state accepts. Results and the masks
+    built from them stay with the automaton, so a repeated schema reuses every
+    state visited before.
+    """
+
+    def __init__(self, dfa: DFA, vocabulary: Vocabulary) -> None:
+        self.dfa = dfa
+        classes = dict(zip(vocabulary.chars, map(dfa.classify, vocabulary.chars)))
+        groups: dict[int, dict[tuple[int, ...], list[int]]] = {}
+        for token_id, text in enumerate(vocabulary.texts):
+            if text is None:
+                continue
+            sequence = tuple(map(classes.__getitem__, text))
+            rests = groups.setdefault(sequence[0], {})
+            rests.setdefault(sequence[1:], []).append(token_id)
+        self._groups = groups
+        self._next: dict[int, dict[int, int]] = {}
+        self._masks: dict[tuple[int, tuple[int, ...]], torch.Tensor] = {}
+
+    def _transitions(self, state: int) -> dict[int, int]:
+        """Next state of every token allowed in `state`."""
+        transitions = self._next.get(state)
+        if transitions is not None:
+            return transitions
+        table = self.dfa.table
+        row = table[state]
+        transitions = {}
+        for first, rests in self._groups.items():
+            start = row[first]
+            if start < 0:
+                continue
+            for rest, token_ids in rests.items():
+                current = start
+                for cls in rest:
+                    current = table[current][cls]
+                    if current < 0:
+                        break
+                else:
+                    for token_id in token_ids:
+                        transitions[token_id] = current
+        self._next[state] = transitions
+        return transitions
+
+    def advance(self, state: int, token_id: int) -> int:
+        if state == FINISHED:
+            return FINISHED
+        return self._transitions(state).get(token_id, FINISHED)
+
+    def mask(
+        self,
+        state: int,
+        eos_token_ids: tuple[int, ...],
+        size: int,
+        device: torch.device,
+    ) -> torch.Tensor:
+        """Bool row of the `size` vocabulary entries allowed in `state`."""
+        key = (state, eos_token_ids)
+        mask = self._masks.get(key)
+        if mask is not None and mask.shape[0] == size and mask.device == device:
+            return mask
+        if state == FINISHED:
+            mask = torch.ones(size, dtype=torch.bool, device=device)
+        else:
+            allowed = [
+                token_id for token_id in self._transitions(state) if token_id < size
+            ]
+            # EOS ends accepted text, and cuts short a state no token continues
+            if self.dfa.accepting[state] or not allowed:
+                allowed.extend(eos for eos in eos_token_ids if eos < size)
+            mask = torch.zeros(size, dtype=torch.bool)
+            mask[allowed] = True
+            mask = mask.to(device)
+        self._masks[key] = mask
+        return mask
+
+
+class GrammarCache:
+    """
+    LRU cache of token automata for the loaded tokenizer, by constraint hash.
+
+    The vocabulary is read on the first constrained request. Compiling a new
+    schema costs a regex to automaton pass and one sweep over the vocabulary,
+    a repeated one is a lookup.
+    """
+
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizerBase,
+        max_entries: int,
+        logger: logging.Logger,
+    ) -> None:
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+        self._vocabulary: Vocabulary | None = None
+        self._entries: OrderedDict[str, TokenAutomaton] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def vocabulary(self) -> Vocabulary:
+        with self._lock:
+            if self._vocabulary is None:
+                started = time.perf_counter()
+                self._vocabulary = Vocabulary(self.tokenizer)
+                self.logger.info(
+                    f"Read {len(self._vocabulary.texts)} tokens for constrained "
+                    f"decoding in {time.perf_counter() - started:.2f}s"
+                )
+            return self._vocabulary
+
+    def get(self, constraint: OutputConstraint) -> TokenAutomaton:
+        key = constraint.key()
+        with self._lock:
+            automaton = self._entries.get(key)
+            if automaton is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return automaton
+            self.misses += 1
+
+        started = time.perf_counter()
+        automaton = TokenAutomaton(constraint.dfa(), self.vocabulary)
+        metrics.GRAMMAR_COMPILE_SECONDS.observe(time.perf_counter() - started)
+        with self._lock:
+            self._entries[key] = automaton
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return automaton
+
+    def clear(self) -> None:
+        """Drops the automata and their device masks, the vocabulary stays."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+class ConstrainedLogitsProcessor(LogitsProcessor):
+    """
+    Masks every token that would take a row's text off the automaton.
+
+    Each row's state is advanced by the token picked last step, then the
+    cached masks of all states are stacked and applied in one `masked_fill`.
+    Rows past EOS are left unmasked. The automaton is compiled before the
+    request is queued, so an invalid schema fails it up front rather than
+    inside `generate`.
+    """
+
+    def __init__(self, automaton: TokenAutomaton, eos_token_ids: set[int]) -> None:
+        self.automaton = automaton
+        self.eos_token_ids = tuple(sorted(eos_token_ids))
+        self._states: list[int] | None = None
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        automaton = self.automaton
+        if self._states is None:
+            # the first step sees the prompt, nothing generated yet
+            self._states = [0] * input_ids.shape[0]
+        else:
+            self._states = [
+                automaton.advance(state, token_id)
+                for state, token_id in zip(self._states, input_ids[:, -1].tolist())
+            ]
+        allowed = torch.stack(
+            [
+                automaton.mask(
+                    state, self.eos_token_ids, scores.shape[-1], scores.device
+                )
+                for state in self._states
+            ]
+        )
+        return scores.masked_fill(~allowed, float("-inf"))  # type: ignore
@@ -0,0 +1,393 @@
+import copy
+import queue
+import torch
+import logging
+from threading import Thread
+from concurrent.futures import Future
+from src.core.cancellation import StopSignal
+from transformers.cache_utils import DynamicCache
+from src.core.kv_memory import KVMemoryManager, KVReservation
+from src.core.cache_utils import build_cache, cache_tensors
+from transformers.modeling_utils import PreTrainedModel
+from transformers.generation.streamers import BaseStreamer
+from transformers.tokenization_utils_base import PreTrainedTokenizerBase
+from transformers.generation.configuration_utils import GenerationConfig
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+    TemperatureLogitsWarper,
+    RepetitionPenaltyLogitsProcessor,
+)
+
+
+def _left_pad(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+class _Sequence:
+    """State of one request inside the decode loop."""
+
+    def __init__(
+        self,
+        input_ids: list[int],
+        generation_config: GenerationConfig,
+        streamer: BaseStreamer | None,
+        stop: StopSignal | None = None,
+    ) -> None:
+        self.input_ids = input_ids
+        self.generation_config = generation_config
+        self.streamer = streamer
+        self.stop = stop
+        self.future: Future = Future()
+        self.generated: list[int] = []
+        self.finished = False
+        self.reservation: KVReservation | None = None
+
+        if generation_config.max_new_tokens is not None:
+            self.budget = generation_config.max_new_tokens
+        else:
+            self.budget = max(generation_config.max_length - len(input_ids), 1)
+
+        eos_token_id = generation_config.eos_token_id
+        if eos_token_id is None:
+            self.eos_token_ids = set()
+        elif isinstance(eos_token_id, int):
+            self.eos_token_ids = {eos_token_id}
+        else:
+            self.eos_token_ids = set(eos_token_id)
+
+        stop_strings = generation_config.stop_strings or []
+        if isinstance(stop_strings, str):
+            stop_strings = [stop_strings]
+        self.stop_strings: list[str] = stop_strings
+
+        self.do_sample = bool(generation_config.do_sample)
+        self.processors = LogitsProcessorList()
+        if generation_config.repetition_penalty not in (None, 1.0):
+            self.processors.append(
+                RepetitionPenaltyLogitsProcessor(generation_config.repetition_penalty)
+            )
+        if self.do_sample:
+            if generation_config.temperature not in (None, 1.0):
+                self.processors.append(
+                    TemperatureLogitsWarper(generation_config.temperature)
+                )
+            if generation_config.top_k:
+                self.processors.append(TopKLogitsWarper(generation_config.top_k))
+            if generation_config.top_p not in (None, 1.0):
+                self.processors.append(TopPLogitsWarper(generation_config.top_p))
+
+
+class ContinuousBatchingEngine:
+    """
+    Iteration-level batching over a hand-written decode loop.
+
+    All running sequences share one left-padded `DynamicCache` and advance by one
+    token per `model.forward` call. Waiting sequences are prefilled and merged
+    into the batch at step boundaries, finished ones are dropped right away, so
+    a short request never waits for the longest generation in its batch.
+
+    With a `kv_memory` manager every sequence reserves the cache of its prompt
+    and full token budget when it is admitted, and releases it once it retires.
+    A sequence that does not fit waits at the head of the queue for running
+    ones to finish, instead of stalling the loop.
+    """
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        tokenizer: PreTrainedTokenizerBase,
+        max_running: int,
+        logger: logging.Logger,
+        kv_memory: KVMemoryManager | None = None,
+    ) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_running = max(max_running, 1)
+        self.logger = logger
+        self.kv_memory = kv_memory
+
+        self._waiting: queue.Queue[_Sequence | None] = queue.Queue()
+        # admitted once running sequences released enough KV memory
+        self._blocked: _Sequence | None = None
+        self._running: list[_Sequence] = []
+        self._cache: DynamicCache | None = None
+        self._attention_mask: torch.Tensor | None = None
+        self._closed = False
+        self._thread = Thread(target=self._run, name="decode-loop", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def supports(generation_config: GenerationConfig | None) -> bool:
+        """Beam search and similar strategies still go through `generate`."""
+        if generation_config is None:
+            return True
+        return (generation_config.num_beams or 1) == 1 and (
+            generation_config.num_beam_groups or 1
+        ) == 1
+
+    def submit(
+        self,
+        input_ids: list[int],
+        generation_config: GenerationConfig | None = None,
+        streamer: BaseStreamer | None = None,
+        stop: StopSignal | None = None,
+    ) -> Future:
+        """
+        Queues a request, the future resolves to its generated token IDs.
+
+        A set `stop` signal ends the request at the next step boundary, with
+        the tokens generated so far.
+        """
+        config = copy.deepcopy(self.model.generation_config)
+        if generation_config is not None:
+            config.update(**generation_config.to_diff_dict())
+        sequence = _Sequence(input_ids, config, streamer, stop)
+        self._waiting.put(sequence)
+        return sequence.future
+
+    def close(self) -> None:
+        self._closed = True
+        self._waiting.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._closed:
+            try:
+                self._admit()
+                if self._running:
+                    self._step()
+                    self._evict()
+            except Exception as e:
+                self.logger.error(f"Decode loop failed: {e}", exc_info=True)
+                for sequence in self._running:
+                    self._finish(sequence, error=e)
+                self._running = []
+                self._cache = None
+                self._attention_mask = None
+
+        if self._blocked is not None:
+            self._running.append(self._blocked)
+        for sequence in self._running:
+            self._finish(sequence, error=RuntimeError("Engine is shutting down"))
+
+    @torch.no_grad()
+    def _admit(self) -> None:
+        while len(self._running) < self.max_running:
+            sequence, self._blocked = self._blocked, None
+            if sequence is None:
+                try:
+                    # block only when there is nothing to decode
+                    sequence = self._waiting.get(block=not self._running)
+                except queue.Empty:
+                    return
+                if sequence is None:
+                    return
+                if not sequence.future.set_running_or_notify_cancel():
+                    continue
+            if self._stopped(sequence):
+                self._finish(sequence)
+            elif self._reserve(sequence):
+                self._prefill(sequence)
+            elif not sequence.finished:
+                self._blocked = sequence
+                return
+
+    def _reserve(self, sequence: _Sequence) -> bool:
+        """Reserves the KV cache of `sequence`, waiting only on an idle loop."""
+        if self.kv_memory is None:
+            return True
+        try:
+            sequence.reservation = self.kv_memory.reserve(
+                1,
+                len(sequence.input_ids) + sequence.budget,
+                # the loop merges plain `DynamicCache`s only
+                fixed_cache=True,
+                wait=not self._running,
+            )
+        except Exception as e:
+            self._finish(sequence, error=e)
+            return False
+        return sequence.reservation is not None
+
+    def _prefill(self, sequence: _Sequence) -> None:
+        device = self.model.device
+        input_ids = torch.tensor([sequence.input_ids], device=device)
+        if sequence.streamer is not None:
+            sequence.streamer.put(input_ids.cpu())
+
+        try:
+            cache = DynamicCache()
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=cache,
+                use_cache=True,
+            )
+            token = self._sample([sequence], outputs.logits[:, -1, :])[0]
+        except Exception as e:
+            self._finish(sequence, error=e)
+            return
+
+        self._append(sequence, token)
+        if sequence.finished:
+            return
+
+        self._merge(sequence, outputs.past_key_values)
+
+    def _merge(self, sequence: _Sequence, cache: DynamicCache) -> None:
+        new_tensors = cache_tensors(cache)
+        new_mask = torch.ones(
+            (1, len(sequence.input_ids)), dtype=torch.long, device=self.model.device
+        )
+        if self._cache is None or self._attention_mask is None:
+            self._cache = build_cache(new_tensors)
+            self._attention_mask = new_mask
+            self._running = [sequence]
+            return
+
+        length = max(self._attention_mask.shape[1], new_mask.shape[1])
+        tensors = []
+        for (key, value), (new_key, new_value) in zip(
+            cache_tensors(self._cache), new_tensors
+        ):
+            tensors.append(
+                (
+                    torch.cat(
+                        [_left_pad(key, length, 2), _left_pad(new_key, length, 2)]
+                    ),
+                    torch.cat(
+                        [_left_pad(value, length, 2), _left_pad(new_value, length, 2)]
+                    ),
+                )
+            )
+        self._cache = build_cache(tensors)
+        self._attention_mask = torch.cat(
+            [
+                _left_pad(self._attention_mask, length, 1),
+                _left_pad(new_mask, length, 1),
+            ]
+        )
+        self._running.append(sequence)
+
+    @torch.no_grad()
+    def _step(self) -> None:
+        assert self._attention_mask is not None, "Running batch has no attention mask"
+        device = self.model.device
+        input_ids = torch.tensor(
+            [[sequence.generated[-1]] for sequence in self._running], device=device
+        )
+        self._attention_mask = torch.cat(
+            [
+                self._attention_mask,
+                self._attention_mask.new_ones((len(self._running), 1)),
+            ],
+            dim=1,
+        )
+        position_ids = self._attention_mask.sum(dim=1, keepdim=True) - 1
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=self._attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._cache,
+            use_cache=True,
+        )
+        self._cache = outputs.past_key_values
+        tokens = self._sample(self._running, outputs.logits[:, -1, :])
+        for sequence, token in zip(self._running, tokens):
+            self._append(sequence, token)
+
+    def _sample(self, sequences: list[_Sequence], logits: torch.Tensor) -> list[int]:
+        # greedy rows share one argmax, processed rows are handled one by one
+        tokens = logits.argmax(dim=-1).tolist()
+        for i, sequence in enumerate(sequences):
+            if not sequence.processors and not sequence.do_sample:
+                continue
+            scores = logits[i : i + 1].float()
+            if sequence.processors:
+                history = torch.tensor(
+                    [sequence.input_ids + sequence.generated], device=logits.device
+                )
+                scores = sequence.processors(history, scores)
+            if sequence.do_sample:
+                probs = torch.softmax(scores, dim=-1)
+                tokens[i] = int(torch.multinomial(probs, num_samples=1).item())
+            else:
+                tokens[i] = int(scores.argmax(dim=-1).item())
+        return tokens
+
+    def _append(self, sequence: _Sequence, token: int) -> None:
+        sequence.generated.append(token)
+        if sequence.streamer is not None:
+            sequence.streamer.put(torch.tensor([token]))
+
+        if (
+            token in sequence.eos_token_ids
+            or len(sequence.generated) >= sequence.budget
+            or self._hit_stop_string(sequence)
+            or self._stopped(sequence)
+        ):
+            self._finish(sequence)
+
+    @staticmethod
+    def _stopped(sequence: _Sequence) -> bool:
+        if sequence.stop is None or not sequence.stop.is_set():
+            return False
+        sequence.stop.stopped(max(sequence.budget - len(sequence.generated), 0))
+        return True
+
+    def _hit_stop_string(self, sequence: _Sequence) -> bool:
+        if not sequence.stop_strings:
+            return False
+        # a stop string spans at most as many tokens as it has characters
+        window = max(len(stop) for stop in sequence.stop_strings)
+        tail = self.tokenizer.decode(sequence.generated[-window:])
+        return any(tail.endswith(stop) for stop in sequence.stop_strings)
+
+    def _finish(self, sequence: _Sequence, error: Exception | None = None) -> None:
+        if sequence.finished:
+            return
+        sequence.finished = True
+        if sequence.reservation is not None:
+            assert self.kv_memory is not None, "Reservation without a KV manager"
+            self.kv_memory.release(sequence.reservation)
+            sequence.reservation = None
+        if sequence.streamer is not None:
+            sequence.streamer.end()
+        if error is not None:
+            sequence.future.set_exception(error)
+        else:
+            sequence.future.set_result(sequence.generated)
+
+    def _evict(self) -> None:
+        keep = [i for i, sequence in enumerate(self._running) if not sequence.finished]
+        if len(keep) == len(self._running):
+            return
+        if not keep:
+            self._running = []
+            self._cache = None
+            self._attention_mask = None
+            return
+
+        assert self._cache is not None and self._attention_mask is not None
+        index = torch.tensor(keep, device=self._attention_mask.device)
+        attention_mask = self._attention_mask.index_select(0, index)
+        # drop leading columns that are padding for every remaining sequence
+        offset = int((attention_mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+        tensors = [
+            (
+                key.index_select(0, index.to(key.device))[:, :, offset:],
+                value.index_select(0, index.to(value.device))[:, :, offset:],
+            )
+            for key, value in cache_tensors(self._cache)
+        ]
+        self._cache = build_cache(tensors)
+        self._attention_mask = attention_mask[:, offset:]
+        self._running = [self._running[i] for i in keep]
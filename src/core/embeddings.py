@@ -0,0 +1,95 @@
+import torch
+import numpy as np
+from transformers.modeling_utils import PreTrainedModel
+from transformers.tokenization_utils_base import PreTrainedTokenizerBase
+
+POOLING_MODES = ("mean", "last")
+
+
+class Embedder:
+    """
+    Encodes token sequences into pooled, optionally normalized hidden states.
+
+    Inputs are sorted by length and cut into micro-batches of at most
+    `max_batch_size` rows and `max_batch_tokens` padded tokens, so every batch
+    pads its rows to a similar length. Vectors come back in input order as one
+    float32 array.
+    """
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        tokenizer: PreTrainedTokenizerBase,
+        max_batch_size: int,
+        max_batch_tokens: int,
+        normalize: bool,
+    ) -> None:
+        # a causal LM's base model skips the vocabulary projection
+        self.model = model.base_model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_batch_tokens = max(max_batch_tokens, 1)
+        self.normalize = normalize
+        pad_token_id = tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = tokenizer.eos_token_id
+        self.pad_token_id = pad_token_id if pad_token_id is not None else 0
+
+    def tokenize(self, texts: list[str]) -> list[list[int]]:
+        return self.tokenizer(texts)["input_ids"]  # type: ignore
+
+    def _batches(self, lengths: list[int]) -> list[list[int]]:
+        """Input indices grouped into micro-batches, shortest inputs first."""
+        batches: list[list[int]] = []
+        batch: list[int] = []
+        for index in sorted(range(len(lengths)), key=lengths.__getitem__):
+            # sorted ascending, so the newest row is the longest of its batch
+            padded_tokens = (len(batch) + 1) * max(lengths[index], 1)
+            if batch and (
+                len(batch) >= self.max_batch_size
+                or padded_tokens > self.max_batch_tokens
+            ):
+                batches.append(batch)
+                batch = []
+            batch.append(index)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @staticmethod
+    def _pool(
+        hidden: torch.Tensor, attention_mask: torch.Tensor, pooling: str
+    ) -> torch.Tensor:
+        if pooling == "last":
+            # rows are right-padded, the last real token sits at length - 1
+            last = attention_mask.sum(dim=1) - 1
+            return hidden[torch.arange(hidden.shape[0], device=hidden.device), last]
+        mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+        return (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+    @torch.no_grad()
+    def encode(self, token_ids: list[list[int]], pooling: str) -> np.ndarray:
+        if pooling not in POOLING_MODES:
+            raise ValueError(f"Unknown pooling '{pooling}', use one of {POOLING_MODES}")
+        device = self.model.device
+        vectors: np.ndarray | None = None
+        for batch in self._batches([len(ids) for ids in token_ids]):
+            rows = [token_ids[index] for index in batch]
+            longest = max(max(len(row) for row in rows), 1)
+            input_ids = torch.full((len(rows), longest), self.pad_token_id)
+            attention_mask = torch.zeros((len(rows), longest), dtype=torch.long)
+            for row_index, row in enumerate(rows):
+                input_ids[row_index, : len(row)] = torch.tensor(row, dtype=torch.long)
+                attention_mask[row_index, : len(row)] = 1
+            attention_mask = attention_mask.to(device)
+            hidden = self.model(
+                input_ids=input_ids.to(device), attention_mask=attention_mask
+            ).last_hidden_state
+            pooled = self._pool(hidden, attention_mask, pooling).float()
+            if self.normalize:
+                pooled = torch.nn.functional.normalize(pooled, dim=-1)
+            if vectors is None:
+                # little-endian float32, its rows are base64-encoded in place
+                vectors = np.empty((len(token_ids), pooled.shape[-1]), dtype="<f4")
+            vectors[batch] = pooled.cpu().numpy()
+        return vectors if vectors is not None else np.empty((0, 0), dtype="<f4")
@@ -1,46 +1,587 @@
+import copy
+import json
+import time
+import queue
 import torch
+import asyncio
 import logging
+from threading import Lock, Thread
+from contextlib import contextmanager
+from concurrent.futures import Future
 from config.settings import AppSettings
-from src.core.loader import load_model_with_settings
+from src.core.loader import (
+    load_draft_model,
+    load_embedding_model,
+    load_model_with_settings,
+    load_processor,
+)
+from src.core.outputs import EmbeddingResult, GenerationResult, RequestStats
+from src.core import metrics
+from src.core.metrics import StepCounter
+from src.core.speculative import ForwardCounter
+from src.core.embeddings import Embedder
+from src.core.kv_memory import KVMemoryManager
+from src.core.prefix_cache import PrefixCache
+from src.core.template_cache import TemplateCache
+from src.core.cancellation import StopSignal, StopSignalCriteria
+from src.core.constrained import (
+    GrammarCache,
+    OutputConstraint,
+    InvalidConstraintError,
+    ConstrainedLogitsProcessor,
+)
+from src.core.buckets import ShapeBuckets, compiled_graphs
+from src.core.response_cache import ResponseCache
+from src.core.executor import InferenceExecutor
+from transformers.cache_utils import DynamicCache
+from src.core.continuous import ContinuousBatchingEngine
+from src.core.reasoning import ReasoningBudgetProcessor
+from src.core.logprobs import LogprobsRecorder, LogprobsStreamer
 from transformers.generation.streamers import BaseStreamer
+from transformers.processing_utils import ProcessorMixin
 from transformers.tokenization_utils_base import BatchEncoding
+from transformers.generation.logits_process import LogitsProcessorList
+from transformers.generation.stopping_criteria import StoppingCriteriaList
 from transformers.generation.configuration_utils import GenerationConfig
 
 
+class _PendingRequest:
+    """A tokenized text-only request waiting to be batched."""
+
+    def __init__(
+        self,
+        input_ids: list[int],
+        generation_config: GenerationConfig | None,
+        stop: StopSignal | None = None,
+    ) -> None:
+        self.input_ids = input_ids
+        self.generation_config = generation_config
+        self.stop = stop
+        self.future: Future = Future()
+
+
+class PaddedBatcher:
+    """
+    Runs compatible tokenized requests as left-padded `generate` calls.
+
+    Requests are compatible when their generation configs are equal apart from
+    the length limits, which are resolved per request after generation.
+    """
+
+    def __init__(
+        self, engine: "InferenceEngine", max_batch_size: int, max_padded_tokens: int
+    ) -> None:
+        self.engine = engine
+        self.logger = engine.logger
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_padded_tokens = max_padded_tokens
+
+    def _batch_key(self, generation_config: GenerationConfig | None) -> str:
+        if generation_config is None:
+            return ""
+        config = generation_config.to_diff_dict()
+        config.pop("max_length", None)
+        config.pop("max_new_tokens", None)
+        return json.dumps(config, sort_keys=True, default=str)
+
+    def _form_batches(
+        self, pending: list[_PendingRequest]
+    ) -> list[list[_PendingRequest]]:
+        groups: dict[str, list[_PendingRequest]] = {}
+        for request in pending:
+            key = self._batch_key(request.generation_config)
+            groups.setdefault(key, []).append(request)
+
+        batches = []
+        for group in groups.values():
+            # similar lengths next to each other keep padding low
+            group.sort(key=lambda request: len(request.input_ids))
+            batch: list[_PendingRequest] = []
+            for request in group:
+                # the group is sorted, so this request is the longest so far
+                padded_tokens = len(request.input_ids) * (len(batch) + 1)
+                if batch and (
+                    len(batch) >= self.max_batch_size
+                    or padded_tokens > self.max_padded_tokens
+                ):
+                    batches.append(batch)
+                    batch = []
+                batch.append(request)
+            if batch:
+                batches.append(batch)
+        return batches
+
+    def _new_token_budget(self, request: _PendingRequest) -> int:
+        return self.engine._new_token_budget(
+            request.generation_config, len(request.input_ids)
+        )
+
+    def _execute(self, batch: list[_PendingRequest]) -> None:
+        pad_token_id = self.engine._pad_token_id()
+        budgets = [self._new_token_budget(request) for request in batch]
+        generation_config = copy.deepcopy(batch[0].generation_config)
+        if generation_config is not None:
+            # resolve length limits per request, the batch decodes up to the largest
+            generation_config.max_new_tokens = max(budgets)
+
+        max_len = max(len(request.input_ids) for request in batch)
+        num_rows = len(batch)
+        buckets = self.engine.buckets
+        if buckets is not None:
+            max_len = buckets.length_for(max_len)
+            num_rows = buckets.batch_for(num_rows)
+            buckets.record(
+                max_len,
+                sum(len(request.input_ids) for request in batch),
+                num_rows * max_len,
+            )
+        input_ids = torch.full((num_rows, max_len), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((num_rows, max_len), dtype=torch.long)
+        # filler rows attend to one token, a fully masked row breaks attention
+        attention_mask[:, -1] = 1
+        for i, request in enumerate(batch):
+            length = len(request.input_ids)
+            input_ids[i, max_len - length :] = torch.tensor(request.input_ids)
+            attention_mask[i, max_len - length :] = 1
+
+        if len(batch) > 1:
+            self.logger.debug(
+                f"Running batch of {len(batch)} requests, padded length {max_len}"
+            )
+
+        try:
+            kwargs = {}
+            if generation_config is None:
+                kwargs["max_new_tokens"] = max(budgets)
+            if any(request.stop is not None for request in batch):
+                # filler rows never stop early
+                fillers = num_rows - len(batch)
+                criteria = StopSignalCriteria(
+                    [request.stop for request in batch] + [None] * fillers,
+                    budgets + [0] * fillers,
+                    max_len,
+                )
+                kwargs["stopping_criteria"] = StoppingCriteriaList([criteria])
+            outputs = self.engine._managed_generate(
+                input_ids=input_ids.to(self.engine.model.device),
+                attention_mask=attention_mask.to(self.engine.model.device),
+                generation_config=generation_config,
+                **kwargs,
+            )
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        generated = outputs[:, max_len:].tolist()
+        for request, tokens, budget in zip(batch, generated, budgets):
+            request.future.set_result(
+                self.engine._trim_generated(tokens[:budget], generation_config)
+            )
+
+
+class BatchScheduler(PaddedBatcher):
+    """
+    Collects pending non-streaming requests over a short window and runs
+    compatible ones as a single left-padded `generate` call.
+    """
+
+    def __init__(self, engine: "InferenceEngine") -> None:
+        batching = engine.settings.batching
+        super().__init__(engine, batching.max_batch_size, batching.max_padded_tokens)
+        self.max_wait = batching.max_wait_ms / 1000
+        self._queue: queue.Queue[_PendingRequest | None] = queue.Queue()
+        self._thread = Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        input_ids: list[int],
+        generation_config: GenerationConfig | None,
+        stop: StopSignal | None = None,
+    ) -> Future:
+        """Queues a request, the future resolves to its generated token IDs."""
+        request = _PendingRequest(input_ids, generation_config, stop)
+        self._queue.put(request)
+        return request.future
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        running = True
+        while running:
+            first = self._queue.get()
+            if first is None:
+                break
+            pending = [first]
+            deadline = time.monotonic() + self.max_wait
+            while len(pending) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    running = False
+                    break
+                pending.append(request)
+
+            for batch in self._form_batches(pending):
+                self._execute(batch)
+
+
 class InferenceEngine:
     def __init__(self, settings: AppSettings, logger: logging.Logger) -> None:
         self.settings = settings
         self.logger = logger
-        self.model, self.tokenizer, self.processor = load_model_with_settings(
+        metrics.REGISTRY.enabled = self.settings.metrics.enabled
+        timings: dict[str, float] = {}
+        started = time.perf_counter()
+        self.model, self.tokenizer = load_model_with_settings(
             self.settings, self.logger
         )
+        timings["model"] = time.perf_counter() - started
+        # loaded on the first multimodal request
+        self._processor: ProcessorMixin | None = None
+        self._processor_loaded = False
+        self._processor_lock = Lock()
+        # loaded on the first embeddings request
+        self._embedder: Embedder | None = None
+        self._embedder_lock = Lock()
+
+        phase_started = time.perf_counter()
+        self.draft_model = load_draft_model(self.settings, self.logger)
+        self.draft_counter = (
+            ForwardCounter(self.draft_model) if self.draft_model is not None else None
+        )
+        if self.draft_model is not None:
+            timings["draft model"] = time.perf_counter() - phase_started
+
+        self.buckets: ShapeBuckets | None = None
+        if self.settings.model.length_buckets or self.settings.model.batch_buckets:
+            self.buckets = ShapeBuckets(
+                self.settings.model.length_buckets, self.settings.model.batch_buckets
+            )
+        warmup_shapes = [(length, 1) for length in self.settings.model.warmup_lengths]
+        if self.buckets is not None:
+            warmup_shapes.extend(self.buckets.shapes())
+        if warmup_shapes:
+            phase_started = time.perf_counter()
+            self._warmup(warmup_shapes)
+            timings["warmup"] = time.perf_counter() - phase_started
+        # graphs compiled from here on are recompiles caused by traffic
+        self.warm_graphs = compiled_graphs()
+        # after warmup, so the free memory it measures is what serving has
+        self.kv_memory = KVMemoryManager(
+            self.model,
+            self.settings.kv_cache,
+            self.logger,
+            headroom_bytes=int(self.settings.model.prefix_cache_mb * 1024 * 1024),
+        )
+        self.scheduler: BatchScheduler | None = None
+        self.continuous: ContinuousBatchingEngine | None = None
+        if self.settings.batching.continuous:
+            self.continuous = ContinuousBatchingEngine(
+                self.model,
+                self.tokenizer,
+                self.settings.batching.max_batch_size,
+                self.logger,
+                kv_memory=self.kv_memory,
+            )
+        elif self.settings.batching.enabled:
+            self.scheduler = BatchScheduler(self)
+        self.prefix_cache: PrefixCache | None = None
+        if self.settings.model.prefix_cache_mb > 0:
+            self.prefix_cache = PrefixCache(
+                int(self.settings.model.prefix_cache_mb * 1024 * 1024), self.logger
+            )
+        self.template_cache: TemplateCache | None = None
+        if self.settings.model.template_cache_size > 0:
+            self.template_cache = TemplateCache(self.settings.model.template_cache_size)
+        self.grammar_cache = GrammarCache(
+            self.tokenizer, self.settings.model.grammar_cache_size, self.logger
+        )
+        self.response_cache: ResponseCache | None = None
+        if self.settings.response_cache.enabled:
+            self.response_cache = ResponseCache(
+                self.settings.response_cache.max_entries,
+                self.settings.response_cache.max_tokens,
+                self.settings.response_cache.ttl_seconds,
+                self.logger,
+                persist_path=self.settings.response_cache.persist_path,
+            )
+        # requests started through `_submit_tokens`/`_cached_generate_tokens`
+        self._active = 0
+        # offline batches of `generate_batch`, they do not count as online load
+        self._offline = 0
+        self._active_lock = Lock()
+        self._resident_device = self.model.device
+        # whether the processor can template chats, checked on first use
+        self.processor_template_supported: bool | None = None
+        self.executor = InferenceExecutor(
+            self.settings.executor.max_concurrency,
+            self.settings.executor.max_queue_size,
+            self.logger,
+        )
+        timings["total"] = time.perf_counter() - started
+        self.logger.info(
+            "Startup timing: "
+            + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+        )
+
+    @property
+    def processor(self) -> ProcessorMixin | None:
+        """The model's processor, loaded on first access."""
+        if not self._processor_loaded:
+            with self._processor_lock:
+                if not self._processor_loaded:
+                    self._processor = load_processor(self.settings, self.logger)
+                    self._processor_loaded = True
+        return self._processor
+
+    @property
+    def embedder(self) -> Embedder:
+        """Encoder for embeddings, loaded on first access."""
+        if self._embedder is None:
+            with self._embedder_lock:
+                if self._embedder is None:
+                    loaded = load_embedding_model(self.settings, self.logger)
+                    model, tokenizer = loaded or (self.model, self.tokenizer)
+                    self._embedder = Embedder(
+                        model,
+                        tokenizer,
+                        self.settings.embeddings.max_batch_size,
+                        self.settings.embeddings.max_batch_tokens,
+                        self.settings.embeddings.normalize,
+                    )
+        return self._embedder
+
+    def recompiles(self) -> int | None:
+        """Graphs compiled since warmup, None when nothing is compiled."""
+        graphs = compiled_graphs()
+        if graphs is None or self.warm_graphs is None:
+            return None
+        return graphs - self.warm_graphs
+
+    @torch.no_grad()
+    def _warmup(self, shapes: list[tuple[int, int]]) -> None:
+        """
+        Runs a short greedy generation per (prompt length, batch size).
+
+        With `torch.compile` this compiles the graphs for those shapes up front,
+        and fills the compile cache for the next start.
+        """
+        token_id = self._pad_token_id()
+        for length, batch_size in sorted(set(shapes)):
+            phase_started = time.perf_counter()
+            input_ids = torch.full(
+                (batch_size, length),
+                token_id,
+                dtype=torch.long,
+                device=self.model.device,
+            )
+            self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                max_new_tokens=self.settings.model.warmup_new_tokens,
+                do_sample=False,
+                pad_token_id=token_id,
+            )
+            self.logger.info(
+                f"Warmup with {length} prompt tokens x {batch_size} took "
+                f"{time.perf_counter() - phase_started:.2f}s"
+            )
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        if self.scheduler is not None:
+            self.scheduler.close()
+            self.scheduler = None
+        if self.continuous is not None:
+            self.continuous.close()
+            self.continuous = None
+        if self.response_cache is not None:
+            self.response_cache.save()
+
+    @property
+    def busy(self) -> bool:
+        """Whether any request is queued, running or streaming on this engine."""
+        return (
+            self._active > 0 or self._offline > 0 or self.executor.outstanding > 0
+        )
+
+    def _begin_active(self) -> None:
+        with self._active_lock:
+            self._active += 1
+
+    def _end_active(self) -> None:
+        with self._active_lock:
+            self._active -= 1
+
+    @contextmanager
+    def _track_active(self):
+        self._begin_active()
+        try:
+            yield
+        finally:
+            self._end_active()
+
+    @contextmanager
+    def _track_offline(self):
+        with self._active_lock:
+            self._offline += 1
+        try:
+            yield
+        finally:
+            with self._active_lock:
+                self._offline -= 1
+
+    def _yield_to_online(self) -> None:
+        """
+        Holds an offline batch back while online requests keep the engine busy.
+
+        Waits at most `batch_jobs.max_yield_seconds`, so offline jobs still get
+        a share of the engine under constant online load.
+        """
+        limit = self.settings.batch_jobs.yield_to_online
+        deadline = time.monotonic() + self.settings.batch_jobs.max_yield_seconds
+        while (
+            self._active + self.executor.queue_depth > limit
+            and time.monotonic() < deadline
+        ):
+            time.sleep(0.05)
+
+    def memory_footprint(self) -> int:
+        """Bytes of model (and draft model) weights and buffers."""
+        models = [self.model, self.draft_model]
+        if self._embedder is not None and self.settings.embeddings.model_path:
+            models.append(self._embedder.model)
+        return sum(
+            model.get_memory_footprint() for model in models if model is not None
+        )
+
+    def _can_offload(self) -> bool:
+        # quantized weights and models split over devices cannot simply move
+        if getattr(self.model, "is_quantized", False):
+            return False
+        devices = set(getattr(self.model, "hf_device_map", {"": None}).values())
+        return len(devices) <= 1
+
+    def offload(self) -> bool:
+        """
+        Moves the weights to CPU to free accelerator memory.
+
+        Caches holding device tensors are dropped. Returns False when the model
+        cannot be moved, the caller should release it instead.
+        """
+        if not self._can_offload():
+            return False
+        self._resident_device = self.model.device
+        try:
+            self.model.to("cpu")
+            if self.draft_model is not None:
+                self.draft_model.to("cpu")
+        except (RuntimeError, ValueError, NotImplementedError) as e:
+            self.logger.warning(f"Cannot offload model, releasing it instead: {e}")
+            self.model.to(self._resident_device)
+            return False
+
+        if self.prefix_cache is not None:
+            self.prefix_cache = PrefixCache(
+                self.prefix_cache.budget_bytes, self.prefix_cache.logger
+            )
+        if self.template_cache is not None:
+            self.template_cache = TemplateCache(self.template_cache.max_entries)
+        self.grammar_cache.clear()
+        # a dedicated encoder is released, it loads again on the next request
+        self._embedder = None
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return True
+
+    def restore(self) -> None:
+        """Moves offloaded weights back to the device they were loaded on."""
+        self.model.to(self._resident_device)
+        if self.draft_model is not None:
+            self.draft_model.to(self._resident_device)
+
+    def _kv_demand(
+        self, generation_config: GenerationConfig | None, kwargs: dict
+    ) -> tuple[int, int, bool]:
+        """Rows and tokens of the KV cache a `generate` call builds at most."""
+        config = copy.copy(generation_config or self.model.generation_config)
+        for name in ("num_beams", "num_return_sequences", "max_new_tokens"):
+            if kwargs.get(name) is not None:
+                setattr(config, name, kwargs[name])
+        input_ids = kwargs.get("input_ids")
+        batch_size, num_prompt_tokens = (
+            input_ids.shape if input_ids is not None else (1, 0)
+        )
+        # beams replace sampled sequences, they are not multiplied
+        if (config.num_beams or 1) > 1:
+            num_rows = batch_size * config.num_beams
+        else:
+            num_rows = batch_size * (config.num_return_sequences or 1)
+        if config.max_new_tokens is not None:
+            num_tokens = num_prompt_tokens + config.max_new_tokens
+        else:
+            num_tokens = max(config.max_length, num_prompt_tokens + 1)
+        # these bring or name their own cache, or only run with a dynamic one
+        fixed_cache = self.model.generation_config.cache_implementation is not None
+        fixed_cache = fixed_cache or any(
+            name in kwargs
+            for name in (
+                "past_key_values",
+                "cache_implementation",
+                "assistant_model",
+                "prompt_lookup_num_tokens",
+            )
+        )
+        return num_rows, num_tokens, fixed_cache
 
-    def _resilient_generate(
+    def _managed_generate(
         self,
         generation_config: GenerationConfig | None = None,
         streamer: BaseStreamer | None = None,
         *args,
         **kwargs,
     ):
-        try:
-            return self.model.generate(
-                use_model_defaults=True,
-                generation_config=generation_config,
-                streamer=streamer,
-                tokenizer=self.tokenizer,
-                *args,
-                **kwargs,
-            )
-        except torch.cuda.OutOfMemoryError as e:
-            self.logger.warning(f"OOM error during generation: {e}")
-            torch.cuda.empty_cache()
-            kwargs["cache_implementation"] = "offloaded"
+        """
+        Runs `generate` once the KV memory manager admitted its cache.
+
+        The manager picks the cache implementation before the prefill, so no
+        work is lost to running out of memory halfway. If that still happens
+        the estimate was off, the error is counted and raised without a retry.
+        """
+        with self.kv_memory.admit(
+            *self._kv_demand(generation_config, kwargs)
+        ) as reservation:
             try:
-                return self.model.generate(use_model_defaults=True, *args, **kwargs)
+                return self.model.generate(
+                    use_model_defaults=True,
+                    generation_config=generation_config,
+                    streamer=streamer,
+                    tokenizer=self.tokenizer,
+                    *args,
+                    **self.kv_memory.generate_kwargs(reservation),
+                    **kwargs,
+                )
+            except torch.cuda.OutOfMemoryError as e:
+                self.logger.warning(
+                    f"OOM error during generation with a {reservation.implementation}"
+                    f" cache of {reservation.nbytes} bytes: {e}"
+                )
+                metrics.OOM_ERRORS.inc()
+                torch.cuda.empty_cache()
+                raise RuntimeError(e)
+            except InvalidConstraintError:
+                raise
             except Exception as e:
                 raise RuntimeError(e)
-        except Exception as e:
-            raise RuntimeError(e)
 
     def is_multimodal(
         self, conversation: list[dict[str, str]] | list[list[dict[str, str]]]
@@ -72,10 +613,19 @@ class InferenceEngine:
         return_dict: bool = False,
         **kwargs,
     ) -> str | list[int] | dict | list[str] | list[list[int]] | BatchEncoding:
-        if self.is_multimodal(conversation=conversation):
+        multimodal = self.is_multimodal(conversation=conversation)
+        if multimodal and self.processor_template_supported is None:
+            # decided once per model, a processor without a template always fails
+            self.processor_template_supported = (
+                getattr(self.processor, "chat_template", None) is not None
+            )
+            if not self.processor_template_supported:
+                self.logger.info("Processor has no chat template, using tokenizer")
+
+        if multimodal and self.processor_template_supported:
             # for multimodal inputs
             try:
-                return self.processor.apply_chat_template(
+                return self.processor.apply_chat_template(  # type: ignore
                     conversation=conversation,
                     add_generation_prompt=add_generation_prompt,
                     tokenize=tokenize,
@@ -84,6 +634,8 @@ class InferenceEngine:
                     **kwargs,
                 )
             except Exception:
+                # don't retry a template that fails to render on every request
+                self.processor_template_supported = False
                 self.logger.warning(
                     "Failed apply multimodal template, try to apply in text-only"
                 )
@@ -101,90 +653,1229 @@ class InferenceEngine:
         except Exception as e:
             raise RuntimeError from e
 
-    def generate_completions(
+    def _encode_prompt(self, prompt: str) -> BatchEncoding:
+        return self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
+
+    def _encode_conversation(
         self,
-        prompt: str,
+        conversation: list[dict[str, str]] | list[list[dict[str, str]]],
+        tools: list[dict] | None = None,
+    ) -> BatchEncoding:
+        options = dict(
+            add_generation_prompt=True,
+            tokenize=True,
+            return_dict=True,
+            return_tensors="pt",
+        )
+        if tools:
+            options["tools"] = tools
+        if self.template_cache is None:
+            processed_chat = self.apply_chat_template(
+                conversation=conversation, **options
+            )
+            return processed_chat.to(self.model.device)  # type: ignore
+
+        key = TemplateCache.key(conversation, **options)
+        processed_chat = self.template_cache.get(key)
+        if processed_chat is None:
+            processed_chat = self.apply_chat_template(
+                conversation=conversation, **options
+            )
+            processed_chat = processed_chat.to(self.model.device)  # type: ignore
+            self.template_cache.put(key, processed_chat)
+        return processed_chat
+
+    def _can_batch(self, model_inputs: BatchEncoding, kwargs: dict) -> bool:
+        # only text-only inputs can be padded into a shared batch
+        return not kwargs and set(model_inputs.keys()) <= {
+            "input_ids",
+            "attention_mask",
+        }
+
+    def _is_single_sequence(self, generation_config: GenerationConfig | None) -> bool:
+        """Whether generation keeps batch size 1, so a prefix cache fits as is."""
+        if generation_config is None:
+            return True
+        return (
+            (generation_config.num_beams or 1) == 1
+            and (generation_config.num_return_sequences or 1) == 1
+        )
+
+    def _num_choices(self, generation_config: GenerationConfig | None) -> int:
+        if generation_config is None:
+            return 1
+        return generation_config.num_return_sequences or 1
+
+    def _eos_token_ids(self, generation_config: GenerationConfig | None) -> set[int]:
+        eos_token_id = None
+        if generation_config is not None:
+            eos_token_id = generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = self.model.generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = self.tokenizer.eos_token_id
+        if eos_token_id is None:
+            return set()
+        if isinstance(eos_token_id, int):
+            return {eos_token_id}
+        return set(eos_token_id)
+
+    def _pad_token_id(self) -> int:
+        if self.tokenizer.pad_token_id is not None:
+            return self.tokenizer.pad_token_id
+        return self.tokenizer.eos_token_id or 0
+
+    def _trim_generated(
+        self, tokens: list[int], generation_config: GenerationConfig | None
+    ) -> list[int]:
+        """Cuts a generated row after its first EOS, or strips trailing padding."""
+        eos_token_ids = self._eos_token_ids(generation_config)
+        for i, token in enumerate(tokens):
+            if token in eos_token_ids:
+                return tokens[: i + 1]
+        # finished rows of a batch are filled with padding, e.g. on stop strings
+        pad_token_id = self._pad_token_id()
+        while tokens and tokens[-1] == pad_token_id:
+            tokens.pop()
+        return tokens
+
+    def _generate_tokens(
+        self,
+        model_inputs: BatchEncoding,
         generation_config: GenerationConfig | None = None,
         streamer: BaseStreamer | None = None,
+        best_of: int | None = None,
+        speculative: bool | None = None,
+        stats: RequestStats | None = None,
+        stop: StopSignal | None = None,
         **kwargs,
-    ) -> tuple[str, int, int]:
-        if self.settings.log.prompt:
-            self.logger.info(f"Prompt: {prompt}")
-        if self.settings.log.params:
-            self.logger.info(f"Generation config: {generation_config}")
+    ) -> list[list[int]]:
+        """
+        Runs generation for one request and returns the generated token IDs.
 
-        model_inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
+        There is one row per generated sequence. With `best_of`, all `best_of`
+        rows are returned ordered by mean token log probability, best first.
+        A `LogprobsRecorder` among the stopping criteria in `kwargs` sends the
+        request down the plain `generate` path, an echoing one scores the prompt
+        in the prefill pass first. Once `stop` is set, every path ends within a
+        decoding step and returns what was generated so far.
+        """
         input_ids = model_inputs.get("input_ids")
         assert input_ids is not None, "Input IDs are missing"
         num_prompt_tokens = len(input_ids[0])
 
-        all_outputs = self._resilient_generate(
+        generation_config, speculative_kwargs = self._speculative_kwargs(
+            generation_config, speculative, best_of
+        )
+        if speculative_kwargs:
+            return [
+                self._generate_speculative(
+                    model_inputs,
+                    generation_config,
+                    streamer,
+                    speculative_kwargs,
+                    stats or RequestStats(),
+                    stop=stop,
+                    **kwargs,
+                )
+            ]
+
+        if (
+            best_of is None
+            and self._is_single_sequence(generation_config)
+            and self._can_batch(model_inputs, kwargs)
+        ):
+            if self.prefix_cache is not None:
+                return [
+                    self._generate_with_prefix_cache(
+                        model_inputs, generation_config, streamer, stats, stop
+                    )
+                ]
+            if self.continuous is not None and self.continuous.supports(
+                generation_config
+            ):
+                return [
+                    self.continuous.submit(
+                        input_ids[0].tolist(), generation_config, streamer, stop
+                    ).result()
+                ]
+            if self.scheduler is not None and streamer is None:
+                return [
+                    self.scheduler.submit(
+                        input_ids[0].tolist(), generation_config, stop
+                    ).result()
+                ]
+
+        if best_of is not None and best_of > self._num_choices(generation_config):
+            # one shared prefill, expanded into `best_of` sampled sequences
+            generation_config = copy.deepcopy(generation_config or GenerationConfig())
+            generation_config.num_return_sequences = best_of
+            kwargs.update(output_scores=True, return_dict_in_generate=True)
+        else:
+            best_of = None
+
+        recorder = LogprobsRecorder.find(kwargs)
+        if recorder is not None and recorder.echo:
+            if self._scores_only(generation_config):
+                self._score_prompt(model_inputs, recorder)
+                if streamer is not None:
+                    streamer.put(input_ids.cpu())
+                    streamer.end()
+                return [[] for _ in range(self._num_choices(generation_config))]
+            kwargs["past_key_values"] = self._score_prompt(
+                model_inputs, recorder, self._num_choices(generation_config)
+            )
+
+        # a cache from `_score_prompt` covers the unpadded prompt
+        prompt_end = num_prompt_tokens
+        if (
+            self.buckets is not None
+            and self._can_batch(model_inputs, {})
+            and "past_key_values" not in kwargs
+        ):
+            model_inputs = self._pad_to_bucket(model_inputs)
+            prompt_end = len(model_inputs["input_ids"][0])
+        if prompt_end > num_prompt_tokens:
+            # `max_tokens` sets `max_length`, which must not count the padding
+            budget = self._new_token_budget(generation_config, num_prompt_tokens)
+            generation_config = copy.deepcopy(
+                generation_config or self.model.generation_config
+            )
+            generation_config.max_new_tokens = budget
+
+        # the budget is resolved, the offset is where generated tokens start
+        self._watch_stop(kwargs, stop, generation_config, prompt_end)
+        step_counter = self._count_steps(kwargs)
+        all_outputs = self._managed_generate(
             **model_inputs,
             generation_config=generation_config,
             streamer=streamer,
             **kwargs,
         )
         assert all_outputs is not None, "Model generation failed"
-        num_completion_tokens = len(all_outputs[0]) - num_prompt_tokens
+        if stats is not None:
+            stats.first_token = step_counter.first_step
+        sequences = (
+            all_outputs
+            if isinstance(all_outputs, torch.Tensor)
+            else all_outputs.sequences
+        )
+        generated = [
+            self._trim_generated(row, generation_config)
+            for row in sequences[:, prompt_end:].tolist()
+        ]
+        if best_of is not None:
+            order = self._rank_by_logprob(all_outputs, generated)
+            generated = [generated[i] for i in order]
+            if recorder is not None:
+                recorder.reorder(order)
+        return generated
+
+    def _speculative_kwargs(
+        self,
+        generation_config: GenerationConfig | None,
+        speculative: bool | None,
+        best_of: int | None = None,
+    ) -> tuple[GenerationConfig | None, dict]:
+        """
+        Picks the speculative decoding mode of a request.
+
+        A prompt lookup size set on the request wins over the draft model, which
+        wins over the configured prompt lookup size. `speculative=False` opts out.
+        Returns the generation config to use and extra `generate` arguments.
+        """
+        lookup = None
+        if generation_config is not None:
+            lookup = generation_config.prompt_lookup_num_tokens
+        # assisted generation only handles a single sequence
+        if (
+            speculative is False
+            or best_of is not None
+            or not self._is_single_sequence(generation_config)
+        ):
+            if lookup is not None:
+                generation_config = copy.deepcopy(generation_config)
+                generation_config.prompt_lookup_num_tokens = None  # type: ignore
+            return generation_config, {}
+
+        if lookup:
+            return generation_config, {"prompt_lookup_num_tokens": lookup}
+        if self.draft_model is not None:
+            return generation_config, {"assistant_model": self.draft_model}
+        if self.settings.model.prompt_lookup_num_tokens:
+            return generation_config, {
+                "prompt_lookup_num_tokens": self.settings.model.prompt_lookup_num_tokens
+            }
+        return generation_config, {}
+
+    def _generate_speculative(
+        self,
+        model_inputs: BatchEncoding,
+        generation_config: GenerationConfig | None,
+        streamer: BaseStreamer | None,
+        speculative_kwargs: dict,
+        stats: RequestStats,
+        stop: StopSignal | None = None,
+        **kwargs,
+    ) -> list[int]:
+        num_prompt_tokens = len(model_inputs["input_ids"][0])
+        self._watch_stop(kwargs, stop, generation_config, num_prompt_tokens)
+        step_counter = self._count_steps(kwargs)
+
+        if "assistant_model" in speculative_kwargs:
+            assert self.draft_counter is not None, "Draft model is not loaded"
+            with self.draft_counter.track() as draft_calls:
+                all_outputs = self._managed_generate(
+                    **model_inputs,
+                    generation_config=generation_config,
+                    streamer=streamer,
+                    **speculative_kwargs,
+                    **kwargs,
+                )
+                stats.draft_tokens = draft_calls()
+            stats.speculative_mode = "draft_model"
+        else:
+            all_outputs = self._managed_generate(
+                **model_inputs,
+                generation_config=generation_config,
+                streamer=streamer,
+                **speculative_kwargs,
+                **kwargs,
+            )
+            stats.speculative_mode = "prompt_lookup"
+        assert all_outputs is not None, "Model generation failed"
+        stats.target_steps = step_counter.steps
+        stats.first_token = step_counter.first_step
+
+        return self._trim_generated(
+            all_outputs[0][num_prompt_tokens:].tolist(), generation_config
+        )
+
+    def _pad_to_bucket(self, model_inputs: BatchEncoding) -> BatchEncoding:
+        """Left-pads text-only inputs to the next length bucket."""
+        assert self.buckets is not None, "Shape buckets are disabled"
+        input_ids = model_inputs["input_ids"]
+        attention_mask = model_inputs.get("attention_mask")
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        batch_size, length = input_ids.shape
+        bucket = self.buckets.length_for(length)
+        self.buckets.record(bucket, batch_size * length, batch_size * bucket)
+        if bucket == length:
+            return model_inputs
+
+        padding = (batch_size, bucket - length)
+        return BatchEncoding(
+            {
+                "input_ids": torch.cat(
+                    [input_ids.new_full(padding, self._pad_token_id()), input_ids],
+                    dim=1,
+                ),
+                "attention_mask": torch.cat(
+                    [attention_mask.new_zeros(padding), attention_mask], dim=1
+                ),
+            }
+        )
+
+    def _new_token_budget(
+        self, generation_config: GenerationConfig | None, num_prompt_tokens: int
+    ) -> int:
+        config = generation_config or self.model.generation_config
+        if config.max_new_tokens is not None:
+            return config.max_new_tokens
+        return max(config.max_length - num_prompt_tokens, 1)
+
+    def _watch_stop(
+        self,
+        kwargs: dict,
+        stop: StopSignal | None,
+        generation_config: GenerationConfig | None,
+        num_prompt_tokens: int,
+    ) -> None:
+        """Adds a `StopSignalCriteria` for `stop` to the stopping criteria."""
+        if stop is None:
+            return
+        criteria = StopSignalCriteria(
+            [stop],
+            [self._new_token_budget(generation_config, num_prompt_tokens)],
+            num_prompt_tokens,
+        )
+        stopping_criteria = kwargs.pop("stopping_criteria", None) or []
+        kwargs["stopping_criteria"] = StoppingCriteriaList(
+            [*stopping_criteria, criteria]
+        )
+
+    def _count_steps(self, kwargs: dict) -> StepCounter:
+        """Adds a `StepCounter` to the stopping criteria in `kwargs`."""
+        step_counter = StepCounter()
+        stopping_criteria = kwargs.pop("stopping_criteria", None) or []
+        kwargs["stopping_criteria"] = StoppingCriteriaList(
+            [*stopping_criteria, step_counter]
+        )
+        return step_counter
+
+    def _rank_by_logprob(self, outputs, generated: list[list[int]]) -> list[int]:
+        """Indices of the generated rows by mean token log probability, best first."""
+        scores = self.model.compute_transition_scores(
+            outputs.sequences, outputs.scores, normalize_logits=True
+        )
+        lengths = torch.tensor(
+            [max(len(tokens), 1) for tokens in generated], device=scores.device
+        )
+        positions = torch.arange(scores.shape[1], device=scores.device)
+        mask = positions[None, :] < lengths[:, None]
+        mean_logprobs = scores.masked_fill(~mask, 0).sum(dim=1) / lengths
+        return mean_logprobs.argsort(descending=True).tolist()
+
+    def _add_recorder(
+        self,
+        kwargs: dict,
+        generation_config: GenerationConfig | None,
+        logprobs: int | None,
+        echo: bool = False,
+    ) -> LogprobsRecorder | None:
+        """Adds a `LogprobsRecorder` to the `generate` arguments if one is asked for."""
+        if logprobs is None:
+            return None
+        if generation_config is not None and (generation_config.num_beams or 1) > 1:
+            raise ValueError("logprobs are not supported with beam search")
+        recorder = LogprobsRecorder(self.tokenizer, logprobs, echo=echo)
+        kwargs.update(recorder.generate_kwargs())
+        return recorder
+
+    def _add_constraint(
+        self,
+        kwargs: dict,
+        generation_config: GenerationConfig | None,
+        constraint: OutputConstraint | None,
+    ) -> None:
+        """
+        Adds a `ConstrainedLogitsProcessor` ahead of other custom processors.
+
+        The automaton is compiled here, before the request is queued, so an
+        invalid constraint raises `InvalidConstraintError` to the caller.
+        """
+        if constraint is None:
+            return
+        if generation_config is not None and (generation_config.num_beams or 1) > 1:
+            raise ValueError("response_format is not supported with beam search")
+        processor = ConstrainedLogitsProcessor(
+            self.grammar_cache.get(constraint), self._eos_token_ids(generation_config)
+        )
+        # a logprobs tap after it sees the constrained distribution
+        processors = kwargs.setdefault("logits_processor", LogitsProcessorList())
+        processors.insert(0, processor)
+
+    def _add_reasoning_budget(
+        self,
+        kwargs: dict,
+        generation_config: GenerationConfig | None,
+        max_reasoning_tokens: int | None,
+    ) -> None:
+        """Adds a `ReasoningBudgetProcessor` capping the thinking phase."""
+        if max_reasoning_tokens is None:
+            return
+        reasoning = self.settings.model.reasoning
+        if not reasoning.enabled:
+            raise ValueError("max_reasoning_tokens needs reasoning enabled")
+        if generation_config is not None and (generation_config.num_beams or 1) > 1:
+            raise ValueError("max_reasoning_tokens is not supported with beam search")
+        processor = ReasoningBudgetProcessor(
+            self.tokenizer.encode(reasoning.start, add_special_tokens=False),
+            self.tokenizer.encode(reasoning.end, add_special_tokens=False),
+            max_reasoning_tokens,
+            starts_thinking=reasoning.starts_thinking,
+        )
+        processors = kwargs.setdefault("logits_processor", LogitsProcessorList())
+        processors.append(processor)
+
+    @torch.no_grad()
+    def _score_prompt(
+        self,
+        model_inputs: BatchEncoding,
+        recorder: LogprobsRecorder,
+        num_sequences: int = 1,
+    ) -> DynamicCache:
+        """
+        Scores the prompt tokens in the prefill pass generation continues from.
+
+        The returned cache holds every prompt position but the last, `generate`
+        runs that one again to get the logits of its first step. It is repeated
+        for each of `num_sequences`, as `generate` expands the inputs.
+        """
+        cache = DynamicCache()
+        outputs = self.model(**model_inputs, past_key_values=cache, use_cache=True)
+        recorder.score_prompt(outputs.logits, model_inputs["input_ids"])
+        cache.crop(model_inputs["input_ids"].shape[1] - 1)
+        if num_sequences > 1:
+            cache.batch_repeat_interleave(num_sequences)
+        return cache
+
+    @staticmethod
+    def _scores_only(generation_config: GenerationConfig | None) -> bool:
+        """Whether an echo request asks for `max_tokens=0`, i.e. prompt scores."""
+        return (
+            generation_config is not None
+            and generation_config.max_new_tokens is None
+            and generation_config.max_length == 0
+        )
+
+    def _generate_with_prefix_cache(
+        self,
+        model_inputs: BatchEncoding,
+        generation_config: GenerationConfig | None = None,
+        streamer: BaseStreamer | None = None,
+        stats: RequestStats | None = None,
+        stop: StopSignal | None = None,
+    ) -> list[int]:
+        assert self.prefix_cache is not None, "Prefix cache is disabled"
+        input_ids = model_inputs["input_ids"][0].tolist()
+        past_key_values, _ = self.prefix_cache.lookup(input_ids)
+
+        kwargs = {}
+        if past_key_values is not None:
+            kwargs["past_key_values"] = past_key_values
+        self._watch_stop(kwargs, stop, generation_config, len(input_ids))
+        step_counter = self._count_steps(kwargs)
+        outputs = self._managed_generate(
+            **model_inputs,
+            generation_config=generation_config,
+            streamer=streamer,
+            return_dict_in_generate=True,
+            **kwargs,
+        )
+        assert outputs is not None, "Model generation failed"
+        if stats is not None:
+            stats.first_token = step_counter.first_step
+
+        # a static, quantized or offloaded cache is not stored, only plain ones
+        cache = getattr(outputs, "past_key_values", None)
+        if type(cache) is DynamicCache:
+            self.prefix_cache.insert(input_ids, cache)
+        return self._trim_generated(
+            outputs.sequences[0][len(input_ids) :].tolist(), generation_config
+        )
+
+    def _response_cache_key(
+        self,
+        model_inputs: BatchEncoding,
+        generation_config: GenerationConfig | None,
+        kwargs: dict,
+        **options,
+    ) -> str | None:
+        """Key of a deterministic text-only request, None if it cannot be cached."""
+        if self.response_cache is None or not self._can_batch(model_inputs, kwargs):
+            return None
+        # an unset config means the model defaults, which may sample
+        config = copy.deepcopy(self.model.generation_config)
+        if generation_config is not None:
+            config.update(**generation_config.to_diff_dict())
+        if not ResponseCache.cacheable(config):
+            return None
+        return ResponseCache.key(
+            model_inputs["input_ids"][0].tolist(),
+            config,
+            model=self.settings.model.model_path,
+            **options,
+        )
+
+    def _replay(
+        self,
+        model_inputs: BatchEncoding,
+        generated: list[list[int]],
+        streamer: BaseStreamer,
+    ) -> None:
+        """Pushes cached tokens through `streamer` as if they were just generated."""
+        streamer.put(model_inputs["input_ids"].cpu())
+        length = max((len(tokens) for tokens in generated), default=0)
+        if length > 0:
+            pad_token_id = self._pad_token_id()
+            rows = [
+                tokens + [pad_token_id] * (length - len(tokens)) for tokens in generated
+            ]
+            streamer.put(torch.tensor(rows))
+        streamer.end()
+
+    def _mark_generation_started(self, stats: RequestStats | None) -> None:
+        if stats is None:
+            return
+        stats.generation_started = time.perf_counter()
+        metrics.PREPROCESS.observe(stats.generation_started - stats.started)
+
+    def _cached_generate_tokens(
+        self,
+        model_inputs: BatchEncoding,
+        generation_config: GenerationConfig | None = None,
+        streamer: BaseStreamer | None = None,
+        best_of: int | None = None,
+        speculative: bool | None = None,
+        stats: RequestStats | None = None,
+        stop: StopSignal | None = None,
+        **kwargs,
+    ) -> list[list[int]]:
+        """`_generate_tokens` behind the response cache."""
+        with self._track_active():
+            self._mark_generation_started(stats)
+            key = self._response_cache_key(
+                model_inputs, generation_config, kwargs, best_of=best_of
+            )
+            if key is not None:
+                assert self.response_cache is not None
+                generated = self.response_cache.get(key)
+                if generated is not None:
+                    if streamer is not None:
+                        self._replay(model_inputs, generated, streamer)
+                    return generated
+
+            generated = self._generate_tokens(
+                model_inputs,
+                generation_config,
+                streamer,
+                best_of=best_of,
+                speculative=speculative,
+                stats=stats,
+                stop=stop,
+                **kwargs,
+            )
+            # output cut short by the stop signal is not the real response
+            if key is not None and not (stop is not None and stop.is_set()):
+                assert self.response_cache is not None
+                self.response_cache.put(key, generated)
+            return generated
+
+    def _submit_tokens(
+        self,
+        model_inputs: BatchEncoding,
+        generation_config: GenerationConfig | None = None,
+        streamer: BaseStreamer | None = None,
+        speculative: bool | None = None,
+        stats: RequestStats | None = None,
+        stop: StopSignal | None = None,
+        **kwargs,
+    ) -> Future:
+        """Starts generation in the background, the future resolves to token IDs."""
+        self._begin_active()
+        try:
+            future = self._submit_cached_tokens(
+                model_inputs,
+                generation_config,
+                streamer,
+                speculative=speculative,
+                stats=stats,
+                stop=stop,
+                **kwargs,
+            )
+        except BaseException:
+            self._end_active()
+            raise
+        future.add_done_callback(lambda _: self._end_active())
+        return future
 
-        generated_tokens = all_outputs[0][num_prompt_tokens:]
-        generated_texts = self.tokenizer.decode(
-            generated_tokens,
-            skip_special_tokens=True,
+    def _submit_cached_tokens(
+        self,
+        model_inputs: BatchEncoding,
+        generation_config: GenerationConfig | None = None,
+        streamer: BaseStreamer | None = None,
+        speculative: bool | None = None,
+        stats: RequestStats | None = None,
+        stop: StopSignal | None = None,
+        **kwargs,
+    ) -> Future:
+        self._mark_generation_started(stats)
+        # streaming never uses `best_of`, so its responses share keys with the rest
+        key = self._response_cache_key(
+            model_inputs, generation_config, kwargs, best_of=None
         )
+        response_cache = self.response_cache
+        if key is not None:
+            assert response_cache is not None
+            generated = response_cache.get(key)
+            if generated is not None:
+                if streamer is not None:
+                    self._replay(model_inputs, generated, streamer)
+                cached: Future = Future()
+                cached.set_result(generated)
+                return cached
+
+        future = self._start_tokens(
+            model_inputs,
+            generation_config,
+            streamer,
+            speculative=speculative,
+            stats=stats,
+            stop=stop,
+            **kwargs,
+        )
+        if key is not None:
+            assert response_cache is not None
+
+            def store(future: Future):
+                if stop is not None and stop.is_set():
+                    return
+                if not future.cancelled() and future.exception() is None:
+                    response_cache.put(key, future.result())
+
+            future.add_done_callback(store)
+        return future
+
+    def _start_tokens(
+        self,
+        model_inputs: BatchEncoding,
+        generation_config: GenerationConfig | None = None,
+        streamer: BaseStreamer | None = None,
+        speculative: bool | None = None,
+        stats: RequestStats | None = None,
+        stop: StopSignal | None = None,
+        **kwargs,
+    ) -> Future:
+        if (
+            self.continuous is not None
+            and self.continuous.supports(generation_config)
+            and not self._speculative_kwargs(generation_config, speculative)[1]
+            and self._is_single_sequence(generation_config)
+            and self._can_batch(model_inputs, kwargs)
+        ):
+            future = self.continuous.submit(
+                model_inputs["input_ids"][0].tolist(),
+                generation_config,
+                streamer,
+                stop,
+            )
+            return self._map_future(future, lambda tokens: [tokens])
+
+        future: Future = Future()
+
+        def run():
+            try:
+                future.set_result(
+                    self._generate_tokens(
+                        model_inputs,
+                        generation_config,
+                        streamer,
+                        speculative=speculative,
+                        stats=stats,
+                        stop=stop,
+                        **kwargs,
+                    )
+                )
+            except Exception as e:
+                if streamer is not None:
+                    streamer.end()  # unblock the consumer
+                future.set_exception(e)
+
+        Thread(target=run, daemon=True).start()
+        return future
 
+    @staticmethod
+    def _map_future(future: Future, fn) -> Future:
+        """Returns a future resolving to `fn(future.result())`."""
+        mapped: Future = Future()
+
+        def done(future: Future):
+            try:
+                mapped.set_result(fn(future.result()))
+            except Exception as e:
+                mapped.set_exception(e)
+
+        future.add_done_callback(done)
+        return mapped
+
+    def _decode_completion(self, generated_tokens: list[int]) -> str:
+        generated_text = self.tokenizer.decode(
+            generated_tokens, skip_special_tokens=True
+        )
         if self.settings.log.completion:
-            self.logger.info(f"Completion: {generated_texts}")
+            self.logger.info(f"Completion: {generated_text}")
+        return generated_text
+
+    def _build_result(
+        self,
+        generated: list[list[int]],
+        num_prompt_tokens: int,
+        num_choices: int,
+        stats: RequestStats,
+        decode: bool = True,
+        recorder: LogprobsRecorder | None = None,
+        generation_config: GenerationConfig | None = None,
+    ) -> GenerationResult:
+        """
+        Decodes the first `num_choices` rows, usage counts every generated row.
+
+        With the `generation_config` of the request, the result also tells which
+        rows stopped at their token budget rather than at EOS or a stop string.
+        """
+        stats.finished = time.perf_counter()
+        texts = []
+        logprobs = None
+        finish_reasons = []
+        if decode:
+            texts = [
+                self._decode_completion(tokens) for tokens in generated[:num_choices]
+            ]
+            # streams already handed the logprobs out step by step
+            if recorder is not None:
+                logprobs = recorder.rows(generated[:num_choices])
+        if generation_config is not None:
+            budget = self._new_token_budget(generation_config, num_prompt_tokens)
+            eos_token_ids = self._eos_token_ids(generation_config)
+            finish_reasons = [
+                (
+                    "stop"
+                    if len(tokens) < budget or (tokens and tokens[-1] in eos_token_ids)
+                    else "length"
+                )
+                for tokens in generated[:num_choices]
+            ]
+        num_completion_tokens = sum(len(tokens) for tokens in generated)
+        self._record_metrics(stats, num_prompt_tokens, num_completion_tokens)
+
+        if stats.speculative_mode is not None:
+            acceptance_rate = stats.acceptance_rate(num_completion_tokens)
+            self.logger.info(
+                f"Speculative decoding ({stats.speculative_mode}): "
+                f"{stats.accepted_tokens(num_completion_tokens)} accepted tokens "
+                f"in {stats.target_steps} steps, acceptance rate "
+                + (f"{acceptance_rate:.2%}" if acceptance_rate is not None else "n/a")
+                + f", {stats.tokens_per_second(num_completion_tokens):.1f} tokens/s"
+            )
+
+        return GenerationResult(
+            texts=texts,
+            num_prompt_tokens=num_prompt_tokens,
+            num_completion_tokens=num_completion_tokens,
+            stats=stats,
+            finish_reasons=finish_reasons,
+            logprobs=logprobs,
+            prompt_logprobs=recorder.prompt if recorder is not None else None,
+        )
+
+    def _record_metrics(
+        self, stats: RequestStats, num_prompt_tokens: int, num_completion_tokens: int
+    ) -> None:
+        if not metrics.REGISTRY.enabled:
+            return
+        metrics.PROMPT_TOKENS.inc(num_prompt_tokens)
+        metrics.COMPLETION_TOKENS.inc(num_completion_tokens)
+        # batched paths do not report their first token
+        if stats.first_token is None or stats.finished is None:
+            return
+        metrics.TIME_TO_FIRST_TOKEN.observe(stats.first_token - stats.started)
+        if stats.generation_started is not None:
+            prefill = stats.first_token - stats.generation_started
+            if prefill > 0:
+                metrics.PREFILL_THROUGHPUT.observe(num_prompt_tokens / prefill)
+        decode = stats.finished - stats.first_token
+        if num_completion_tokens > 1 and decode > 0:
+            metrics.INTER_TOKEN_LATENCY.observe(decode / (num_completion_tokens - 1))
+            metrics.DECODE_THROUGHPUT.observe((num_completion_tokens - 1) / decode)
+
+    def generate_completions(
+        self,
+        prompt: str,
+        generation_config: GenerationConfig | None = None,
+        streamer: BaseStreamer | None = None,
+        best_of: int | None = None,
+        speculative: bool | None = None,
+        logprobs: int | None = None,
+        echo: bool = False,
+        constraint: OutputConstraint | None = None,
+        stop: StopSignal | None = None,
+        **kwargs,
+    ) -> GenerationResult:
+        """
+        Completes `prompt`. `logprobs` is the number of top alternatives to
+        return with every token's log probability, None returns none. With
+        `echo` the prompt tokens are scored as well. `constraint` restricts the
+        completion to a regex or JSON schema. Setting `stop` ends generation
+        early, e.g. once the client went away.
+        """
+        stats = RequestStats()
+        if self.settings.log.prompt:
+            self.logger.info(f"Prompt: {prompt}")
+        if self.settings.log.params:
+            self.logger.info(f"Generation config: {generation_config}")
 
-        return generated_texts, num_prompt_tokens, num_completion_tokens
+        recorder = self._add_recorder(kwargs, generation_config, logprobs, echo)
+        self._add_constraint(kwargs, generation_config, constraint)
+        if recorder is not None or constraint is not None:
+            speculative = False  # assisted steps verify several tokens at once
+        model_inputs = self._encode_prompt(prompt)
+        num_prompt_tokens = len(model_inputs["input_ids"][0])
+
+        generated = self._cached_generate_tokens(
+            model_inputs,
+            generation_config,
+            streamer,
+            best_of=best_of,
+            speculative=speculative,
+            stats=stats,
+            stop=stop,
+            **kwargs,
+        )
+        return self._build_result(
+            generated,
+            num_prompt_tokens,
+            self._num_choices(generation_config),
+            stats,
+            recorder=recorder,
+            generation_config=generation_config,
+        )
 
     def generate_chat_completions(
         self,
         conversation: list[dict[str, str]] | list[list[dict[str, str]]],
         generation_config: GenerationConfig | None = None,
         streamer: BaseStreamer | None = None,
+        speculative: bool | None = None,
+        logprobs: int | None = None,
+        constraint: OutputConstraint | None = None,
+        tools: list[dict] | None = None,
+        max_reasoning_tokens: int | None = None,
+        stop: StopSignal | None = None,
         **kwargs,
-    ):
+    ) -> GenerationResult:
+        stats = RequestStats()
         if self.settings.log.prompt:
             self.logger.info(f"Conversation: {conversation}")
         if self.settings.log.params:
             self.logger.info(f"Generation Config: {generation_config}")
 
-        processed_chat = self.apply_chat_template(
-            conversation=conversation,
-            add_generation_prompt=True,
-            tokenize=True,
-            return_dict=True,
-            return_tensors="pt",
-        )
-        processed_chat.to(self.model.device)  # type: ignore
-        input_ids = processed_chat.get("input_ids")  # type: ignore
+        recorder = self._add_recorder(kwargs, generation_config, logprobs)
+        self._add_constraint(kwargs, generation_config, constraint)
+        self._add_reasoning_budget(kwargs, generation_config, max_reasoning_tokens)
+        if kwargs.get("logits_processor"):
+            speculative = False  # assisted steps verify several tokens at once
+        processed_chat = self._encode_conversation(conversation, tools)
+        input_ids = processed_chat.get("input_ids")
         assert input_ids is not None, "processed_chat produced None input_ids"
         num_prompt_tokens = len(input_ids[0])
-        # print(processed_chat)
 
-        all_outputs = self._resilient_generate(
-            **processed_chat,  # type: ignore
+        generated = self._cached_generate_tokens(
+            processed_chat,
+            generation_config,
+            streamer,
+            speculative=speculative,
+            stats=stats,
+            stop=stop,
+            **kwargs,
+        )
+        return self._build_result(
+            generated,
+            num_prompt_tokens,
+            self._num_choices(generation_config),
+            stats,
+            recorder=recorder,
             generation_config=generation_config,
-            streamer=streamer,
+        )
+
+    def stream_completions(
+        self,
+        prompt: str,
+        streamer: BaseStreamer,
+        generation_config: GenerationConfig | None = None,
+        speculative: bool | None = None,
+        logprobs: int | None = None,
+        echo: bool = False,
+        constraint: OutputConstraint | None = None,
+        stop: StopSignal | None = None,
+        **kwargs,
+    ) -> Future:
+        """
+        Starts a completion that pushes its tokens into `streamer`.
+
+        Returns a future of the `GenerationResult`. The streamer already
+        delivered the text, so `texts` is only filled when completions are logged.
+        With `logprobs`, each step's logprobs go to `streamer.put_logprobs` before
+        its tokens, and `echo` replays the scored prompt through it first.
+        """
+        stats = RequestStats()
+        if self.settings.log.prompt:
+            self.logger.info(f"Prompt: {prompt}")
+        if self.settings.log.params:
+            self.logger.info(f"Generation config: {generation_config}")
+
+        recorder = self._add_recorder(kwargs, generation_config, logprobs, echo)
+        if recorder is not None:
+            streamer = LogprobsStreamer(
+                streamer, recorder, self._num_choices(generation_config)
+            )
+            speculative = False
+        self._add_constraint(kwargs, generation_config, constraint)
+        if constraint is not None:
+            speculative = False
+
+        model_inputs = self._encode_prompt(prompt)
+        num_prompt_tokens = len(model_inputs["input_ids"][0])
+        future = self._submit_tokens(
+            model_inputs,
+            generation_config,
+            streamer,
+            speculative=speculative,
+            stats=stats,
+            stop=stop,
             **kwargs,
         )
-        assert all_outputs is not None, "Model generation failed"
-        num_completion_tokens = len(all_outputs[0]) - num_prompt_tokens
+        return self._map_future(
+            future,
+            lambda generated: self._build_result(
+                generated,
+                num_prompt_tokens,
+                self._num_choices(generation_config),
+                stats,
+                decode=self.settings.log.completion,
+                generation_config=generation_config,
+            ),
+        )
+
+    def stream_chat_completions(
+        self,
+        conversation: list[dict[str, str]] | list[list[dict[str, str]]],
+        streamer: BaseStreamer,
+        generation_config: GenerationConfig | None = None,
+        speculative: bool | None = None,
+        logprobs: int | None = None,
+        constraint: OutputConstraint | None = None,
+        tools: list[dict] | None = None,
+        max_reasoning_tokens: int | None = None,
+        stop: StopSignal | None = None,
+        **kwargs,
+    ) -> Future:
+        """
+        Starts a chat completion that pushes its tokens into `streamer`.
 
-        generated_tokens = all_outputs[0][num_prompt_tokens:]
+        Returns a future of the `GenerationResult`, see `stream_completions`.
+        """
+        stats = RequestStats()
+        if self.settings.log.prompt:
+            self.logger.info(f"Conversation: {conversation}")
+        if self.settings.log.params:
+            self.logger.info(f"Generation Config: {generation_config}")
 
-        generated_text = self.tokenizer.decode(
-            generated_tokens, skip_special_tokens=True
+        recorder = self._add_recorder(kwargs, generation_config, logprobs)
+        if recorder is not None:
+            streamer = LogprobsStreamer(
+                streamer, recorder, self._num_choices(generation_config)
+            )
+            speculative = False
+        self._add_constraint(kwargs, generation_config, constraint)
+        self._add_reasoning_budget(kwargs, generation_config, max_reasoning_tokens)
+        if kwargs.get("logits_processor"):
+            speculative = False
+
+        processed_chat = self._encode_conversation(conversation, tools)
+        num_prompt_tokens = len(processed_chat["input_ids"][0])
+        future = self._submit_tokens(
+            processed_chat,
+            generation_config,
+            streamer,
+            speculative=speculative,
+            stats=stats,
+            stop=stop,
+            **kwargs,
+        )
+        return self._map_future(
+            future,
+            lambda generated: self._build_result(
+                generated,
+                num_prompt_tokens,
+                self._num_choices(generation_config),
+                stats,
+                decode=self.settings.log.completion,
+                generation_config=generation_config,
+            ),
         )
 
-        if self.settings.log.completion:
-            self.logger.info(f"Completion: {generated_text}")
+    async def metrics_snapshots(self) -> list[dict]:
+        """Metrics recorded outside this process, none as the engine runs here."""
+        return []
+
+    async def compile_constraint(self, constraint: OutputConstraint) -> None:
+        """
+        Compiles `constraint` into the grammar cache off the event loop.
+
+        Lets endpoints reject an invalid schema or regex with
+        `InvalidConstraintError` before a streamed response has started.
+        """
+        await asyncio.to_thread(self.grammar_cache.get, constraint)
+
+    async def submit_completions(
+        self,
+        prompt: str,
+        generation_config: GenerationConfig | None = None,
+        **kwargs,
+    ) -> GenerationResult:
+        """Awaitable `generate_completions` running on the inference executor."""
+        return await self.executor.submit(
+            self.generate_completions,
+            prompt=prompt,
+            generation_config=generation_config,
+            **kwargs,
+        )
 
-        return generated_text, num_prompt_tokens, num_completion_tokens
+    async def submit_chat_completions(
+        self,
+        conversation: list[dict[str, str]] | list[list[dict[str, str]]],
+        generation_config: GenerationConfig | None = None,
+        **kwargs,
+    ) -> GenerationResult:
+        """Awaitable `generate_chat_completions` running on the inference executor."""
+        return await self.executor.submit(
+            self.generate_chat_completions,
+            conversation=conversation,
+            generation_config=generation_config,
+            **kwargs,
+        )
+
+    def generate_batch(
+        self,
+        prompts: list[str | list[dict[str, str]]],
+        generation_configs: list[GenerationConfig | None],
+    ) -> list[GenerationResult | Exception]:
+        """
+        Runs offline requests as large left-padded batches, results in order.
+
+        A string is a completion prompt, a list a conversation. Text-only single
+        sequence requests are grouped by generation config and sorted by length
+        within the `batch_jobs` limits, the others run one at a time. Every
+        batch first yields to online requests, see `_yield_to_online`, then runs
+        on the inference executor within its concurrency and queue limits.
+        """
+        results: list[GenerationResult | Exception | None] = [None] * len(prompts)
+        batcher = PaddedBatcher(
+            self,
+            self.settings.batch_jobs.max_batch_size,
+            self.settings.batch_jobs.max_padded_tokens,
+        )
+        with self._track_offline():
+            pending: list[tuple[int, _PendingRequest, RequestStats]] = []
+            singles: list[tuple[int, BatchEncoding, RequestStats]] = []
+            for index, prompt in enumerate(prompts):
+                stats = RequestStats()
+                config = generation_configs[index]
+                try:
+                    model_inputs = (
+                        self._encode_prompt(prompt)
+                        if isinstance(prompt, str)
+                        else self._encode_conversation(prompt)
+                    )
+                except Exception as e:
+                    results[index] = e
+                    continue
+                if self._is_single_sequence(config) and self._can_batch(
+                    model_inputs, {}
+                ):
+                    input_ids = model_inputs["input_ids"][0].tolist()
+                    request = _PendingRequest(input_ids, config)
+                    pending.append((index, request, stats))
+                else:
+                    singles.append((index, model_inputs, stats))
+
+            for batch in batcher._form_batches([request for _, request, _ in pending]):
+                self._yield_to_online()
+                try:
+                    self.executor.run(batcher._execute, batch)
+                except Exception as e:
+                    # the executor shut down before the batch ran
+                    for request in batch:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+            for index, request, stats in pending:
+                try:
+                    generated = [request.future.result()]
+                except Exception as e:
+                    results[index] = e
+                    continue
+                results[index] = self._build_result(
+                    generated,
+                    len(request.input_ids),
+                    1,
+                    stats,
+                    generation_config=request.generation_config,
+                )
+
+            for index, model_inputs, stats in singles:
+                config = generation_configs[index]
+                self._yield_to_online()
+                try:
+                    generated = self.executor.run(
+                        self._generate_tokens, model_inputs, config, None, stats=stats
+                    )
+                except Exception as e:
+                    results[index] = e
+                    continue
+                results[index] = self._build_result(
+                    generated,
+                    len(model_inputs["input_ids"][0]),
+                    self._num_choices(config),
+                    stats,
+                    generation_config=config,
+                )
+        return results  # type: ignore
+
+    def embed(
+        self, inputs: list[str] | list[list[int]], pooling: str | None = None
+    ) -> EmbeddingResult:
+        """Embeds texts or token ID lists, one vector per input."""
+        with self._track_active():
+            embedder = self.embedder
+            token_ids: list[list[int]] = (
+                embedder.tokenize(inputs)  # type: ignore
+                if inputs and isinstance(inputs[0], str)
+                else inputs
+            )
+            vectors = embedder.encode(
+                token_ids, pooling or self.settings.embeddings.pooling
+            )
+        return EmbeddingResult(
+            embeddings=vectors,
+            num_prompt_tokens=sum(len(ids) for ids in token_ids),
+        )
+
+    async def submit_embeddings(
+        self, inputs: list[str] | list[list[int]], pooling: str | None = None
+    ) -> EmbeddingResult:
+        """Awaitable `embed` running on the inference executor."""
+        return await self.executor.submit(self.embed, inputs=inputs, pooling=pooling)
 
     def tokenize(self, prompt: str) -> list[int]:
         return self.tokenizer.encode(prompt)
 
     def detokenize(self, tokens: list[int]) -> str:
         return self.tokenizer.decode(tokens)
+
+    def tokenize_batch(
+        self, prompts: list[str], add_special_tokens: bool = True
+    ) -> list[list[int]]:
+        """Encodes all prompts in one call, the fast tokenizer spreads it over cores."""
+        return self.tokenizer(prompts, add_special_tokens=add_special_tokens)[
+            "input_ids"
+        ]  # type: ignore
+
+    def tokenize_conversations(
+        self,
+        conversations: list[list[dict[str, str]]],
+        add_generation_prompt: bool = True,
+    ) -> list[list[int]]:
+        """Token IDs of each conversation after chat templating."""
+        token_lists = []
+        for conversation in conversations:
+            encoded = self.apply_chat_template(
+                conversation=conversation,
+                add_generation_prompt=add_generation_prompt,
+                tokenize=True,
+                return_dict=True,
+            )
+            input_ids = encoded["input_ids"]  # type: ignore
+            if hasattr(input_ids, "tolist"):
+                input_ids = input_ids.tolist()
+            if input_ids and isinstance(input_ids[0], list):
+                input_ids = input_ids[0]  # processors return a batch of one
+            token_lists.append(input_ids)
+        return token_lists
+
+    def detokenize_batch(
+        self, token_lists: list[list[int]], skip_special_tokens: bool = False
+    ) -> list[str]:
+        return self.tokenizer.batch_decode(
+            token_lists, skip_special_tokens=skip_special_tokens
+        )
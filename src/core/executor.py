@@ -0,0 +1,119 @@
+import time
+import asyncio
+import logging
+import threading
+from src.core import metrics
+from typing import Any, Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class EngineOverloadedError(RuntimeError):
+    """Raised when the inference queue is full."""
+
+
+class EngineUnavailableError(RuntimeError):
+    """Raised when the inference executor no longer accepts work."""
+
+
+class InferenceExecutor:
+    """
+    Bounded thread pool that runs blocking engine calls off the event loop.
+
+    At most `max_concurrency` calls run at once and up to `max_queue_size` more
+    wait for a worker. Anything beyond that is rejected right away instead of
+    piling up behind a long generation. Offline work goes through `run`, which
+    waits for room instead.
+    """
+
+    def __init__(
+        self, max_concurrency: int, max_queue_size: int, logger: logging.Logger
+    ) -> None:
+        self.max_concurrency = max(max_concurrency, 1)
+        self.max_queue_size = max(max_queue_size, 0)
+        self.logger = logger
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.max_concurrency, thread_name_prefix="inference"
+        )
+        # notified whenever a call finishes, for `run` waiting on a full queue
+        self._lock = threading.Condition()
+        self._outstanding = 0
+        self._closed = False
+
+    @property
+    def outstanding(self) -> int:
+        """Number of calls that are running or waiting for a worker."""
+        return self._outstanding
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of calls waiting for a worker."""
+        return max(self._outstanding - self.max_concurrency, 0)
+
+    def _release(self, future: Future) -> None:
+        with self._lock:
+            self._outstanding -= 1
+            self._lock.notify_all()
+
+    async def submit(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Runs `fn` on the pool and waits for it without blocking the loop.
+
+        Cancelling the awaiting task drops the call if it has not started yet.
+        """
+        with self._lock:
+            if self._closed:
+                raise EngineUnavailableError("Inference engine is shutting down")
+            if self._full():
+                raise EngineOverloadedError(
+                    f"Inference queue is full ({self.max_queue_size} waiting)"
+                )
+            self._outstanding += 1
+        future = self._start(fn, *args, **kwargs)
+
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if future.cancel():
+                self.logger.debug("Dropped queued inference call")
+            raise
+
+    def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Runs `fn` on the pool from a thread other than the event loop's.
+
+        Blocks until it is done. Rather than being rejected when the queue is
+        full, the call waits for room, so offline work slows down under load
+        instead of failing, while still counting against the limits.
+        """
+        with self._lock:
+            while not self._closed and self._full():
+                self._lock.wait()
+            if self._closed:
+                raise EngineUnavailableError("Inference engine is shutting down")
+            self._outstanding += 1
+        return self._start(fn, *args, **kwargs).result()
+
+    def _full(self) -> bool:
+        return self._outstanding >= self.max_concurrency + self.max_queue_size
+
+    def _start(self, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """Hands a call already counted in `outstanding` to the pool."""
+        queued = time.perf_counter()
+
+        def run():
+            metrics.QUEUE_WAIT.observe(time.perf_counter() - queued)
+            return fn(*args, **kwargs)
+
+        try:
+            future = self._pool.submit(run)
+        except RuntimeError as e:
+            self._release(None)  # type: ignore
+            raise EngineUnavailableError(str(e)) from e
+        future.add_done_callback(self._release)
+        return future
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,354 @@
+from bisect import bisect_right
+
+MAX_CODEPOINT = 0x10FFFF
+# bounded repetitions are unrolled, larger counts would blow up the automaton
+MAX_REPEAT = 1000
+MAX_STATES = 20000
+
+Intervals = tuple[tuple[int, int], ...]
+
+_DIGIT: Intervals = ((48, 57),)
+_WORD: Intervals = ((48, 57), (65, 90), (95, 95), (97, 122))
+_SPACE: Intervals = ((9, 13), (32, 32))
+_CHAR_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "0": "\0"}
+
+
+def _normalize(intervals) -> Intervals:
+    merged: list[list[int]] = []
+    for lo, hi in sorted(intervals):
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    return tuple((lo, hi) for lo, hi in merged)
+
+
+def _negate(intervals: Intervals) -> Intervals:
+    negated = []
+    start = 0
+    for lo, hi in intervals:
+        if lo > start:
+            negated.append((start, lo - 1))
+        start = hi + 1
+    if start <= MAX_CODEPOINT:
+        negated.append((start, MAX_CODEPOINT))
+    return tuple(negated)
+
+
+_CLASS_ESCAPES = {
+    "d": _DIGIT,
+    "w": _WORD,
+    "s": _SPACE,
+    "D": _negate(_DIGIT),
+    "W": _negate(_WORD),
+    "S": _negate(_SPACE),
+}
+_ANY: Intervals = _negate(((10, 10),))
+
+
+class _Parser:
+    """
+    Parses the regex subset constrained decoding supports into a syntax tree.
+
+    Literals and escapes, `.`, classes with ranges and negation, groups,
+    alternation and the greedy or lazy quantifiers `*`, `+`, `?` and `{n,m}`.
+    Anchors are accepted and ignored, the whole output always has to match.
+    Nodes are tuples: ("set", intervals), ("cat", nodes), ("alt", nodes) and
+    ("rep", node, min, max or None).
+    """
+
+    def __init__(self, pattern: str) -> None:
+        self.pattern = pattern
+        self.pos = 0
+
+    def parse(self) -> tuple:
+        node = self._alternation()
+        if self.pos < len(self.pattern):
+            self._error("unbalanced ')'")
+        return node
+
+    def _error(self, message: str):
+        raise ValueError(f"Invalid regex at position {self.pos}: {message}")
+
+    def _peek(self) -> str | None:
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def _next(self) -> str:
+        if self.pos >= len(self.pattern):
+            self._error("unexpected end")
+        char = self.pattern[self.pos]
+        self.pos += 1
+        return char
+
+    def _alternation(self) -> tuple:
+        branches = [self._sequence()]
+        while self._peek() == "|":
+            self.pos += 1
+            branches.append(self._sequence())
+        return branches[0] if len(branches) == 1 else ("alt", branches)
+
+    def _sequence(self) -> tuple:
+        items = []
+        while self._peek() not in (None, "|", ")"):
+            atom = self._atom()
+            if atom is not None:
+                items.append(self._quantified(atom))
+        return items[0] if len(items) == 1 else ("cat", items)
+
+    def _quantified(self, atom: tuple) -> tuple:
+        while True:
+            char = self._peek()
+            if char == "*":
+                bounds = (0, None)
+            elif char == "+":
+                bounds = (1, None)
+            elif char == "?":
+                bounds = (0, 1)
+            elif char == "{":
+                bounds = self._braces()
+                if bounds is None:
+                    return atom
+            else:
+                return atom
+            if char != "{":
+                self.pos += 1
+            if self._peek() == "?":
+                self.pos += 1  # lazy matching accepts the same strings
+            low, high = bounds
+            if max(low, high or 0) > MAX_REPEAT:
+                self._error(f"repetitions above {MAX_REPEAT} are not supported")
+            atom = ("rep", atom, low, high)
+
+    def _braces(self) -> tuple[int, int | None] | None:
+        """Bounds of a `{n}`, `{n,}` or `{n,m}` quantifier, None for a literal `{`."""
+        end = self.pattern.find("}", self.pos)
+        if end < 0:
+            return None
+        low, comma, high = self.pattern[self.pos + 1 : end].partition(",")
+        if not low.isdigit() or (high and not high.isdigit()):
+            return None
+        self.pos = end + 1
+        if not comma:
+            return int(low), int(low)
+        return int(low), int(high) if high else None
+
+    def _atom(self) -> tuple | None:
+        char = self._next()
+        if char == "(":
+            if self.pattern.startswith("?:", self.pos):
+                self.pos += 2
+            elif self.pattern.startswith(("?P<", "?<"), self.pos):
+                self.pos = self.pattern.index(">", self.pos) + 1
+            elif self._peek() == "?":
+                self._error("lookarounds and inline flags are not supported")
+            node = self._alternation()
+            if self._next() != ")":
+                self._error("missing ')'")
+            return node
+        if char in "^$":
+            return None
+        if char == ".":
+            return ("set", _ANY)
+        if char == "[":
+            return ("set", self._class())
+        if char == "\\":
+            return ("set", self._escape())
+        if char in "*+?":
+            self._error(f"nothing to repeat with '{char}'")
+        return ("set", ((ord(char), ord(char)),))
+
+    def _class(self) -> Intervals:
+        negated = self._peek() == "^"
+        if negated:
+            self.pos += 1
+        intervals: list[tuple[int, int]] = []
+        first = True
+        while True:
+            char = self._next()
+            if char == "]" and not first:
+                break
+            first = False
+            if char == "\\":
+                escaped = self._escape()
+                if len(escaped) != 1 or escaped[0][0] != escaped[0][1]:
+                    intervals.extend(escaped)
+                    continue
+                low = escaped[0][0]
+            else:
+                low = ord(char)
+            high = low
+            after = self.pattern[self.pos + 1 : self.pos + 2]
+            if self._peek() == "-" and after not in ("]", ""):
+                self.pos += 1
+                end = self._next()
+                high = self._escape()[0][0] if end == "\\" else ord(end)
+                if high < low:
+                    self._error("bad character range")
+            intervals.append((low, high))
+        normalized = _normalize(intervals)
+        return _negate(normalized) if negated else normalized
+
+    def _escape(self) -> Intervals:
+        char = self._next()
+        if char in _CLASS_ESCAPES:
+            return _CLASS_ESCAPES[char]
+        if char in _CHAR_ESCAPES:
+            code = ord(_CHAR_ESCAPES[char])
+        elif char in "xu":
+            digits = 2 if char == "x" else 4
+            value = self.pattern[self.pos : self.pos + digits]
+            try:
+                code = int(value, 16)
+            except ValueError:
+                self._error(f"bad \\{char} escape")
+            self.pos += digits
+        elif char.isalnum():
+            self._error(f"unsupported escape '\\{char}'")
+        else:
+            code = ord(char)
+        return ((code, code),)
+
+
+class _NFA:
+    """Thompson automaton, edges carry code point intervals."""
+
+    def __init__(self) -> None:
+        self.epsilon: list[list[int]] = []
+        self.edges: list[list[tuple[Intervals, int]]] = []
+
+    def _state(self) -> int:
+        self.epsilon.append([])
+        self.edges.append([])
+        return len(self.epsilon) - 1
+
+    def build(self, node: tuple) -> tuple[int, int]:
+        """Start and end state of a fragment matching `node`."""
+        kind = node[0]
+        start = self._state()
+        if kind == "set":
+            end = self._state()
+            self.edges[start].append((node[1], end))
+            return start, end
+        if kind == "cat":
+            end = start
+            for item in node[1]:
+                item_start, item_end = self.build(item)
+                self.epsilon[end].append(item_start)
+                end = item_end
+            return start, end
+        end = self._state()
+        if kind == "alt":
+            for branch in node[1]:
+                branch_start, branch_end = self.build(branch)
+                self.epsilon[start].append(branch_start)
+                self.epsilon[branch_end].append(end)
+            return start, end
+        _, item, low, high = node
+        current = start
+        for _ in range(low):
+            item_start, item_end = self.build(item)
+            self.epsilon[current].append(item_start)
+            current = item_end
+        if high is None:
+            item_start, item_end = self.build(item)
+            self.epsilon[current].extend([item_start, end])
+            self.epsilon[item_end].extend([item_start, end])
+            return start, end
+        for _ in range(high - low):
+            item_start, item_end = self.build(item)
+            self.epsilon[current].extend([item_start, end])
+            current = item_end
+        self.epsilon[current].append(end)
+        return start, end
+
+    def closure(self, states) -> frozenset[int]:
+        seen = set(states)
+        stack = list(states)
+        while stack:
+            for target in self.epsilon[stack.pop()]:
+                if target not in seen:
+                    seen.add(target)
+                    stack.append(target)
+        return frozenset(seen)
+
+
+class DFA:
+    """
+    Deterministic automaton of a regex over unicode code points.
+
+    Code points are split into classes that every state treats alike, so
+    `table[state][cls]` is the next state or -1. `classify` maps a character to
+    its class. State 0 is the start state.
+    """
+
+    def __init__(self, pattern: str) -> None:
+        self.pattern = pattern
+        nfa = _NFA()
+        start, end = nfa.build(_Parser(pattern).parse())
+
+        subsets = [nfa.closure([start])]
+        index = {subsets[0]: 0}
+        transitions: list[list[tuple[int, int, int]]] = []
+        while len(transitions) < len(subsets):
+            subset = subsets[len(transitions)]
+            moves = [edge for state in subset for edge in nfa.edges[state]]
+            row: list[tuple[int, int, int]] = []
+            for low, high, targets in self._partition(moves):
+                target_subset = nfa.closure(targets)
+                target = index.get(target_subset)
+                if target is None:
+                    if len(subsets) >= MAX_STATES:
+                        raise ValueError("Regex is too complex to compile")
+                    target = index[target_subset] = len(subsets)
+                    subsets.append(target_subset)
+                if row and row[-1][2] == target and row[-1][1] + 1 == low:
+                    row[-1] = (row[-1][0], high, target)
+                else:
+                    row.append((low, high, target))
+            transitions.append(row)
+        self.accepting = [end in subset for subset in subsets]
+
+        self.boundaries = sorted(
+            {low for row in transitions for low, _, _ in row}
+            | {high + 1 for row in transitions for _, high, _ in row}
+        )
+        num_classes = len(self.boundaries) + 1
+        self.table: list[list[int]] = []
+        for row in transitions:
+            targets = [-1] * num_classes
+            for low, high, target in row:
+                first = bisect_right(self.boundaries, low)
+                for cls in range(first, bisect_right(self.boundaries, high) + 1):
+                    targets[cls] = target
+            self.table.append(targets)
+
+    @staticmethod
+    def _partition(moves: list[tuple[Intervals, int]]):
+        """Disjoint code point ranges of `moves`, with the targets each reaches."""
+        points = sorted(
+            {lo for intervals, _ in moves for lo, _ in intervals}
+            | {hi + 1 for intervals, _ in moves for _, hi in intervals}
+        )
+        for low, next_low in zip(points, points[1:]):
+            targets = [
+                target
+                for intervals, target in moves
+                if any(lo <= low <= hi for lo, hi in intervals)
+            ]
+            if targets:
+                yield low, next_low - 1, targets
+
+    @property
+    def num_states(self) -> int:
+        return len(self.table)
+
+    def classify(self, char: str) -> int:
+        return bisect_right(self.boundaries, ord(char))
+
+    def matches(self, text: str) -> bool:
+        state = 0
+        for char in text:
+            state = self.table[state][self.classify(char)]
+            if state < 0:
+                return False
+        return self.accepting[state]
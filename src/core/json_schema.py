@@ -0,0 +1,229 @@
+import re
+import json
+
+# whitespace allowed between JSON tokens, a little keeps models fluent while
+# unbounded runs of it would let them stall
+WHITESPACE = r"[ ]?"
+STRING_CHAR = r'([^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})'
+STRING = rf'"{STRING_CHAR}*"'
+INTEGER = r"-?(0|[1-9][0-9]*)"
+NUMBER = rf"{INTEGER}(\.[0-9]+)?([eE][+-]?[0-9]+)?"
+BOOLEAN = r"(true|false)"
+NULL = r"null"
+FORMATS = {
+    "date": r'"[0-9]{4}-[0-9]{2}-[0-9]{2}"',
+    "time": r'"[0-9]{2}:[0-9]{2}:[0-9]{2}(\.[0-9]+)?(Z|[+-][0-9]{2}:[0-9]{2})?"',
+    "date-time": (
+        r'"[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}'
+        r'(\.[0-9]+)?(Z|[+-][0-9]{2}:[0-9]{2})?"'
+    ),
+    "uuid": (
+        r'"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+        r'[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"'
+    ),
+}
+# nesting of values a schema leaves open, e.g. `{}` or an object without
+# properties, and of `$ref`s, recursive schemas are cut off there
+ANY_DEPTH = 2
+MAX_DEPTH = 8
+
+
+def _literal(value) -> str:
+    return re.escape(json.dumps(value, ensure_ascii=False))
+
+
+def _alternatives(patterns: list[str]) -> str:
+    return "(" + "|".join(patterns) + ")"
+
+
+def any_value(depth: int = ANY_DEPTH) -> str:
+    """Any JSON value, objects and arrays nested at most `depth` deep."""
+    scalars = [STRING, NUMBER, BOOLEAN, NULL]
+    if depth <= 0:
+        return _alternatives(scalars)
+    nested = any_value(depth - 1)
+    return _alternatives(scalars + [_object_of(nested), _array(nested)])
+
+
+def any_object(depth: int = ANY_DEPTH) -> str:
+    return _object_of(any_value(depth))
+
+
+def _object_of(value: str) -> str:
+    member = rf"{STRING}{WHITESPACE}:{WHITESPACE}{value}"
+    return (
+        rf"\{{{WHITESPACE}({member}({WHITESPACE},{WHITESPACE}{member})*)?"
+        rf"{WHITESPACE}\}}"
+    )
+
+
+def _array(item: str, min_items: int = 0, max_items: int | None = None) -> str:
+    separated = rf"({WHITESPACE},{WHITESPACE}{item})"
+    if max_items is not None and max_items <= 0:
+        return rf"\[{WHITESPACE}\]"
+    more_max = "" if max_items is None else str(max_items - 1)
+    items = rf"{item}{separated}{{{max(min_items - 1, 0)},{more_max}}}"
+    if min_items == 0:
+        items = f"({items})?"
+    return rf"\[{WHITESPACE}{items}{WHITESPACE}\]"
+
+
+class SchemaConverter:
+    """
+    Converts a JSON schema into a regex of the JSON texts it accepts.
+
+    Objects list their properties in schema order, optional ones may be left
+    out and no others are allowed. Supported keywords are `type`, `enum`,
+    `const`, `anyOf`, `oneOf`, `allOf`, `$ref` into the schema itself,
+    `properties`, `required`, `additionalProperties`, `items`, `minItems`,
+    `maxItems`, `minLength`, `maxLength`, `pattern` and a few string `format`s.
+    Others, e.g. numeric bounds, are not enforced.
+    """
+
+    def __init__(self, schema: dict) -> None:
+        self.root = schema
+
+    def convert(self, schema: dict | bool | None = None, depth: int = 0) -> str:
+        if schema is None:
+            schema = self.root
+        if depth > MAX_DEPTH:
+            raise ValueError(
+                f"Schemas nested deeper than {MAX_DEPTH} are not supported"
+            )
+        if schema is True or schema == {}:
+            return any_value()
+        if not isinstance(schema, dict):
+            raise ValueError(f"Invalid schema: {schema!r}")
+
+        if "$ref" in schema:
+            return self.convert(self._resolve(schema["$ref"]), depth + 1)
+        if "const" in schema:
+            return _literal(schema["const"])
+        if "enum" in schema:
+            return _alternatives([_literal(value) for value in schema["enum"]])
+        for keyword in ("anyOf", "oneOf"):
+            if keyword in schema:
+                return _alternatives(
+                    [self.convert(option, depth + 1) for option in schema[keyword]]
+                )
+        if "allOf" in schema:
+            return self.convert(self._merge(schema["allOf"]), depth + 1)
+
+        kind = schema.get("type")
+        if isinstance(kind, list):
+            return _alternatives(
+                [self.convert({**schema, "type": name}, depth) for name in kind]
+            )
+        if kind is None:
+            if "properties" in schema:
+                kind = "object"
+            elif "items" in schema:
+                kind = "array"
+            else:
+                return any_value()
+        if kind == "object":
+            return self._object(schema, depth)
+        if kind == "array":
+            item = schema.get("items", {})
+            return _array(
+                self.convert(item, depth + 1),
+                schema.get("minItems", 0),
+                schema.get("maxItems"),
+            )
+        if kind == "string":
+            return self._string(schema)
+        scalars = {"integer": INTEGER, "number": NUMBER, "boolean": BOOLEAN}
+        if kind in scalars:
+            return scalars[kind]
+        if kind == "null":
+            return NULL
+        raise ValueError(f"Unsupported schema type: {kind!r}")
+
+    def _resolve(self, ref: str) -> dict:
+        if not ref.startswith("#"):
+            raise ValueError(f"Only local $refs are supported, got {ref!r}")
+        target = self.root
+        for part in ref[1:].split("/"):
+            if not part:
+                continue
+            part = part.replace("~1", "/").replace("~0", "~")
+            if not isinstance(target, dict) or part not in target:
+                raise ValueError(f"Unresolvable $ref {ref!r}")
+            target = target[part]
+        return target
+
+    @staticmethod
+    def _merge(schemas: list[dict]) -> dict:
+        merged: dict = {}
+        for schema in schemas:
+            for key, value in schema.items():
+                if key == "properties":
+                    merged["properties"] = {**merged.get("properties", {}), **value}
+                elif key == "required":
+                    merged["required"] = merged.get("required", []) + list(value)
+                else:
+                    merged[key] = value
+        return merged
+
+    def _object(self, schema: dict, depth: int) -> str:
+        properties = schema.get("properties") or {}
+        if not properties:
+            additional = schema.get("additionalProperties", True)
+            if additional is False:
+                return rf"\{{{WHITESPACE}\}}"
+            if additional is True:
+                return any_object()
+            return _object_of(self.convert(additional, depth + 1))
+
+        required = set(schema.get("required", []))
+        members = [
+            (
+                rf"{_literal(name)}{WHITESPACE}:{WHITESPACE}"
+                + self.convert(value, depth + 1),
+                name in required,
+            )
+            for name, value in properties.items()
+        ]
+        separator = rf"{WHITESPACE},{WHITESPACE}"
+
+        def after_first(index: int) -> str:
+            # members following one already written, each behind a comma
+            parts = []
+            for member, is_required in members[index:]:
+                part = f"{separator}{member}"
+                parts.append(part if is_required else f"({part})?")
+            return "".join(parts)
+
+        def from_first(index: int) -> str:
+            # members from `index` on, none written yet
+            if index == len(members):
+                return ""
+            member, is_required = members[index]
+            if is_required:
+                return member + after_first(index + 1)
+            rest = from_first(index + 1)
+            return _alternatives([member + after_first(index + 1), rest])
+
+        return rf"\{{{WHITESPACE}{from_first(0)}{WHITESPACE}\}}"
+
+    @staticmethod
+    def _string(schema: dict) -> str:
+        if "pattern" in schema:
+            pattern = schema["pattern"]
+            if pattern.startswith("^"):
+                pattern = pattern[1:]
+            if pattern.endswith("$") and not pattern.endswith("\\$"):
+                pattern = pattern[:-1]
+            return f'"({pattern})"'
+        if schema.get("format") in FORMATS:
+            return FORMATS[schema["format"]]
+        min_length = schema.get("minLength", 0)
+        max_length = schema.get("maxLength")
+        if min_length == 0 and max_length is None:
+            return STRING
+        bound = "" if max_length is None else str(max_length)
+        return f'"{STRING_CHAR}{{{min_length},{bound}}}"'
+
+
+def schema_to_regex(schema: dict) -> str:
+    return SchemaConverter(schema).convert()
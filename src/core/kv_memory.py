@@ -0,0 +1,227 @@
+import time
+import torch
+import logging
+import threading
+import importlib
+from dataclasses import dataclass
+from contextlib import contextmanager
+from src.core import metrics
+from config.settings import KVCacheSettings
+from src.core.executor import EngineOverloadedError
+from transformers.modeling_utils import PreTrainedModel
+
+CACHE_IMPLEMENTATIONS = ("dynamic", "static", "offloaded", "quantized")
+# packages behind `QuantizedCache`, by `kv_cache.quantized_backend`
+QUANTIZED_BACKENDS = {"quanto": "optimum.quanto", "HQQ": "hqq"}
+# recent tokens a quantized cache keeps in full precision
+QUANTIZED_RESIDUAL_LENGTH = 128
+GIB = 1024**3
+
+
+def _backend_installed(backend: str) -> bool:
+    package = QUANTIZED_BACKENDS.get(backend)
+    if package is None:
+        return False
+    try:
+        importlib.import_module(package)
+    except ImportError:
+        return False
+    return True
+
+
+class KVCacheTooLargeError(ValueError):
+    """Raised when a request's KV cache exceeds the whole budget in every form."""
+
+
+@dataclass
+class KVReservation:
+    """KV cache memory set aside for one `generate` call."""
+
+    implementation: str
+    # device bytes, 0 when the budget is unlimited
+    nbytes: int
+
+
+class KVMemoryManager:
+    """
+    Admits `generate` calls against a KV cache memory budget.
+
+    The footprint of a call follows from the model config: keys and values of
+    every layer, KV head and head dim, for each row and each token up to the
+    prompt length plus the new tokens. The first of `kv_cache.implementations`
+    whose device footprint fits into what running calls left of the budget is
+    reserved up front, so a long request starts with a quantized or offloaded
+    cache instead of falling back to one after running out of memory. When none
+    fits, the call waits for running ones to release their share.
+
+    The budget is `kv_cache.budget_gb`, or `memory_fraction` of the GPU memory
+    free once the model is loaded. Without either, e.g. on CPU, every call is
+    admitted with the first implementation.
+    """
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        settings: KVCacheSettings,
+        logger: logging.Logger,
+        headroom_bytes: int = 0,
+    ) -> None:
+        self.settings = settings
+        self.logger = logger
+        self.device = model.device
+        config = model.config
+        if hasattr(config, "get_text_config"):
+            config = config.get_text_config()  # multimodal models nest it
+        num_heads = config.num_attention_heads
+        num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+        self.num_layers = config.num_hidden_layers
+        self.dtype_bytes = torch.empty((), dtype=model.dtype).element_size()
+        # keys and values of one token in every layer
+        self.token_bytes = 2 * self.num_layers * num_kv_heads * head_dim
+        self.token_bytes *= self.dtype_bytes
+
+        self.implementations = self._available(settings.implementations)
+        self.budget = self._budget(headroom_bytes)
+        self.reserved = 0
+        self._condition = threading.Condition()
+        if self.budget is not None:
+            self.logger.info(
+                f"KV cache budget {self.budget / GIB:.2f} GiB, "
+                f"{self.token_bytes / 1024:.1f} KiB per token, "
+                f"implementations {self.implementations}"
+            )
+
+    def _available(self, names: list[str]) -> list[str]:
+        available = []
+        for name in names:
+            if name not in CACHE_IMPLEMENTATIONS:
+                raise ValueError(
+                    f"Unknown KV cache implementation '{name}', "
+                    f"use one of {CACHE_IMPLEMENTATIONS}"
+                )
+            if name == "quantized":
+                if not _backend_installed(self.settings.quantized_backend):
+                    self.logger.warning(
+                        "Quantized KV cache disabled, backend "
+                        f"'{self.settings.quantized_backend}' is not installed"
+                    )
+                    continue
+            # offloading to CPU memory saves nothing when the model runs there
+            if name == "offloaded" and self.device.type == "cpu":
+                continue
+            available.append(name)
+        return available or ["dynamic"]
+
+    def _budget(self, headroom_bytes: int) -> int | None:
+        if self.settings.budget_gb > 0:
+            return int(self.settings.budget_gb * GIB)
+        if self.device.type == "cuda":
+            free, _ = torch.cuda.mem_get_info(self.device)
+            return max(int(free * self.settings.memory_fraction) - headroom_bytes, 0)
+        return None
+
+    def footprint(self, implementation: str, num_rows: int, num_tokens: int) -> int:
+        """Device bytes of a cache of `num_rows` sequences of `num_tokens`."""
+        full = num_rows * num_tokens * self.token_bytes
+        if implementation == "quantized":
+            quantized = full * self.settings.quantized_nbits // (8 * self.dtype_bytes)
+            residual = num_rows * min(num_tokens, QUANTIZED_RESIDUAL_LENGTH)
+            return quantized + residual * self.token_bytes
+        if implementation == "offloaded":
+            # one layer computes while the next one is prefetched
+            return full * min(2, self.num_layers) // self.num_layers
+        return full
+
+    @contextmanager
+    def admit(
+        self,
+        num_rows: int,
+        num_tokens: int,
+        fixed_cache: bool = False,
+    ):
+        """
+        Yields the `KVReservation` of a call, released when the call is done.
+
+        `fixed_cache` calls come with a cache of their own or need a dynamic
+        one, e.g. assisted generation, so only the dynamic size is reserved.
+        Raises `EngineOverloadedError` after `max_wait_seconds` without memory.
+        """
+        reservation = self.reserve(num_rows, num_tokens, fixed_cache)
+        assert reservation is not None, "Waiting reservation came back empty"
+        try:
+            yield reservation
+        finally:
+            self.release(reservation)
+
+    def reserve(
+        self,
+        num_rows: int,
+        num_tokens: int,
+        fixed_cache: bool = False,
+        wait: bool = True,
+    ) -> KVReservation | None:
+        """
+        Reserves memory like `admit`, held until `release`.
+
+        Without `wait` it returns None right away when the memory is in use,
+        e.g. for a decode loop that must keep stepping its running sequences.
+        """
+        candidates = ["dynamic"] if fixed_cache else self.implementations
+        if self.budget is None:
+            metrics.KV_CACHE_ADMISSIONS.inc(implementation=candidates[0])
+            return KVReservation(candidates[0], 0)
+
+        sizes = {
+            name: self.footprint(name, num_rows, num_tokens) for name in candidates
+        }
+        smallest = min(sizes.values())
+        if smallest > self.budget:
+            raise KVCacheTooLargeError(
+                f"The KV cache of {num_rows} x {num_tokens} tokens needs "
+                f"{smallest / GIB:.2f} GiB, the budget is {self.budget / GIB:.2f} GiB"
+            )
+        return self._reserve(candidates, sizes, wait)
+
+    def release(self, reservation: KVReservation) -> None:
+        if not reservation.nbytes:
+            return
+        with self._condition:
+            self.reserved -= reservation.nbytes
+            self._condition.notify_all()
+
+    def _reserve(
+        self, candidates: list[str], sizes: dict[str, int], wait: bool
+    ) -> KVReservation | None:
+        started = time.monotonic()
+        deadline = started + self.settings.max_wait_seconds
+        with self._condition:
+            while True:
+                available = self.budget - self.reserved  # type: ignore
+                for name in candidates:
+                    if sizes[name] <= available:
+                        self.reserved += sizes[name]
+                        metrics.KV_CACHE_ADMISSIONS.inc(implementation=name)
+                        metrics.KV_ADMISSION_WAIT.observe(time.monotonic() - started)
+                        return KVReservation(name, sizes[name])
+                if not wait:
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    metrics.KV_ADMISSION_TIMEOUTS.inc()
+                    raise EngineOverloadedError(
+                        "Not enough memory for the KV cache of this request"
+                    )
+                self._condition.wait(remaining)
+
+    def generate_kwargs(self, reservation: KVReservation) -> dict:
+        """`generate` arguments selecting the reserved cache implementation."""
+        if reservation.implementation == "dynamic":
+            return {}
+        kwargs: dict = {"cache_implementation": reservation.implementation}
+        if reservation.implementation == "quantized":
+            kwargs["cache_config"] = {
+                "backend": self.settings.quantized_backend,
+                "nbits": self.settings.quantized_nbits,
+            }
+        return kwargs
@@ -1,19 +1,60 @@
+import os
+import time
 import torch
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from config.settings import AppSettings
 from transformers.modeling_utils import PreTrainedModel
 from transformers.processing_utils import ProcessorMixin
 from transformers.models.auto.processing_auto import AutoProcessor
 from transformers.models.auto.tokenization_auto import AutoTokenizer
 from transformers.utils.quantization_config import BitsAndBytesConfig
-from transformers.models.auto.modeling_auto import AutoModelForCausalLM
 from transformers.tokenization_utils_base import PreTrainedTokenizerBase
+from transformers.models.auto.modeling_auto import AutoModel, AutoModelForCausalLM
+
+
+def _torch_dtype(precision: str):
+    return {
+        "float32": torch.float32,
+        "float16": torch.float16,
+        "bfloat16": torch.bfloat16,
+        "auto": "auto",
+    }.get(precision, "auto")
+
+
+def _enable_compile_cache(cache_dir: str, logger: logging.Logger) -> None:
+    """Persists inductor and triton artifacts so restarts skip recompiling."""
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    # read when inductor compiles, so this still applies after importing torch
+    inductor_dir = os.path.join(cache_dir, "inductor")
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", inductor_dir)
+    os.environ.setdefault("TRITON_CACHE_DIR", os.path.join(cache_dir, "triton"))
+    try:
+        import torch._inductor.config as inductor_config
+
+        inductor_config.fx_graph_cache = True
+        if hasattr(inductor_config, "autotune_local_cache"):
+            inductor_config.autotune_local_cache = True
+    except ImportError:
+        logger.warning("torch inductor is unavailable, compile cache disabled")
+        return
+    logger.info(f"Compile cache directory: {cache_dir}")
+
+
+def load_tokenizer(model_path: str) -> PreTrainedTokenizerBase:
+    return AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
 
 
 def load_model_with_settings(
     settings: AppSettings,
     logger: logging.Logger,
-) -> tuple[PreTrainedModel, PreTrainedTokenizerBase, ProcessorMixin]:
+) -> tuple[PreTrainedModel, PreTrainedTokenizerBase]:
+    """
+    Loads the model and its tokenizer, the processor is loaded on demand.
+
+    The tokenizer loads on a second thread while the weights are read.
+    """
     model_path = settings.model.model_path
     precision = settings.model.precision
     device = settings.model.device
@@ -22,13 +63,11 @@ def load_model_with_settings(
         raise ValueError("Model name must be provided in the configuration")
 
     logger.info(f"Loading model {model_path}")
+    timings: dict[str, float] = {}
+    if settings.model.compile and settings.model.compile_cache_dir:
+        _enable_compile_cache(settings.model.compile_cache_dir, logger)
 
-    torch_dtype = {
-        "float32": torch.float32,
-        "float16": torch.float16,
-        "bfloat16": torch.bfloat16,
-        "auto": "auto",
-    }.get(precision, "auto")
+    torch_dtype = _torch_dtype(precision)
 
     quant_cfg = None
     if settings.model.quantization.bnb_4bit or settings.model.quantization.bnb_8bit:
@@ -43,7 +82,10 @@ def load_model_with_settings(
             bnb_4bit_use_double_quant=True,
         )
 
+    pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tokenizer-loader")
     try:
+        started = time.perf_counter()
+        tokenizer_future = pool.submit(load_tokenizer, model_path)
         if quant_cfg:
             model = AutoModelForCausalLM.from_pretrained(
                 model_path,
@@ -62,8 +104,13 @@ def load_model_with_settings(
                 low_cpu_mem_usage=True,
             )
         assert isinstance(model, PreTrainedModel)
+        timings["weights"] = time.perf_counter() - started
 
-        tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+        tokenizer = tokenizer_future.result()
+        # only the part of tokenizer loading that outlasted the weights
+        timings["tokenizer (not overlapped)"] = (
+            time.perf_counter() - started - timings["weights"]
+        )
 
         if tokenizer.pad_token is None:
             if model.config.eos_token is not None:
@@ -75,15 +122,93 @@ def load_model_with_settings(
             else:
                 logger.warning("No pad token found, using default")
 
-        processor = AutoProcessor.from_pretrained(model_path, trust_remote_code=True)
+        if settings.model.compile:
+            started = time.perf_counter()
+            # lazy, the actual compilation happens on the first forward
+            model = torch.compile(
+                model, dynamic=True, fullgraph=True, mode="reduce-overhead"
+            )
+            timings["compile setup"] = time.perf_counter() - started
+            logger.info("Model loaded and compiled successfully")
+        else:
+            logger.info("Model loaded successfully")
 
-        model = torch.compile(
-            model, dynamic=True, fullgraph=True, mode="reduce-overhead"
+        logger.info(
+            "Model load timing: "
+            + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
         )
+        return model, tokenizer  # type: ignore
 
-        logger.info("Model loaded and compiled successfully")
+    except Exception as e:
+        raise RuntimeError(f"Error initializing model and tokenizer: {e}")
+    finally:
+        pool.shutdown(wait=False)
 
-        return model, tokenizer, processor  # type: ignore
 
+def load_processor(
+    settings: AppSettings,
+    logger: logging.Logger,
+) -> ProcessorMixin | None:
+    """Loads the processor for multimodal inputs, None if the model has none."""
+    started = time.perf_counter()
+    try:
+        processor = AutoProcessor.from_pretrained(
+            settings.model.model_path, trust_remote_code=True
+        )
     except Exception as e:
-        raise RuntimeError(f"Error initializing model and tokenizer: {e}")
+        logger.warning(f"No processor available, using tokenizer only: {e}")
+        return None
+    logger.info(f"Processor loaded in {time.perf_counter() - started:.2f}s")
+    return processor  # type: ignore
+
+
+def load_draft_model(
+    settings: AppSettings,
+    logger: logging.Logger,
+) -> PreTrainedModel | None:
+    """Loads the draft model for speculative decoding, if one is configured."""
+    draft_model_path = settings.model.draft_model_path
+    if not draft_model_path:
+        return None
+
+    logger.info(f"Loading draft model {draft_model_path}")
+    try:
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            draft_model_path,
+            device_map=settings.model.device,
+            torch_dtype=_torch_dtype(settings.model.precision),
+            trust_remote_code=True,
+            low_cpu_mem_usage=True,
+        )
+        assert isinstance(draft_model, PreTrainedModel)
+        # the draft runs many short generate calls, compiling it does not pay off
+        return draft_model
+    except Exception as e:
+        raise RuntimeError(f"Error initializing draft model: {e}")
+
+
+def load_embedding_model(
+    settings: AppSettings,
+    logger: logging.Logger,
+) -> tuple[PreTrainedModel, PreTrainedTokenizerBase] | None:
+    """Loads the dedicated embedding encoder, None to reuse the generation model."""
+    model_path = settings.embeddings.model_path
+    if not model_path:
+        return None
+
+    logger.info(f"Loading embedding model {model_path}")
+    started = time.perf_counter()
+    try:
+        model = AutoModel.from_pretrained(
+            model_path,
+            device_map=settings.model.device,
+            torch_dtype=_torch_dtype(settings.model.precision),
+            trust_remote_code=True,
+            low_cpu_mem_usage=True,
+        )
+        assert isinstance(model, PreTrainedModel)
+        tokenizer = load_tokenizer(model_path)
+    except Exception as e:
+        raise RuntimeError(f"Error initializing embedding model: {e}")
+    logger.info(f"Embedding model loaded in {time.perf_counter() - started:.2f}s")
+    return model, tokenizer
@@ -0,0 +1,232 @@
+import torch
+from src.core.outputs import TokenLogprob
+from transformers.generation.streamers import BaseStreamer
+from transformers.tokenization_utils_base import PreTrainedTokenizerBase
+from transformers.generation.logits_process import LogitsProcessor, LogitsProcessorList
+from transformers.generation.stopping_criteria import (
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
+
+# stands in for -inf, e.g. of tokens masked by other processors, JSON has no infinity
+MIN_LOGPROB = -9999.0
+# prompt positions reduced at a time, bounds the float32 copy of the logits
+PROMPT_CHUNK = 512
+
+
+class _ScoreTap(LogitsProcessor):
+    """Hands the scores the other logits processors left on to the recorder."""
+
+    def __init__(self, recorder: "LogprobsRecorder") -> None:
+        self.recorder = recorder
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        self.recorder.record(scores)
+        return scores
+
+
+class LogprobsRecorder(StoppingCriteria):
+    """
+    Records the log probability of every generated token and its top alternatives.
+
+    A logits processor reduces each step's scores on the device with one batched
+    log-softmax and one top-k. The token picked from them is known once the step
+    ends, where this class runs as a stopping criterion that never stops and
+    gathers its log probability. The full vocabulary row of a step is dropped
+    right after, only the (batch, k) reductions are kept and `rows` copies them
+    to the host at once.
+
+    `generate` runs custom logits processors after penalties and before the
+    temperature, top-k and top-p warpers, so the logprobs are those of the model
+    distribution with penalties applied. With `echo`, `score_prompt` fills
+    `prompt` from the raw logits of the prefill pass.
+    """
+
+    def __init__(
+        self, tokenizer: PreTrainedTokenizerBase, num_top: int, echo: bool = False
+    ) -> None:
+        self.tokenizer = tokenizer
+        self.num_top = num_top
+        self.echo = echo
+        self.prompt: list[TokenLogprob] | None = None
+        self._step: torch.Tensor | None = None
+        self._step_top: tuple[torch.Tensor, torch.Tensor] | None = None
+        self._chosen: list[torch.Tensor] = []
+        self._top_values: list[torch.Tensor] = []
+        self._top_ids: list[torch.Tensor] = []
+        self._order: list[int] | None = None
+        self._texts: dict[int, str] = {}
+
+    @staticmethod
+    def find(kwargs: dict) -> "LogprobsRecorder | None":
+        """The recorder among the `generate` arguments in `kwargs`, if any."""
+        for criteria in kwargs.get("stopping_criteria") or []:
+            if isinstance(criteria, LogprobsRecorder):
+                return criteria
+        return None
+
+    def generate_kwargs(self) -> dict:
+        return {
+            "logits_processor": LogitsProcessorList([_ScoreTap(self)]),
+            "stopping_criteria": StoppingCriteriaList([self]),
+        }
+
+    def record(self, scores: torch.Tensor) -> None:
+        logprobs = torch.log_softmax(scores.float(), dim=-1)
+        self._step = logprobs
+        if self.num_top > 0:
+            self._step_top = logprobs.topk(self.num_top, dim=-1)
+
+    def _collect(self, tokens: torch.Tensor) -> bool:
+        """Gathers the log probabilities of the tokens picked in the pending step."""
+        if self._step is None:
+            return False
+        tokens = tokens.to(self._step.device).view(-1, 1)
+        chosen = self._step.gather(-1, tokens).squeeze(-1)
+        self._chosen.append(chosen.clamp(min=MIN_LOGPROB))
+        if self._step_top is not None:
+            values, ids = self._step_top
+            self._top_values.append(values.clamp(min=MIN_LOGPROB))
+            self._top_ids.append(ids)
+        self._step = None
+        self._step_top = None
+        return True
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> torch.BoolTensor:
+        # a streamer may have taken the step already, see `observe`
+        self._collect(input_ids[:, -1])
+        return torch.zeros(
+            input_ids.shape[0], dtype=torch.bool, device=input_ids.device
+        )  # type: ignore
+
+    def observe(self, tokens: torch.Tensor) -> list[list[TokenLogprob]]:
+        """Takes the step of the just picked `tokens` right away, for streaming."""
+        num_rows = tokens.shape[0]
+        if not self._collect(tokens):
+            return [[] for _ in range(num_rows)]
+        chosen = self._chosen[-1].tolist()
+        top_ids: list[list[int]] = [[] for _ in range(num_rows)]
+        top_values: list[list[float]] = [[] for _ in range(num_rows)]
+        if self.num_top > 0:
+            top_ids = self._top_ids[-1].tolist()
+            top_values = self._top_values[-1].tolist()
+        return [
+            [self._entry(token, chosen[row], top_ids[row], top_values[row])]
+            for row, token in enumerate(tokens.view(-1).tolist())
+        ]
+
+    def reorder(self, order: list[int]) -> None:
+        """`generate` row of each row later passed to `rows`, e.g. after ranking."""
+        self._order = order
+
+    def rows(self, generated: list[list[int]]) -> list[list[TokenLogprob]]:
+        """Entries of each generated row, rows were trimmed to their real tokens."""
+        if not self._chosen:
+            return [[] for _ in generated]
+        # one copy of the (batch, steps) and (batch, steps, k) reductions
+        chosen = torch.stack(self._chosen, dim=1).tolist()
+        top_ids = top_values = None
+        if self._top_ids:
+            top_ids = torch.stack(self._top_ids, dim=1).tolist()
+            top_values = torch.stack(self._top_values, dim=1).tolist()
+        order = self._order or list(range(len(generated)))
+        return [
+            [
+                self._entry(
+                    token,
+                    chosen[row][step],
+                    top_ids[row][step] if top_ids is not None else [],
+                    top_values[row][step] if top_values is not None else [],
+                )
+                for step, token in enumerate(tokens)
+            ]
+            for row, tokens in zip(order, generated)
+        ]
+
+    def score_prompt(self, logits: torch.Tensor, input_ids: torch.Tensor) -> None:
+        """Fills `prompt` from the prefill logits, nothing predicts the first token."""
+        token_ids = input_ids[0].tolist()
+        targets = input_ids[0, 1:].to(logits.device)
+        chosen: list[float] = []
+        top_ids: list[list[int]] = [[] for _ in token_ids[1:]]
+        top_values: list[list[float]] = [[] for _ in token_ids[1:]]
+        for start in range(0, targets.shape[0], PROMPT_CHUNK):
+            end = min(start + PROMPT_CHUNK, targets.shape[0])
+            logprobs = torch.log_softmax(logits[0, start:end].float(), dim=-1)
+            chosen.extend(
+                logprobs.gather(-1, targets[start:end, None])
+                .squeeze(-1)
+                .clamp(min=MIN_LOGPROB)
+                .tolist()
+            )
+            if self.num_top > 0:
+                values, ids = logprobs.topk(self.num_top, dim=-1)
+                top_ids[start:end] = ids.tolist()
+                top_values[start:end] = values.clamp(min=MIN_LOGPROB).tolist()
+
+        self.prompt = [
+            TokenLogprob(token_ids[0], self._token_text(token_ids[0]), None)
+        ] + [
+            self._entry(token, chosen[i], top_ids[i], top_values[i])
+            for i, token in enumerate(token_ids[1:])
+        ]
+
+    def _token_text(self, token_id: int) -> str:
+        text = self._texts.get(token_id)
+        if text is None:
+            text = self._texts[token_id] = self.tokenizer.decode([token_id])
+        return text
+
+    def _entry(
+        self,
+        token_id: int,
+        logprob: float,
+        top_ids: list[int],
+        top_values: list[float],
+    ) -> TokenLogprob:
+        return TokenLogprob(
+            token_id=token_id,
+            token=self._token_text(token_id),
+            logprob=logprob,
+            top_logprobs=[
+                TokenLogprob(top_id, self._token_text(top_id), value)
+                for top_id, value in zip(top_ids, top_values)
+            ],
+        )
+
+
+class LogprobsStreamer(BaseStreamer):
+    """
+    Passes each step's logprobs to `streamer.put_logprobs` ahead of its tokens.
+
+    With an echoing recorder, the scored prompt is first replayed as generated
+    tokens of every row, so it streams with its logprobs like the rest.
+    """
+
+    def __init__(
+        self, streamer: BaseStreamer, recorder: LogprobsRecorder, num_rows: int
+    ) -> None:
+        self.streamer = streamer
+        self.recorder = recorder
+        self.num_rows = num_rows
+        self._next_tokens_are_prompt = True
+
+    def put(self, value) -> None:
+        if self._next_tokens_are_prompt:
+            self._next_tokens_are_prompt = False
+            self.streamer.put(value)
+            prompt = self.recorder.prompt
+            if prompt is not None:
+                token_ids = [entry.token_id for entry in prompt]
+                self.streamer.put_logprobs([prompt] * self.num_rows)  # type: ignore
+                self.streamer.put(torch.tensor([token_ids] * self.num_rows))
+            return
+        self.streamer.put_logprobs(self.recorder.observe(value))  # type: ignore
+        self.streamer.put(value)
+
+    def end(self) -> None:
+        self.streamer.end()
@@ -0,0 +1,386 @@
+import time
+import torch
+import bisect
+import threading
+from transformers.generation.stopping_criteria import StoppingCriteria
+
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)  # fmt: skip
+THROUGHPUT_BUCKETS = (
+    1.0, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 500.0, 1000.0, 2500.0, 5000.0, 10000.0
+)  # fmt: skip
+
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, values):
+        escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(
+        self,
+        registry: "MetricsRegistry",
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+    ) -> None:
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _label_values(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self, others: list[dict] | None = None) -> list[str]:
+        """Exposition lines, with the `snapshot`s of other processes added in."""
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+            *self._samples(others or []),
+        ]
+
+    def snapshot(self) -> dict:
+        """Picklable values by label values, for `render` in another process."""
+        return {}
+
+    def _samples(self, others: list[dict]) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        if not self.registry.enabled:
+            return
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def _samples(self, others: list[dict]) -> list[str]:
+        values = self.snapshot()
+        for other in others:
+            for key, value in other.items():
+                values[key] = values.get(key, 0.0) + value
+        return [
+            f"{self.name}_total{_format_labels(self.labelnames, key)} "
+            f"{_format_value(value)}"
+            for key, value in values.items()
+        ]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        if not self.registry.enabled:
+            return
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self, others: list[dict]) -> list[str]:
+        # gauges are set at scrape time from the engines this process holds
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class _HistogramValue:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, num_buckets: int) -> None:
+        self.counts = [0] * num_buckets
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        registry: "MetricsRegistry",
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[tuple[str, ...], _HistogramValue] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        if not self.registry.enabled:
+            return
+        key = self._label_values(labels)
+        # non-cumulative bucket counts, summed up when rendering
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = _HistogramValue(len(self.buckets) + 1)
+            histogram.counts[index] += 1
+            histogram.sum += value
+            histogram.count += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                key: (list(histogram.counts), histogram.sum, histogram.count)
+                for key, histogram in self._values.items()
+            }
+
+    def _samples(self, others: list[dict]) -> list[str]:
+        values = self.snapshot()
+        for other in others:
+            for key, (counts, total, count) in other.items():
+                if key not in values:
+                    values[key] = (counts, total, count)
+                    continue
+                own_counts, own_total, own_count = values[key]
+                merged = [a + b for a, b in zip(own_counts, counts)]
+                values[key] = (merged, own_total + total, own_count + count)
+
+        samples = []
+        for key, (counts, total, count) in values.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                labels = _format_labels(
+                    (*self.labelnames, "le"), (*key, _format_value(bound))
+                )
+                samples.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            samples.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            samples.append(f"{self.name}_count{labels} {count}")
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Minimal Prometheus registry rendering the text exposition format.
+
+    Recording is a no-op until the registry is enabled, so instrumented code
+    costs one attribute check per call when metrics are turned off.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric) -> None:
+        self._metrics.append(metric)
+
+    def render(self, snapshots: list[dict[str, dict]] | None = None) -> str:
+        """
+        The text exposition of every metric.
+
+        `snapshots` of other processes' registries, e.g. data parallel workers,
+        are added to the counters and histograms of this one.
+        """
+        lines = []
+        for metric in self._metrics:
+            others = [snapshot.get(metric.name, {}) for snapshot in snapshots or []]
+            lines.extend(metric.render(others))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict[str, dict]:
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+
+class StepCounter(StoppingCriteria):
+    """
+    Stopping criteria that never stops, it counts decoding steps instead.
+
+    Stopping criteria run once per target model forward, so the first call marks
+    the first generated token. With assisted generation every step verifies a
+    batch of candidate tokens.
+    """
+
+    def __init__(self) -> None:
+        self.steps = 0
+        self.first_step: float | None = None
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> torch.BoolTensor:
+        if self.first_step is None:
+            self.first_step = time.perf_counter()
+        self.steps += 1
+        return torch.zeros(
+            input_ids.shape[0], dtype=torch.bool, device=input_ids.device
+        )  # type: ignore
+
+
+REGISTRY = MetricsRegistry()
+
+REQUESTS = Counter(
+    REGISTRY,
+    "transapi_requests",
+    "Requests handled, by endpoint and outcome.",
+    ("endpoint", "outcome"),
+)
+REQUEST_LATENCY = Histogram(
+    REGISTRY,
+    "transapi_request_duration_seconds",
+    "Time from receiving a request to sending its last byte.",
+    ("endpoint",),
+)
+QUEUE_WAIT = Histogram(
+    REGISTRY,
+    "transapi_queue_wait_seconds",
+    "Time a request waited for an inference worker.",
+)
+PREPROCESS = Histogram(
+    REGISTRY,
+    "transapi_preprocess_seconds",
+    "Time spent templating and tokenizing a request.",
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    REGISTRY,
+    "transapi_time_to_first_token_seconds",
+    "Time from the engine picking up a request to its first generated token.",
+)
+INTER_TOKEN_LATENCY = Histogram(
+    REGISTRY,
+    "transapi_inter_token_latency_seconds",
+    "Mean time between generated tokens of a request.",
+)
+PREFILL_THROUGHPUT = Histogram(
+    REGISTRY,
+    "transapi_prefill_tokens_per_second",
+    "Prompt tokens processed per second during prefill.",
+    buckets=THROUGHPUT_BUCKETS,
+)
+DECODE_THROUGHPUT = Histogram(
+    REGISTRY,
+    "transapi_decode_tokens_per_second",
+    "Generated tokens per second after the first token.",
+    buckets=THROUGHPUT_BUCKETS,
+)
+PROMPT_TOKENS = Counter(
+    REGISTRY, "transapi_prompt_tokens", "Prompt tokens of finished requests."
+)
+COMPLETION_TOKENS = Counter(
+    REGISTRY, "transapi_completion_tokens", "Generated tokens of finished requests."
+)
+OOM_ERRORS = Counter(
+    REGISTRY,
+    "transapi_oom_errors",
+    "Generations that ran out of memory although their KV cache was admitted.",
+)
+KV_CACHE_ADMISSIONS = Counter(
+    REGISTRY,
+    "transapi_kv_cache_admissions",
+    "Generations admitted by the KV memory manager, by cache implementation.",
+    ("implementation",),
+)
+KV_ADMISSION_WAIT = Histogram(
+    REGISTRY,
+    "transapi_kv_admission_wait_seconds",
+    "Time generations waited for KV cache memory.",
+)
+KV_ADMISSION_TIMEOUTS = Counter(
+    REGISTRY,
+    "transapi_kv_admission_timeouts",
+    "Generations rejected after waiting `kv_cache.max_wait_seconds` for memory.",
+)
+KV_RESERVED_BYTES = Gauge(
+    REGISTRY,
+    "transapi_kv_reserved_bytes",
+    "KV cache memory reserved by running generations.",
+    ("model",),
+)
+GRAMMAR_COMPILE_SECONDS = Histogram(
+    REGISTRY,
+    "transapi_grammar_compile_seconds",
+    "Time compiling a schema or regex not in the grammar cache into a token automaton.",
+)
+QUEUE_DEPTH = Gauge(
+    REGISTRY,
+    "transapi_queue_depth",
+    "Requests waiting for an inference worker.",
+    ("model",),
+)
+OUTSTANDING = Gauge(
+    REGISTRY,
+    "transapi_outstanding_requests",
+    "Requests running or waiting on the inference executor.",
+    ("model",),
+)
+CACHE_HITS = Gauge(
+    REGISTRY,
+    "transapi_cache_hits",
+    "Lookups served from a cache.",
+    ("model", "cache"),
+)
+CACHE_MISSES = Gauge(
+    REGISTRY,
+    "transapi_cache_misses",
+    "Lookups that missed a cache.",
+    ("model", "cache"),
+)
+BUCKET_TOKENS = Counter(
+    REGISTRY,
+    "transapi_bucket_tokens",
+    "Tokens of bucket-padded inputs, by length bucket and real or padding.",
+    ("bucket", "kind"),
+)
+COMPILED_GRAPHS = Gauge(
+    REGISTRY, "transapi_compiled_graphs", "Graphs compiled by torch.compile."
+)
+RECOMPILES = Gauge(
+    REGISTRY,
+    "transapi_recompiles",
+    "Graphs compiled while serving, after startup warmup finished.",
+    ("model",),
+)
+RESIDENT_MODELS = Gauge(
+    REGISTRY, "transapi_resident_models", "Models with their weights on the device."
+)
+STOPPED_GENERATIONS = Counter(
+    REGISTRY,
+    "transapi_stopped_generations",
+    "Generations ended early by their request's stop signal, by reason.",
+    ("reason",),
+)
+STOPPED_TOKENS_SAVED = Counter(
+    REGISTRY,
+    "transapi_stopped_tokens_saved",
+    "Tokens left of the budget of generations ended early, by reason.",
+    ("reason",),
+)
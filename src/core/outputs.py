@@ -0,0 +1,81 @@
+import time
+import numpy as np
+from dataclasses import dataclass, field
+
+
+@dataclass
+class RequestStats:
+    """Measurements collected while serving one request."""
+
+    started: float = field(default_factory=time.perf_counter)
+    # after templating and tokenization, when generation was handed the request
+    generation_started: float | None = None
+    first_token: float | None = None
+    finished: float | None = None
+    # "draft_model" or "prompt_lookup" when the request used speculative decoding
+    speculative_mode: str | None = None
+    # Target model forward passes, each one accepts one or more tokens
+    target_steps: int = 0
+    # Candidate tokens proposed by the draft model, unknown for prompt lookup
+    draft_tokens: int | None = None
+
+    @property
+    def elapsed(self) -> float:
+        finished = self.finished if self.finished is not None else time.perf_counter()
+        return finished - self.started
+
+    def tokens_per_second(self, num_tokens: int) -> float:
+        return num_tokens / self.elapsed if self.elapsed > 0 else 0.0
+
+    def accepted_tokens(self, num_tokens: int) -> int:
+        """Generated tokens beyond the one every target step yields on its own."""
+        return max(num_tokens - self.target_steps, 0)
+
+    def acceptance_rate(self, num_tokens: int) -> float | None:
+        if not self.draft_tokens:
+            return None
+        return self.accepted_tokens(num_tokens) / self.draft_tokens
+
+
+@dataclass
+class TokenLogprob:
+    """Log probability of one token, with the most likely tokens at its position."""
+
+    token_id: int
+    token: str
+    # None for the first prompt token, nothing predicts it
+    logprob: float | None
+    top_logprobs: list["TokenLogprob"] = field(default_factory=list)
+
+
+@dataclass
+class GenerationResult:
+    """Outcome of one generation request."""
+
+    # One text per returned sequence, in choice order
+    texts: list[str]
+    num_prompt_tokens: int
+    # Summed over every generated sequence, including discarded `best_of` ones
+    num_completion_tokens: int
+    stats: RequestStats = field(default_factory=RequestStats)
+    # One per returned sequence when known, "length" if it used up its budget
+    finish_reasons: list[str] = field(default_factory=list)
+    # One list per returned sequence when logprobs were requested
+    logprobs: list[list[TokenLogprob]] | None = None
+    # The prompt tokens with `echo`, the first one has no logprob
+    prompt_logprobs: list[TokenLogprob] | None = None
+
+    def finish_reason(self, index: int) -> str:
+        """Of sequence `index`, "length" if it used up its token budget."""
+        if index < len(self.finish_reasons):
+            return self.finish_reasons[index]
+        return "stop"
+
+
+@dataclass
+class EmbeddingResult:
+    """Outcome of one embeddings request."""
+
+    # One float32 row per input, in input order
+    embeddings: np.ndarray
+    num_prompt_tokens: int
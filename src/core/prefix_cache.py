@@ -0,0 +1,178 @@
+import torch
+import logging
+import threading
+from collections import OrderedDict
+from transformers.cache_utils import DynamicCache
+from src.core.cache_utils import build_cache, cache_tensors
+
+
+class _Node:
+    """Radix tree node, `edge` holds the token IDs leading here from the parent."""
+
+    __slots__ = ("edge", "parent", "children", "depth", "tensors", "nbytes")
+
+    def __init__(self, edge: tuple[int, ...], parent: "_Node | None") -> None:
+        self.edge = edge
+        self.parent = parent
+        self.children: dict[int, _Node] = {}
+        self.depth = (parent.depth if parent is not None else 0) + len(edge)
+        # past key values for the `depth` tokens from the root to this node
+        self.tensors: list[tuple[torch.Tensor, torch.Tensor]] | None = None
+        self.nbytes = 0
+
+
+def _common_prefix(edge: tuple[int, ...], tokens: list[int], start: int) -> int:
+    length = 0
+    for token, other in zip(edge, tokens[start:]):
+        if token != other:
+            break
+        length += 1
+    return length
+
+
+class PrefixCache:
+    """
+    Radix tree over prompt token IDs that stores past key values per prompt.
+
+    A lookup returns the cache of the longest stored prefix shared with the new
+    prompt, so `generate` only has to prefill the remaining suffix. Entries are
+    evicted least recently used first once their total size exceeds the budget.
+    """
+
+    def __init__(self, budget_bytes: int, logger: logging.Logger) -> None:
+        self.budget_bytes = budget_bytes
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.total_bytes = 0
+        self._root = _Node((), None)
+        self._lru: OrderedDict[_Node, None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "reused_tokens": self.reused_tokens,
+            "entries": len(self._lru),
+            "bytes": self.total_bytes,
+        }
+
+    def lookup(self, input_ids: list[int]) -> tuple[DynamicCache | None, int]:
+        """
+        Returns a cache for the longest reusable prefix of `input_ids` and its length.
+
+        At least the last prompt token is always left for prefill.
+        """
+        with self._lock:
+            node, matched = self._match(input_ids)
+            entry = self._find_entry(node)
+            reusable = min(matched, len(input_ids) - 1)
+            if entry is None or entry.tensors is None or reusable <= 0:
+                self.misses += 1
+                return None, 0
+
+            self._lru.move_to_end(entry)
+            self.hits += 1
+            self.reused_tokens += reusable
+            # slicing makes views, `generate` concatenates onto new tensors
+            cache = build_cache(
+                [
+                    (key[:, :, :reusable], value[:, :, :reusable])
+                    for key, value in entry.tensors
+                ]
+            )
+        self.logger.debug(f"Prefix cache hit, reusing {reusable} tokens")
+        return cache, reusable
+
+    def insert(self, input_ids: list[int], cache: DynamicCache) -> None:
+        """Stores the first `len(input_ids)` positions of `cache` for `input_ids`."""
+        length = len(input_ids)
+        tensors = [
+            (key[:, :, :length].clone(), value[:, :, :length].clone())
+            for key, value in cache_tensors(cache)
+        ]
+        nbytes = sum(
+            key.numel() * key.element_size() + value.numel() * value.element_size()
+            for key, value in tensors
+        )
+        if nbytes > self.budget_bytes:
+            return
+
+        with self._lock:
+            node = self._insert_node(input_ids)
+            if node.tensors is None:
+                node.tensors = tensors
+                node.nbytes = nbytes
+                self.total_bytes += nbytes
+            self._lru[node] = None
+            self._lru.move_to_end(node)
+            self._evict()
+
+    def _match(self, input_ids: list[int]) -> tuple[_Node, int]:
+        """Walks down the tree, returns the deepest node reached and match length."""
+        node = self._root
+        matched = 0
+        while matched < len(input_ids):
+            child = node.children.get(input_ids[matched])
+            if child is None:
+                break
+            common = _common_prefix(child.edge, input_ids, matched)
+            matched += common
+            node = child
+            if common < len(child.edge):
+                # every entry below `child` still shares the first `matched` tokens
+                break
+        return node, matched
+
+    def _find_entry(self, node: _Node) -> _Node | None:
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if current.tensors is not None:
+                return current
+            stack.extend(current.children.values())
+        return None
+
+    def _insert_node(self, input_ids: list[int]) -> _Node:
+        node = self._root
+        matched = 0
+        while matched < len(input_ids):
+            child = node.children.get(input_ids[matched])
+            if child is None:
+                leaf = _Node(tuple(input_ids[matched:]), node)
+                node.children[input_ids[matched]] = leaf
+                return leaf
+            common = _common_prefix(child.edge, input_ids, matched)
+            if common < len(child.edge):
+                child = self._split(child, common)
+            matched += common
+            node = child
+        return node
+
+    def _split(self, node: _Node, length: int) -> _Node:
+        """Splits `node`'s edge after `length` tokens and returns the new upper node."""
+        parent = node.parent
+        assert parent is not None, "Cannot split the root node"
+        upper = _Node(node.edge[:length], parent)
+        parent.children[upper.edge[0]] = upper
+        node.edge = node.edge[length:]
+        node.parent = upper
+        upper.children[node.edge[0]] = node
+        return upper
+
+    def _evict(self) -> None:
+        while self.total_bytes > self.budget_bytes and self._lru:
+            node, _ = self._lru.popitem(last=False)
+            self.total_bytes -= node.nbytes
+            node.tensors = None
+            node.nbytes = 0
+            self._prune(node)
+
+    def _prune(self, node: _Node) -> None:
+        while (
+            node.parent is not None and node.tensors is None and not node.children
+        ):
+            del node.parent.children[node.edge[0]]
+            node = node.parent
@@ -0,0 +1,85 @@
+import torch
+from transformers.generation.logits_process import LogitsProcessor
+
+
+class _Row:
+    """Thinking phase of one generated sequence."""
+
+    def __init__(self, thinking: bool) -> None:
+        self.thinking = thinking
+        self.spent = 0
+        # tokens of the end tag forced so far, None while not forcing
+        self.forced: int | None = None
+        self.done = False
+
+
+class ReasoningBudgetProcessor(LogitsProcessor):
+    """
+    Ends the thinking phase of rows that spent `budget` tokens on it.
+
+    A row thinks from the start tag, or from the first step when the chat
+    template already opened it, to the end tag. Once it spent the budget, the
+    tokens of the end tag are forced one per step and the row continues with
+    its answer. Forcing overwrites the scores rather than masking them, so it
+    holds up against other processors having masked the tag.
+    """
+
+    def __init__(
+        self,
+        start_ids: list[int],
+        end_ids: list[int],
+        budget: int,
+        starts_thinking: bool = False,
+    ) -> None:
+        self.start_ids = start_ids
+        self.end_ids = end_ids
+        self.budget = budget
+        self.starts_thinking = starts_thinking
+        self._rows: list[_Row] | None = None
+        self._window = max(len(start_ids), len(end_ids), 1)
+        self._generated = 0
+
+    def _update(self, row: _Row, recent: list[int]) -> None:
+        if row.done:
+            return
+        if row.forced is not None:
+            row.forced += 1
+            if row.forced == len(self.end_ids):
+                row.done = True
+        elif row.thinking:
+            row.spent += 1
+            if recent[-len(self.end_ids) :] == self.end_ids:
+                row.done = True
+        elif self.start_ids and recent[-len(self.start_ids) :] == self.start_ids:
+            row.thinking = True
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        if self._rows is None:
+            self._rows = [_Row(self.starts_thinking) for _ in range(input_ids.shape[0])]
+        else:
+            self._generated += 1
+            # tags are matched within the generated tokens only
+            window = min(self._window, self._generated)
+            for row, recent in zip(self._rows, input_ids[:, -window:].tolist()):
+                self._update(row, recent)
+
+        forced_rows: list[int] = []
+        forced_tokens: list[int] = []
+        for index, row in enumerate(self._rows):
+            if not row.thinking or row.done or not self.end_ids:
+                continue
+            if row.forced is None and row.spent >= self.budget:
+                row.forced = 0
+            if row.forced is not None:
+                forced_rows.append(index)
+                forced_tokens.append(self.end_ids[row.forced])
+        if not forced_rows:
+            return scores
+        rows = torch.tensor(forced_rows, device=scores.device)
+        tokens = torch.tensor(forced_tokens, device=scores.device)
+        scores = scores.clone()  # type: ignore
+        scores[rows] = float("-inf")
+        scores[rows, tokens] = 0.0
+        return scores
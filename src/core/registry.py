@@ -0,0 +1,240 @@
+import gc
+import torch
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from src.core.engine import InferenceEngine
+from src.core.workers import DataParallelEngine
+from config.settings import AppSettings, ModelSettings
+
+
+class ModelNotFoundError(KeyError):
+    """Raised when a request names a model that is not configured."""
+
+
+class _Entry:
+    """A configured model and, while loaded, its engine."""
+
+    def __init__(self, name: str, settings: AppSettings) -> None:
+        self.name = name
+        self.settings = settings
+        self.engine: InferenceEngine | DataParallelEngine | None = None
+        self.offloaded = False
+        self.footprint = 0
+        # requests holding the engine, it is not evicted while they do
+        self.leases = 0
+        # set by `_evict` under the registry lock, new leases wait for it
+        self.evicting = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.engine is None:
+            return "unloaded"
+        return "offloaded" if self.offloaded else "resident"
+
+
+class ModelRegistry:
+    """
+    Routes requests to one engine per configured model.
+
+    The default model (`model` in the config) is loaded on start, the models
+    under `models` on their first request. Once more than `max_resident_models`
+    are resident or their weights exceed `memory_budget_gb`, the least recently
+    used idle model is offloaded to CPU or released, per `eviction`. A model is
+    idle when no request holds a lease on it from `get` and its engine is not
+    busy.
+    """
+
+    def __init__(self, settings: AppSettings, logger: logging.Logger) -> None:
+        self.settings = settings
+        self.logger = logger
+        self.default_name = settings.model.model_path.split("/")[-1]
+        self._entries: dict[str, _Entry] = {
+            self.default_name: _Entry(self.default_name, settings)
+        }
+        for name, model_settings in settings.models.items():
+            self._entries[name] = _Entry(name, self._model_settings(model_settings))
+        # served model names are aliases of the default model
+        self._aliases = {
+            name: self.default_name
+            for name in settings.server.served_model_names or []
+        }
+        self._lru: OrderedDict[str, None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _model_settings(self, model_settings: ModelSettings) -> AppSettings:
+        return self.settings.model_copy(update={"model": model_settings})
+
+    @property
+    def multi_model(self) -> bool:
+        return len(self._entries) > 1
+
+    def names(self) -> list[str]:
+        """Every name a request may use, aliases first."""
+        names = list(self._aliases)
+        names.extend(name for name in self._entries if name not in names)
+        return names
+
+    def status(self) -> dict[str, str]:
+        """Residency state per model name, including aliases."""
+        return {
+            name: self._entries[self._aliases.get(name, name)].state
+            for name in self.names()
+        }
+
+    def resident(self) -> dict[str, InferenceEngine | DataParallelEngine]:
+        """Engines whose weights are on the device, by model name."""
+        return {
+            name: entry.engine
+            for name, entry in self._entries.items()
+            if entry.engine is not None and not entry.offloaded
+        }
+
+    def resolve(self, model: str | None) -> str:
+        """
+        Maps a requested model name to a configured one.
+
+        With a single model any name is served by it, as before the registry.
+        """
+        if model is None:
+            return self.default_name
+        name = self._aliases.get(model, model)
+        if name in self._entries:
+            return name
+        if not self.multi_model:
+            return self.default_name
+        raise ModelNotFoundError(model)
+
+    def load_default(self) -> InferenceEngine | DataParallelEngine:
+        return self._acquire(self.default_name, lease=False)
+
+    async def get(self, model: str | None) -> InferenceEngine | DataParallelEngine:
+        """
+        Returns the engine for `model`, loading it off the event loop if needed.
+
+        The engine is leased to the caller and stays resident until `release`
+        is called with the same `model`.
+        """
+        name = self.resolve(model)
+        entry = self._entries[name]
+        with self._lock:
+            if entry.engine is not None and not entry.offloaded and not entry.evicting:
+                entry.leases += 1
+                self._lru[name] = None
+                self._lru.move_to_end(name)
+                return entry.engine
+        return await asyncio.to_thread(self._acquire, name)
+
+    def release(self, model: str | None) -> None:
+        """Ends a lease taken by `get`."""
+        entry = self._entries[self.resolve(model)]
+        with self._lock:
+            entry.leases = max(entry.leases - 1, 0)
+
+    def close(self) -> None:
+        for entry in self._entries.values():
+            with entry.lock:
+                if entry.engine is not None:
+                    entry.engine.close()
+                    entry.engine = None
+
+    def _touch(self, name: str) -> None:
+        with self._lock:
+            self._lru[name] = None
+            self._lru.move_to_end(name)
+
+    def _acquire(
+        self, name: str, lease: bool = True
+    ) -> InferenceEngine | DataParallelEngine:
+        entry = self._entries[name]
+        with entry.lock:
+            if entry.engine is None:
+                self._make_room(exclude=name)
+                self.logger.info(f"Loading model '{name}'")
+                entry.engine = self._create_engine(entry.settings)
+                entry.offloaded = False
+                entry.footprint = entry.engine.memory_footprint()
+            elif entry.offloaded:
+                self._make_room(exclude=name)
+                self.logger.info(f"Restoring model '{name}'")
+                entry.engine.restore()
+                entry.offloaded = False
+            engine = entry.engine
+            # taken while holding the entry lock, so no eviction comes in between
+            if lease:
+                with self._lock:
+                    entry.leases += 1
+        self._touch(name)
+        self._make_room(exclude=name, reserve=False)
+        return engine
+
+    def _create_engine(
+        self, settings: AppSettings
+    ) -> InferenceEngine | DataParallelEngine:
+        if settings.data_parallel.workers > 1:
+            return DataParallelEngine(settings, self.logger)
+        return InferenceEngine(settings, self.logger)
+
+    def _over_budget(self, reserve: bool) -> bool:
+        resident = [
+            entry
+            for entry in self._entries.values()
+            if entry.engine is not None and not entry.offloaded
+        ]
+        # `reserve` keeps a slot free for a model about to become resident
+        count = len(resident) + (1 if reserve else 0)
+        max_resident = self.settings.registry.max_resident_models
+        if max_resident > 0 and count > max_resident:
+            return True
+        budget = self.settings.registry.memory_budget_gb * 1024**3
+        return budget > 0 and sum(entry.footprint for entry in resident) > budget
+
+    def _make_room(self, exclude: str, reserve: bool = True) -> None:
+        while self._over_budget(reserve):
+            with self._lock:
+                candidates = [
+                    name
+                    for name in self._lru
+                    if name != exclude
+                    and self._entries[name].engine is not None
+                    and not self._entries[name].offloaded
+                    and not self._entries[name].leases
+                    and not self._entries[name].engine.busy  # type: ignore
+                ]
+            if not any(self._evict(name) for name in candidates):
+                self.logger.warning(
+                    "Model memory budget exceeded, but every other model is in use"
+                )
+                return
+
+    def _evict(self, name: str) -> bool:
+        entry = self._entries[name]
+        # a model being loaded or evicted elsewhere is skipped, never waited for
+        if not entry.lock.acquire(blocking=False):
+            return False
+        try:
+            engine = entry.engine
+            with self._lock:
+                if engine is None or entry.offloaded or entry.leases or engine.busy:
+                    return False
+                entry.evicting = True
+            if self.settings.registry.eviction == "offload" and engine.offload():
+                self.logger.info(f"Offloaded model '{name}' to CPU")
+                entry.offloaded = True
+                return True
+            engine.close()
+            entry.engine = None
+            entry.footprint = 0
+        finally:
+            entry.evicting = False
+            entry.lock.release()
+        with self._lock:
+            self._lru.pop(name, None)
+        del engine
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        self.logger.info(f"Released model '{name}'")
+        return True
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from transformers.generation.configuration_utils import GenerationConfig
+
+
+class _Entry:
+    __slots__ = ("generated", "created", "num_tokens")
+
+    def __init__(self, generated: list[list[int]], created: float) -> None:
+        self.generated = generated
+        self.created = created
+        self.num_tokens = sum(len(tokens) for tokens in generated)
+
+
+class ResponseCache:
+    """
+    LRU cache of generated token IDs for deterministic requests.
+
+    Entries are keyed on the prompt token IDs and the normalized generation
+    config, so any request that would decode the same tokens again is served
+    without running the model. Entries expire after `ttl` seconds and are
+    evicted least recently used first once there are more than `max_entries` of
+    them or they hold more than `max_tokens` generated tokens in total. With a
+    `persist_path` the cache is loaded on start and written back on `save`.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        max_tokens: int,
+        ttl: float,
+        logger: logging.Logger,
+        persist_path: str | None = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_tokens = max_tokens
+        self.ttl = ttl
+        self.logger = logger
+        self.persist_path = persist_path
+        self.hits = 0
+        self.misses = 0
+        self.total_tokens = 0
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+        if persist_path is not None:
+            self._load()
+
+    @staticmethod
+    def cacheable(generation_config: GenerationConfig) -> bool:
+        """Only configs without sampling decode the same tokens every time."""
+        return not generation_config.do_sample
+
+    @staticmethod
+    def key(
+        input_ids: list[int], generation_config: GenerationConfig, **options
+    ) -> str:
+        canonical = json.dumps(
+            {
+                "input_ids": input_ids,
+                "generation_config": generation_config.to_diff_dict(),
+                "options": options,
+            },
+            sort_keys=True,
+            separators=(",", ":"),
+            default=str,
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, key: str) -> list[list[int]] | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return [list(tokens) for tokens in entry.generated]
+
+    def put(self, key: str, generated: list[list[int]]) -> None:
+        entry = _Entry([list(tokens) for tokens in generated], time.time())
+        if entry.num_tokens > self.max_tokens:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.total_tokens += entry.num_tokens
+            self._evict()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "tokens": self.total_tokens,
+        }
+
+    def save(self) -> None:
+        """Writes the unexpired entries to `persist_path`, oldest first."""
+        if self.persist_path is None:
+            return
+        with self._lock:
+            data = [
+                {"key": key, "created": entry.created, "generated": entry.generated}
+                for key, entry in self._entries.items()
+                if not self._expired(entry)
+            ]
+        directory = os.path.dirname(self.persist_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # write then rename, a crash mid-write must not corrupt the old file
+        temp_path = f"{self.persist_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(temp_path, self.persist_path)
+        self.logger.info(
+            f"Saved {len(data)} response cache entries to {self.persist_path}"
+        )
+
+    def _load(self) -> None:
+        assert self.persist_path is not None
+        if not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Ignoring unreadable response cache file: {e}")
+            return
+
+        with self._lock:
+            for item in data:
+                entry = _Entry(item["generated"], item["created"])
+                if self._expired(entry):
+                    continue
+                self._entries[item["key"]] = entry
+                self.total_tokens += entry.num_tokens
+            self._evict()
+        self.logger.info(
+            f"Loaded {len(self._entries)} response cache entries "
+            f"from {self.persist_path}"
+        )
+
+    def _expired(self, entry: _Entry) -> bool:
+        return self.ttl > 0 and time.time() - entry.created > self.ttl
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self.total_tokens -= entry.num_tokens
+
+    def _evict(self) -> None:
+        while self._entries and (
+            len(self._entries) > self.max_entries
+            or self.total_tokens > self.max_tokens
+        ):
+            key = next(iter(self._entries))
+            self._remove(key)
@@ -0,0 +1,34 @@
+import threading
+from contextlib import contextmanager
+from transformers.modeling_utils import PreTrainedModel
+
+
+class ForwardCounter:
+    """
+    Counts forward calls of a (draft) model per calling thread.
+
+    Each draft forward proposes one candidate token, so the count of a request
+    is the number of tokens it proposed.
+    """
+
+    def __init__(self, model: PreTrainedModel) -> None:
+        self._counts: dict[int, int] = {}
+        self._lock = threading.Lock()
+        model.register_forward_pre_hook(self._hook)
+
+    def _hook(self, module, args) -> None:
+        ident = threading.get_ident()
+        if ident in self._counts:
+            self._counts[ident] += 1
+
+    @contextmanager
+    def track(self):
+        """Yields a callable returning the calls made so far from this thread."""
+        ident = threading.get_ident()
+        with self._lock:
+            self._counts[ident] = 0
+        try:
+            yield lambda: self._counts[ident]
+        finally:
+            with self._lock:
+                self._counts.pop(ident, None)
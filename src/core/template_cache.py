@@ -0,0 +1,54 @@
+import copy
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from transformers.tokenization_utils_base import BatchEncoding
+
+
+class TemplateCache:
+    """
+    LRU cache of templated and tokenized conversations.
+
+    Entries are keyed on a canonical hash of the message list and the template
+    options, and hold the model inputs exactly as they are passed to `generate`,
+    including processed pixel values for multimodal conversations.
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, BatchEncoding] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(conversation: list, **options) -> str:
+        canonical = json.dumps(
+            {"conversation": conversation, "options": options},
+            sort_keys=True,
+            separators=(",", ":"),
+            default=str,
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, key: str) -> BatchEncoding | None:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        # a shallow copy, so `.to()` on the result cannot swap the cached tensors
+        return copy.copy(value)
+
+    def put(self, key: str, value: BatchEncoding) -> None:
+        with self._lock:
+            self._entries[key] = copy.copy(value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
@@ -0,0 +1,735 @@
+import os
+import torch
+import pickle
+import signal
+import asyncio
+import logging
+import itertools
+import threading
+import multiprocessing
+from src.core import metrics
+from config.settings import AppSettings
+from src.core.engine import InferenceEngine
+from src.core.loader import load_tokenizer
+from src.core.cancellation import StopSignal
+from src.core.constrained import OutputConstraint
+from multiprocessing.connection import Connection
+from src.core.executor import EngineUnavailableError
+from concurrent.futures import Future, InvalidStateError
+from transformers.generation.streamers import BaseStreamer
+from transformers.generation.configuration_utils import GenerationConfig
+from src.core.outputs import EmbeddingResult, GenerationResult, TokenLogprob
+
+# engine methods a worker serves, the streaming ones push tokens back as they come
+STREAM_METHODS = ("stream_completions", "stream_chat_completions")
+SUBMIT_METHODS = ("submit_completions", "submit_chat_completions", "submit_embeddings")
+# blocking methods, run on a thread of their own instead of the executor
+BLOCKING_METHODS = ("generate_batch",)
+# methods taking a `StopSignal`, the front sets it over the pipe
+STOPPABLE_METHODS = STREAM_METHODS + ("submit_completions", "submit_chat_completions")
+# a worker answers it with the snapshot of its metrics registry
+METRICS_SNAPSHOT = "metrics_snapshot"
+# a scrape leaves out workers that do not answer within this many seconds
+SNAPSHOT_TIMEOUT = 5.0
+
+
+def _picklable(error: Exception) -> Exception:
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")
+
+
+class _PipeStreamer(BaseStreamer):
+    """Forwards the tokens of one request from a worker to the front process."""
+
+    def __init__(self, server: "_WorkerServer", request_id: int) -> None:
+        self.server = server
+        self.request_id = request_id
+
+    def put(self, value) -> None:
+        self.server.send("tokens", self.request_id, value.tolist())
+
+    def put_logprobs(self, rows: list[list[TokenLogprob]]) -> None:
+        self.server.send("logprobs", self.request_id, rows)
+
+    def end(self) -> None:
+        self.server.send("end", self.request_id, None)
+
+
+class _WorkerServer:
+    """Runs the requests a worker process receives on its engine."""
+
+    def __init__(self, engine: InferenceEngine, conn: Connection) -> None:
+        self.engine = engine
+        self.conn = conn
+        self._send_lock = threading.Lock()
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._stops: dict[int, StopSignal] = {}
+
+    def send(self, kind: str, request_id: int | None, payload) -> None:
+        with self._send_lock:
+            self.conn.send((kind, request_id, payload))
+
+    async def serve(self) -> None:
+        while True:
+            try:
+                kind, request_id, payload = await asyncio.to_thread(self.conn.recv)
+            except (EOFError, OSError):
+                break  # the front process is gone
+            if kind == "close":
+                break
+            if kind in ("stop", "cancel"):
+                # a running generation only ends through its stop signal
+                stop = self._stops.get(request_id)
+                if stop is not None:
+                    stop.set(payload or "cancelled")
+                task = self._tasks.get(request_id)
+                if kind == "cancel" and task is not None:
+                    task.cancel()
+                continue
+            if kind == METRICS_SNAPSHOT:
+                # engine metrics are recorded here, the front serves `/metrics`
+                self.send("result", request_id, metrics.REGISTRY.snapshot())
+                continue
+            if kind in STOPPABLE_METHODS:
+                payload["stop"] = self._stops[request_id] = StopSignal()
+            self._tasks[request_id] = asyncio.create_task(
+                self._run(kind, request_id, payload)
+            )
+        for stop in list(self._stops.values()):
+            stop.set("shutdown")
+        for task in self._tasks.values():
+            task.cancel()
+        self.engine.close()
+
+    async def _run(self, method: str, request_id: int, kwargs: dict) -> None:
+        try:
+            if method in STREAM_METHODS:
+                streamer = _PipeStreamer(self, request_id)
+                future = getattr(self.engine, method)(streamer=streamer, **kwargs)
+                result = await asyncio.wrap_future(future)
+            elif method in SUBMIT_METHODS:
+                result = await getattr(self.engine, method)(**kwargs)
+            elif method in BLOCKING_METHODS:
+                result = await asyncio.to_thread(getattr(self.engine, method), **kwargs)
+                if isinstance(result, list):
+                    result = [
+                        _picklable(item) if isinstance(item, Exception) else item
+                        for item in result
+                    ]
+            else:
+                raise ValueError(f"Unknown worker method: {method}")
+            self.send("result", request_id, result)
+        except asyncio.CancelledError:
+            pass  # the front dropped the request already
+        except Exception as e:
+            self.send("error", request_id, _picklable(e))
+        finally:
+            self._tasks.pop(request_id, None)
+            self._stops.pop(request_id, None)
+
+
+def _worker_main(
+    index: int, settings: AppSettings, cores: list[int], conn: Connection
+) -> None:
+    # the front process decides when workers shut down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=settings.log.level.upper())
+    logger = logging.getLogger(f" TransAPI worker {index} ")
+    if cores:
+        os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+        logger.info(f"Pinned to CPU cores {cores}")
+    try:
+        engine = InferenceEngine(settings, logger)
+    except Exception as e:
+        logger.error(f"Failed to initialize engine: {e}", exc_info=True)
+        conn.send(("failed", None, f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", None, engine.memory_footprint()))
+    asyncio.run(_WorkerServer(engine, conn).serve())
+
+
+class _Call:
+    """A request sent to a worker, until its result comes back."""
+
+    def __init__(
+        self, worker: "_Worker", cost: int, streamer: BaseStreamer | None
+    ) -> None:
+        self.worker = worker
+        self.cost = cost
+        self.streamer = streamer
+        self.ended = False
+        self.future: Future = Future()
+
+    def end_stream(self) -> None:
+        if self.streamer is not None and not self.ended:
+            self.ended = True
+            self.streamer.end()
+
+
+class _Worker:
+    """Front side handle of one worker process."""
+
+    def __init__(
+        self,
+        index: int,
+        device: str,
+        cores: list[int],
+        process: multiprocessing.process.BaseProcess,
+        conn: Connection,
+    ) -> None:
+        self.index = index
+        self.device = device
+        self.cores = cores
+        self.process = process
+        self.conn = conn
+        self.alive = True
+        self.footprint = 0
+        self.outstanding_requests = 0
+        self.outstanding_tokens = 0
+        self.reader: threading.Thread | None = None
+        self._send_lock = threading.Lock()
+
+    def send(self, kind: str, request_id: int | None, payload) -> None:
+        with self._send_lock:
+            self.conn.send((kind, request_id, payload))
+
+    def status(self) -> dict:
+        return {
+            "index": self.index,
+            "device": self.device,
+            "pid": self.process.pid,
+            "alive": self.alive and self.process.is_alive(),
+            "outstanding_requests": self.outstanding_requests,
+            "outstanding_tokens": self.outstanding_tokens,
+        }
+
+
+class WorkerPool:
+    """
+    Engine worker processes of one model, each holding its own replica.
+
+    Requests go over a pipe to the live worker with the fewest outstanding
+    tokens, the prompt and token budget of everything it is still working on.
+    Tokens and results come back on one reader thread per worker. A worker that
+    exits fails its outstanding requests and gets no new ones.
+    """
+
+    def __init__(self, settings: AppSettings, logger: logging.Logger) -> None:
+        self.settings = settings
+        self.logger = logger
+        self.workers: list[_Worker] = []
+        self._lock = threading.Lock()
+        self._calls: dict[int, _Call] = {}
+        self._ids = itertools.count()
+        self._rotation = itertools.count()
+        self._closed = False
+
+        count = settings.data_parallel.workers
+        devices = self._devices(count)
+        cores = self._core_sets(devices)
+        context = multiprocessing.get_context("spawn")
+        for index, (device, core_set) in enumerate(zip(devices, cores)):
+            conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=_worker_main,
+                args=(index, self._worker_settings(device), core_set, child_conn),
+                name=f"transapi-worker-{index}",
+            )
+            process.start()
+            child_conn.close()  # so a dead worker shows up as EOF
+            self.workers.append(_Worker(index, device, core_set, process, conn))
+            logger.info(f"Started inference worker {index} on {device}")
+
+        try:
+            for worker in self.workers:
+                self._wait_ready(worker)
+        except Exception:
+            self.close()
+            raise
+        for worker in self.workers:
+            worker.reader = threading.Thread(
+                target=self._read,
+                args=(worker,),
+                name=f"worker-{worker.index}-reader",
+                daemon=True,
+            )
+            worker.reader.start()
+
+    def _devices(self, count: int) -> list[str]:
+        configured = self.settings.data_parallel.devices
+        if configured:
+            return [configured[index % len(configured)] for index in range(count)]
+        gpus = torch.cuda.device_count()
+        if self.settings.model.device == "cpu" or gpus == 0:
+            return ["cpu"] * count
+        return [f"cuda:{index % gpus}" for index in range(count)]
+
+    def _core_sets(self, devices: list[str]) -> list[list[int]]:
+        """Splits the available cores evenly among the CPU workers."""
+        num_cpu = sum(device == "cpu" for device in devices)
+        if (
+            not self.settings.data_parallel.pin_cpu_cores
+            or num_cpu < 2
+            or not hasattr(os, "sched_getaffinity")
+        ):
+            return [[] for _ in devices]
+        available = sorted(os.sched_getaffinity(0))
+        per_worker = max(len(available) // num_cpu, 1)
+        core_sets, position = [], 0
+        for device in devices:
+            if device != "cpu":
+                core_sets.append([])
+                continue
+            core_set = available[position : position + per_worker]
+            position += per_worker
+            # more workers than cores, the rest share all of them
+            core_sets.append(core_set or available)
+        return core_sets
+
+    def _worker_settings(self, device: str) -> AppSettings:
+        return self.settings.model_copy(
+            update={
+                "model": self.settings.model.model_copy(update={"device": device}),
+                "data_parallel": self.settings.data_parallel.model_copy(
+                    update={"workers": 1}
+                ),
+            }
+        )
+
+    def _wait_ready(self, worker: _Worker) -> None:
+        try:
+            kind, _, payload = worker.conn.recv()
+        except (EOFError, OSError):
+            kind, payload = "failed", "the process exited"
+        if kind != "ready":
+            raise RuntimeError(f"Inference worker {worker.index} failed: {payload}")
+        worker.footprint = payload
+        self.logger.info(f"Inference worker {worker.index} is ready")
+
+    @property
+    def outstanding(self) -> int:
+        """Number of requests sent to a worker and not finished yet."""
+        return sum(worker.outstanding_requests for worker in self.workers)
+
+    @property
+    def queue_depth(self) -> int:
+        """Requests beyond what the workers run at once, waiting in their queues."""
+        max_concurrency = max(self.settings.executor.max_concurrency, 1)
+        return sum(
+            max(worker.outstanding_requests - max_concurrency, 0)
+            for worker in self.workers
+        )
+
+    @property
+    def footprint(self) -> int:
+        return sum(worker.footprint for worker in self.workers)
+
+    def status(self) -> list[dict]:
+        return [worker.status() for worker in self.workers]
+
+    def _pick(self) -> _Worker:
+        alive = [worker for worker in self.workers if worker.alive]
+        if not alive:
+            raise EngineUnavailableError("No inference worker is alive")
+        # rotate the start so ties do not always land on the first worker
+        start = next(self._rotation) % len(alive)
+        rotated = alive[start:] + alive[:start]
+        return min(
+            rotated,
+            key=lambda worker: (worker.outstanding_tokens, worker.outstanding_requests),
+        )
+
+    def submit(
+        self,
+        method: str,
+        cost: int,
+        streamer: BaseStreamer | None = None,
+        stop: StopSignal | None = None,
+        **kwargs,
+    ) -> Future:
+        """
+        Runs the engine `method` on the least loaded worker.
+
+        `cost` is the number of tokens the request adds to the worker's load.
+        Cancelling the returned future cancels the request on the worker, and
+        setting `stop` sets the worker's stop signal of the request.
+        """
+        with self._lock:
+            if self._closed:
+                raise EngineUnavailableError("Inference engine is shutting down")
+            worker = self._pick()
+            request_id, call = self._register(worker, cost, streamer)
+        self._send(worker, method, request_id, kwargs)
+
+        def cancelled(future: Future) -> None:
+            if future.cancelled() and self._finish(request_id) is not None:
+                try:
+                    worker.send("cancel", request_id, None)
+                except (OSError, ValueError):
+                    pass
+
+        call.future.add_done_callback(cancelled)
+
+        def stopped(reason: str) -> None:
+            if request_id in self._calls:
+                try:
+                    worker.send("stop", request_id, reason)
+                except (OSError, ValueError):
+                    pass
+
+        if stop is not None:
+            stop.add_callback(stopped)
+        return call.future
+
+    def broadcast(self, method: str, **kwargs) -> list[Future]:
+        """Sends `method` to every live worker, futures of their results."""
+        with self._lock:
+            if self._closed:
+                raise EngineUnavailableError("Inference engine is shutting down")
+            calls = [
+                (worker, *self._register(worker, 0, None))
+                for worker in self.workers
+                if worker.alive
+            ]
+        for worker, request_id, call in calls:
+            try:
+                self._send(worker, method, request_id, kwargs)
+            except EngineUnavailableError as e:
+                self._resolve(call, error=e)
+                continue
+
+            def cancelled(future: Future, request_id: int = request_id) -> None:
+                # a worker that never answers must not stay busy
+                if future.cancelled():
+                    self._finish(request_id)
+
+            call.future.add_done_callback(cancelled)
+        return [call.future for _, _, call in calls]
+
+    def _register(
+        self, worker: _Worker, cost: int, streamer: BaseStreamer | None
+    ) -> tuple[int, _Call]:
+        """Tracks a new call to `worker`, the caller holds `_lock`."""
+        request_id = next(self._ids)
+        call = _Call(worker, cost, streamer)
+        self._calls[request_id] = call
+        worker.outstanding_requests += 1
+        worker.outstanding_tokens += cost
+        return request_id, call
+
+    def _send(self, worker: _Worker, method: str, request_id: int, kwargs) -> None:
+        try:
+            worker.send(method, request_id, kwargs)
+        except (OSError, ValueError) as e:
+            self._finish(request_id)
+            raise EngineUnavailableError(
+                f"Inference worker {worker.index} is unavailable"
+            ) from e
+
+    def _finish(self, request_id: int) -> _Call | None:
+        with self._lock:
+            call = self._calls.pop(request_id, None)
+            if call is not None:
+                call.worker.outstanding_requests -= 1
+                call.worker.outstanding_tokens -= call.cost
+        return call
+
+    @staticmethod
+    def _resolve(call: _Call, result=None, error: Exception | None = None) -> None:
+        try:
+            if error is not None:
+                call.future.set_exception(error)
+            else:
+                call.future.set_result(result)
+        except InvalidStateError:
+            pass  # cancelled in the meantime
+
+    def _read(self, worker: _Worker) -> None:
+        while True:
+            try:
+                kind, request_id, payload = worker.conn.recv()
+            except (EOFError, OSError):
+                break
+            call = self._calls.get(request_id)
+            if call is None:
+                continue  # cancelled, late tokens are dropped
+            if kind == "tokens":
+                if call.streamer is not None:
+                    call.streamer.put(torch.tensor(payload))
+            elif kind == "logprobs":
+                if call.streamer is not None:
+                    call.streamer.put_logprobs(payload)  # type: ignore
+            elif kind == "end":
+                call.end_stream()
+            elif kind in ("result", "error"):
+                self._finish(request_id)
+                call.end_stream()
+                if kind == "result":
+                    self._resolve(call, result=payload)
+                else:
+                    self._resolve(call, error=payload)
+
+        worker.alive = False
+        if not self._closed:
+            self.logger.error(f"Inference worker {worker.index} exited")
+        with self._lock:
+            lost = [
+                request_id
+                for request_id, call in self._calls.items()
+                if call.worker is worker
+            ]
+        for request_id in lost:
+            call = self._finish(request_id)
+            if call is not None:
+                call.end_stream()
+                self._resolve(
+                    call,
+                    error=EngineUnavailableError(
+                        f"Inference worker {worker.index} exited"
+                    ),
+                )
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+        for worker in self.workers:
+            try:
+                worker.send("close", None, None)
+            except (OSError, ValueError):
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=30)
+            if worker.process.is_alive():
+                self.logger.warning(f"Terminating inference worker {worker.index}")
+                worker.process.terminate()
+                worker.process.join()
+            if worker.reader is not None:
+                worker.reader.join(timeout=5)
+            worker.conn.close()
+
+
+class DataParallelEngine:
+    """
+    Serves one model from several worker processes, one replica each.
+
+    Takes the place of `InferenceEngine` when `data_parallel.workers` > 1. The
+    front process only loads the tokenizer, to detokenize streams and estimate
+    the token cost of a request for dispatch.
+    """
+
+    # engine state the metrics endpoint reads, kept inside the workers
+    prefix_cache = None
+    template_cache = None
+    response_cache = None
+    grammar_cache = None
+    kv_memory = None
+
+    def __init__(self, settings: AppSettings, logger: logging.Logger) -> None:
+        self.settings = settings
+        self.logger = logger
+        metrics.REGISTRY.enabled = settings.metrics.enabled
+        self.tokenizer = load_tokenizer(settings.model.model_path)
+        self.executor = WorkerPool(settings, logger)
+
+    def recompiles(self) -> int | None:
+        return None
+
+    @property
+    def busy(self) -> bool:
+        return self.executor.outstanding > 0
+
+    def memory_footprint(self) -> int:
+        return self.executor.footprint
+
+    def offload(self) -> bool:
+        # weights live in the worker processes, evicting releases them
+        return False
+
+    def close(self) -> None:
+        self.executor.close()
+
+    def _cost(self, text: str, generation_config: GenerationConfig | None) -> int:
+        """Prompt tokens plus the token budget of every returned sequence."""
+        num_prompt_tokens = len(self.tokenizer.encode(text))
+        if generation_config is None:
+            return num_prompt_tokens
+        # `max_tokens` of a request sets `max_length`, which counts the prompt
+        budget = generation_config.max_new_tokens
+        if budget is None:
+            budget = max((generation_config.max_length or 0) - num_prompt_tokens, 0)
+        num_sequences = generation_config.num_return_sequences or 1
+        return num_prompt_tokens + budget * num_sequences
+
+    @staticmethod
+    def _conversation_text(
+        conversation: list[dict[str, str]] | list[list[dict[str, str]]],
+    ) -> str:
+        batched = bool(conversation) and isinstance(conversation[0], list)
+        conversations = conversation if batched else [conversation]
+        texts = []
+        for messages in conversations:
+            for message in messages:
+                content = message.get("content")
+                if isinstance(content, str):
+                    texts.append(content)
+                elif isinstance(content, list):
+                    texts.extend(
+                        part.get("text", "")
+                        for part in content
+                        if isinstance(part, dict)
+                    )
+        return "\n".join(texts)
+
+    def stream_completions(
+        self,
+        prompt: str,
+        streamer: BaseStreamer,
+        generation_config: GenerationConfig | None = None,
+        **kwargs,
+    ) -> Future:
+        return self.executor.submit(
+            "stream_completions",
+            self._cost(prompt, generation_config),
+            streamer,
+            prompt=prompt,
+            generation_config=generation_config,
+            **kwargs,
+        )
+
+    def stream_chat_completions(
+        self,
+        conversation: list[dict[str, str]] | list[list[dict[str, str]]],
+        streamer: BaseStreamer,
+        generation_config: GenerationConfig | None = None,
+        **kwargs,
+    ) -> Future:
+        return self.executor.submit(
+            "stream_chat_completions",
+            self._cost(self._conversation_text(conversation), generation_config),
+            streamer,
+            conversation=conversation,
+            generation_config=generation_config,
+            **kwargs,
+        )
+
+    async def compile_constraint(self, constraint: OutputConstraint) -> None:
+        # only validated here, each worker compiles its own token automaton
+        await asyncio.to_thread(constraint.dfa)
+
+    async def metrics_snapshots(self) -> list[dict]:
+        """Metrics the workers recorded, their engines run in those processes."""
+        futures = [
+            asyncio.wrap_future(future)
+            for future in self.executor.broadcast(METRICS_SNAPSHOT)
+        ]
+        if not futures:
+            return []
+        done, pending = await asyncio.wait(futures, timeout=SNAPSHOT_TIMEOUT)
+        for future in pending:
+            future.cancel()
+        return [
+            future.result()
+            for future in done
+            if not future.cancelled() and future.exception() is None
+        ]
+
+    async def submit_completions(
+        self,
+        prompt: str,
+        generation_config: GenerationConfig | None = None,
+        **kwargs,
+    ) -> GenerationResult:
+        future = self.executor.submit(
+            "submit_completions",
+            self._cost(prompt, generation_config),
+            prompt=prompt,
+            generation_config=generation_config,
+            **kwargs,
+        )
+        return await asyncio.wrap_future(future)
+
+    async def submit_chat_completions(
+        self,
+        conversation: list[dict[str, str]] | list[list[dict[str, str]]],
+        generation_config: GenerationConfig | None = None,
+        **kwargs,
+    ) -> GenerationResult:
+        future = self.executor.submit(
+            "submit_chat_completions",
+            self._cost(self._conversation_text(conversation), generation_config),
+            conversation=conversation,
+            generation_config=generation_config,
+            **kwargs,
+        )
+        return await asyncio.wrap_future(future)
+
+    async def submit_embeddings(
+        self, inputs: list[str] | list[list[int]], pooling: str | None = None
+    ) -> EmbeddingResult:
+        # estimated with this tokenizer, a dedicated encoder may count differently
+        cost = sum(
+            len(self.tokenizer.encode(item)) if isinstance(item, str) else len(item)
+            for item in inputs
+        )
+        future = self.executor.submit(
+            "submit_embeddings", cost, inputs=inputs, pooling=pooling
+        )
+        return await asyncio.wrap_future(future)
+
+    def generate_batch(
+        self,
+        prompts: list[str | list[dict[str, str]]],
+        generation_configs: list[GenerationConfig | None],
+    ) -> list[GenerationResult | Exception]:
+        """Runs an offline chunk on the least loaded worker, blocks until done."""
+        cost = 0
+        for prompt, config in zip(prompts, generation_configs):
+            if not isinstance(prompt, str):
+                prompt = self._conversation_text(prompt)
+            cost += self._cost(prompt, config)
+        future = self.executor.submit(
+            "generate_batch",
+            cost,
+            prompts=prompts,
+            generation_configs=generation_configs,
+        )
+        return future.result()
+
+    def tokenize(self, prompt: str) -> list[int]:
+        return self.tokenizer.encode(prompt)
+
+    def detokenize(self, tokens: list[int]) -> str:
+        return self.tokenizer.decode(tokens)
+
+    def tokenize_batch(
+        self, prompts: list[str], add_special_tokens: bool = True
+    ) -> list[list[int]]:
+        return self.tokenizer(prompts, add_special_tokens=add_special_tokens)[
+            "input_ids"
+        ]  # type: ignore
+
+    def tokenize_conversations(
+        self,
+        conversations: list[list[dict[str, str]]],
+        add_generation_prompt: bool = True,
+    ) -> list[list[int]]:
+        # the front has no processor, multimodal parts are templated as text
+        return [
+            self.tokenizer.apply_chat_template(
+                conversation,
+                add_generation_prompt=add_generation_prompt,
+                tokenize=True,
+            )
+            for conversation in conversations
+        ]  # type: ignore
+
+    def detokenize_batch(
+        self, token_lists: list[list[int]], skip_special_tokens: bool = False
+    ) -> list[str]:
+        return self.tokenizer.batch_decode(
+            token_lists, skip_special_tokens=skip_special_tokens
+        )
@@ -0,0 +1,63 @@
+import logging
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from src.core.engine import InferenceEngine
+from src.core.constrained import GrammarCache
+from src.api.endpoints import chat_completions, completions
+from config.settings import AppSettings, ModelSettings
+
+INVALID_FORMATS = [
+    {"type": "regex", "regex": "(ab"},
+    {"type": "json_schema", "json_schema": {"schema": {"type": "tuple"}}},
+]
+
+
+class _Engine:
+    """Serves no tokens, invalid constraints fail before generation starts."""
+
+    settings = AppSettings(model=ModelSettings(model_path="stub"))
+    compile_constraint = InferenceEngine.compile_constraint
+
+    def __init__(self) -> None:
+        # an invalid constraint fails before the vocabulary is read
+        self.grammar_cache = GrammarCache(None, 8, logging.getLogger("test"))
+
+
+class _Registry:
+    def __init__(self) -> None:
+        self.engine = _Engine()
+
+    async def get(self, model):
+        return self.engine
+
+    def release(self, model) -> None:
+        pass
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(completions.router)
+    app.include_router(chat_completions.router)
+    app.state.registry = _Registry()
+    return TestClient(app)
+
+
+@pytest.mark.parametrize("response_format", INVALID_FORMATS)
+@pytest.mark.parametrize("stream", [False, True])
+def test_invalid_response_format_is_a_bad_request(client, response_format, stream):
+    response = client.post(
+        "/v1/completions",
+        json={"prompt": "Hi", "response_format": response_format, "stream": stream},
+    )
+    assert response.status_code == 400
+    response = client.post(
+        "/v1/chat/completions",
+        json={
+            "messages": [{"role": "user", "content": "Hi"}],
+            "response_format": response_format,
+            "stream": stream,
+        },
+    )
+    assert response.status_code == 400
@@ -0,0 +1,62 @@
+import re
+import pytest
+from src.core.fsm import DFA
+
+PATTERNS = [
+    r"abc",
+    r"a|bc|",
+    r"(ab)*c+d?",
+    r"[a-c0-9_]{2,4}",
+    r"[^a-z]+",
+    r"\d+(\.\d{1,2})?",
+    r"\w+\s\w+",
+    r"(true|false|null)",
+    r"x{3}",
+    r"x{2,}",
+    r'"([^"\\]|\\.)*"',
+    r"é[α-ω]*",
+]
+TEXTS = [
+    "",
+    "abc",
+    "a",
+    "bc",
+    "ababcc",
+    "cd",
+    "abcd",
+    "a_9",
+    "a_9xy",
+    "ABC 12",
+    "12.5",
+    "12.",
+    "12.345",
+    "foo bar",
+    "foo  bar",
+    "true",
+    "nul",
+    "xxx",
+    "xx",
+    "xxxxx",
+    '"a\\"b"',
+    '"a"b"',
+    "éαβ",
+    "éa",
+]
+
+
+@pytest.mark.parametrize("pattern", PATTERNS)
+def test_matches_like_re(pattern):
+    dfa = DFA(pattern)
+    for text in TEXTS:
+        assert dfa.matches(text) == bool(re.fullmatch(pattern, text)), text
+
+
+def test_classes_cover_every_code_point():
+    dfa = DFA(r"[^\n]*")
+    assert dfa.matches("any text \U0010ffff")
+    assert not dfa.matches("two\nlines")
+
+
+def test_rejects_invalid_patterns():
+    with pytest.raises(ValueError):
+        DFA(r"(ab")
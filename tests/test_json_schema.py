@@ -0,0 +1,102 @@
+import json
+import pytest
+from src.core.fsm import DFA
+from src.core.json_schema import schema_to_regex
+
+PERSON = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string", "maxLength": 8},
+        "age": {"type": "integer"},
+        "tags": {"type": "array", "items": {"enum": ["a", "b"]}, "maxItems": 2},
+    },
+    "required": ["name", "age"],
+}
+
+CASES = [
+    (
+        PERSON,
+        [
+            {"name": "Ann", "age": 31},
+            {"name": "Ann", "age": -2, "tags": ["a", "b"]},
+            {"name": "", "age": 0, "tags": []},
+        ],
+        [
+            {"age": 31},
+            {"name": "Ann", "age": 1.5},
+            {"name": "a long name", "age": 31},
+            {"name": "Ann", "age": 31, "tags": ["c"]},
+            {"name": "Ann", "age": 31, "tags": ["a", "b", "a"]},
+            {"name": "Ann", "age": 31, "extra": True},
+            ["Ann", 31],
+        ],
+    ),
+    (
+        {"anyOf": [{"type": "number"}, {"type": "null"}]},
+        [1, -0.5, 2e10, None],
+        ["1", True, [1]],
+    ),
+    (
+        {"type": ["boolean", "string"], "pattern": "^[a-z]+$"},
+        [True, False, "abc"],
+        ["ABC", "", 1],
+    ),
+    (
+        {
+            "$defs": {"leaf": {"const": "leaf"}},
+            "type": "array",
+            "items": {"$ref": "#/$defs/leaf"},
+            "minItems": 1,
+        },
+        [["leaf"], ["leaf", "leaf"]],
+        [[], ["node"]],
+    ),
+    (
+        {
+            "allOf": [
+                {"properties": {"a": {"type": "integer"}}, "required": ["a"]},
+                {"properties": {"b": {"type": "boolean"}}},
+            ]
+        },
+        [{"a": 1}, {"a": 1, "b": False}],
+        [{"b": True}, {"a": 1, "b": 1}],
+    ),
+    (
+        {"type": "object", "additionalProperties": {"type": "integer"}},
+        [{}, {"x": 1, "y": 2}],
+        [{"x": "1"}],
+    ),
+]
+
+
+@pytest.mark.parametrize("schema, valid, invalid", CASES)
+def test_dfa_accepts_valid_instances_only(schema, valid, invalid):
+    dfa = DFA(schema_to_regex(schema))
+    for instance in valid:
+        assert dfa.matches(json.dumps(instance)), instance
+        assert dfa.matches(json.dumps(instance, separators=(",", ":"))), instance
+    for instance in invalid:
+        assert not dfa.matches(json.dumps(instance)), instance
+
+
+def test_strings_accept_escapes_only_in_json_form():
+    dfa = DFA(schema_to_regex({"type": "string"}))
+    assert dfa.matches(json.dumps('quote " and \\ and \n and é'))
+    assert dfa.matches(json.dumps("é", ensure_ascii=True))
+    assert not dfa.matches('"raw\nnewline"')
+    assert not dfa.matches('"bad \\x escape"')
+
+
+def test_free_form_object_accepts_nested_json():
+    dfa = DFA(schema_to_regex({"type": "object"}))
+    assert dfa.matches(json.dumps({"a": [1, {"b": None}], "c": "d"}))
+    assert not dfa.matches(json.dumps([1]))
+
+
+@pytest.mark.parametrize(
+    "schema",
+    [{"type": "tuple"}, {"$ref": "other.json#/a"}, {"$ref": "#/missing"}],
+)
+def test_unsupported_schemas_raise(schema):
+    with pytest.raises(ValueError):
+        schema_to_regex(schema)
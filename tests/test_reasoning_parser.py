@@ -0,0 +1,49 @@
+import pytest
+from config.settings import ReasoningSettings
+from src.api.utils.reasoning_parser import ReasoningSplitter, split_reasoning
+
+SETTINGS = ReasoningSettings(enabled=True)
+CASES = [
+    ("<think>\nplan it\n</think>\n\nThe answer.", "plan it\n", "The answer."),
+    ("  <think>a < b</think>c", "a < b", "c"),
+    ("No thinking at all.", "", "No thinking at all."),
+    ("Text mentioning <think> later", "", "Text mentioning <think> later"),
+    ("<think>cut off while thinking <", "cut off while thinking <", ""),
+    ("<thin", "", "<thin"),
+    ("<think></think>", "", ""),
+]
+
+
+def _stream(text: str, size: int, settings: ReasoningSettings) -> tuple[str, str]:
+    splitter = ReasoningSplitter(settings)
+    reasoning, content = "", ""
+    for offset in range(0, len(text), size):
+        more_reasoning, more_content = splitter.feed(text[offset : offset + size])
+        reasoning += more_reasoning
+        content += more_content
+    rest_reasoning, rest_content = splitter.flush()
+    return reasoning + rest_reasoning, content + rest_content
+
+
+@pytest.mark.parametrize("text, reasoning, content", CASES)
+def test_splits_whole_text(text, reasoning, content):
+    assert split_reasoning(text, SETTINGS) == (reasoning, content)
+
+
+@pytest.mark.parametrize("text, reasoning, content", CASES)
+@pytest.mark.parametrize("size", [1, 2, 5, 100])
+def test_chunked_input_splits_like_whole_text(text, reasoning, content, size):
+    assert _stream(text, size, SETTINGS) == (reasoning, content)
+
+
+@pytest.mark.parametrize("size", [1, 3, 100])
+def test_thinking_opened_by_the_prompt(size):
+    settings = ReasoningSettings(enabled=True, starts_thinking=True)
+    text = "step one</think>\nresult"
+    assert _stream(text, size, settings) == ("step one", "result")
+
+
+def test_content_is_not_held_back_after_thinking():
+    splitter = ReasoningSplitter(SETTINGS)
+    assert splitter.feed("<think>x</think>") == ("x", "")
+    assert splitter.feed("done <") == ("", "done <")
@@ -0,0 +1,86 @@
+import json
+import pytest
+from src.api.utils.tool_parser import ToolCallParser, parse_tool_calls
+
+START, END = "<tool_call>", "</tool_call>"
+OUTPUTS = [
+    "no tool call here",
+    'Sure. <tool_call>{"name": "get_weather", "arguments": {"city": "Paris"}}'
+    "</tool_call>",
+    '<tool_call>{"name": "f", "arguments": {"q": "a}b\\"", "n": [1, {"m": 2}]}}'
+    '</tool_call><tool_call>{"name": "g", "arguments": {}}</tool_call> done',
+    # arguments given as a JSON string come out decoded
+    '<tool_call>{"name": "f", "arguments": "{\\"a\\": 1, \\"b\\": \\"x\\\\\\"y\\"}"}'
+    "</tool_call>",
+    '<tool_call>{"name": "h", "arguments": "\\u00e9"}</tool_call>',
+    '<tool_call>{"name": "k", "arguments": null}</tool_call>',
+    # a layout the head does not match is parsed once the call ends
+    '<tool_call>{"arguments": {"x": 1}, "name": "late"}</tool_call>',
+    # a call missing its end marker
+    'text <tool_call>{"name": "cut", "arguments": {"a": 1}',
+    "a < b and <tool_ not a marker",
+]
+
+
+def _stream(text: str, size: int) -> tuple[str, list[dict]]:
+    parser = ToolCallParser(START, END)
+    content = ""
+    calls: dict[int, dict] = {}
+
+    def merge(text: str, deltas) -> None:
+        nonlocal content
+        content += text
+        for delta in deltas:
+            call = calls.setdefault(delta.index, {"name": None, "arguments": ""})
+            if delta.function.name is not None:
+                assert call["name"] is None, "name sent twice"
+                call["name"] = delta.function.name
+            call["arguments"] += delta.function.arguments or ""
+
+    for offset in range(0, len(text), size):
+        merge(*parser.feed(text[offset : offset + size]))
+    merge(*parser.flush())
+    return content, [calls[index] for index in sorted(calls)]
+
+
+@pytest.mark.parametrize("text", OUTPUTS)
+@pytest.mark.parametrize("size", [1, 3, 7, 100])
+def test_streaming_matches_whole_text(text, size):
+    content, calls = parse_tool_calls(text, START, END)
+    expected = [
+        {"name": call.function.name, "arguments": call.function.arguments or ""}
+        for call in calls
+    ]
+    assert _stream(text, size) == (content, expected)
+
+
+def test_parses_calls_and_content():
+    content, calls = parse_tool_calls(OUTPUTS[2], START, END)
+    assert content == " done"
+    assert [call.function.name for call in calls] == ["f", "g"]
+    assert json.loads(calls[0].function.arguments) == {
+        "q": 'a}b"',
+        "n": [1, {"m": 2}],
+    }
+    assert json.loads(calls[1].function.arguments) == {}
+    assert len({call.id for call in calls}) == 2
+
+
+def test_string_arguments_are_decoded():
+    _, calls = parse_tool_calls(OUTPUTS[3], START, END)
+    assert json.loads(calls[0].function.arguments) == {"a": 1, "b": 'x"y'}
+    _, calls = parse_tool_calls(OUTPUTS[4], START, END)
+    assert calls[0].function.arguments == "é"
+
+
+def test_text_that_only_looks_like_a_marker_is_content():
+    assert parse_tool_calls(OUTPUTS[-1], START, END) == (OUTPUTS[-1], [])
+
+
+def test_other_layouts_and_unterminated_calls_still_parse():
+    _, calls = parse_tool_calls(OUTPUTS[6], START, END)
+    assert calls[0].function.name == "late"
+    assert json.loads(calls[0].function.arguments) == {"x": 1}
+    content, calls = parse_tool_calls(OUTPUTS[7], START, END)
+    assert content == "text "
+    assert calls[0].function.name == "cut"